@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""Parses and validates the track files of a Genomedata archive,
+such that they can be parsed in parallel (i.e. by separate processes),
+into an intermediate, binary, per-chromosome form, from which each
+track is then loaded into the archive:
+
+    parsedTrack = parseBedGraph(trackFilename, parsedTrackDir)
+    with Genome(archive, mode='r+') as genome:
+        loadParsedTrack(genome, trackName, parsedTrack)
+
+Only bedGraph tracks are parsed, since they are the bulk of the data;
+other tracks are loaded by Genomedata itself.
+Loading a parsed track is equivalent to Genomedata's loading of the
+bedGraph itself, for which each interval sets the track's value
+over the part of the interval that is within a supercontig,
+with the last of any overlapping intervals taking precedence.
+
+Exports:
+
+Constants:
+
+BEDGRAPH_REGEX             - Identifies the filenames of bedGraph tracks.
+PARSED_RECORD_DTYPE        - Type of the records of parsed tracks.
+
+Functions:
+
+isBedGraph                 - Whether a track file is a bedGraph.
+iterBedGraphRecords        - Parse the records of a bedGraph.
+parseBedGraph              - Parse a bedGraph into per-chromosome files.
+loadParsedRecords          - Read the parsed records of a chromosome.
+fillTrackValues            - Fill values of a track from its records.
+loadParsedTrack            - Load a parsed track into an open archive.
+"""
+
+from __future__ import with_statement, division, print_function
+
+import os
+import re
+
+from itertools import izip
+
+import numpy as np
+
+import cytoUtils as cUtils
+
+__version__ = cUtils.__version__
+
+BEDGRAPH_REGEX = '\.bed[gG]raph(.gz)?$'
+# the (start, end, value) of each interval of a parsed track
+PARSED_RECORD_DTYPE = np.dtype([('start', '<i8'), ('end', '<i8'),
+                                ('value', '<f4')])
+_SUFFIX_PARSED = '.records'
+# prefixes of the header (i.e. non-interval) lines of a bedGraph
+_HEADER_PREFIXES = ('#', 'track', 'browser')
+# the approximate number of bytes of a bedGraph parsed at once
+_PARSE_BLOCK_SIZE = 2 ** 24
+# intervals of at most this length are filled together, by expanding them
+# to their positions, while longer intervals are filled one at a time
+_MAX_EXPANDED_INTERVAL_LEN = 64
+# the number of intervals expanded to their positions at once
+_EXPANSION_BATCH_SIZE = 2 ** 20
+
+
+def isBedGraph(filename):
+    """Returns whether the given track file is a bedGraph."""
+    return bool(re.search(BEDGRAPH_REGEX, filename))
+
+
+def _parseUniformBlock(block):
+    """Returns the chromosome and records of the given block of lines
+    of a bedGraph, if all of its lines are tab-delimited intervals of the
+    same chromosome, which is the case for nearly every block of a bedGraph,
+    such that the block is parsed entirely by NumPy.
+    Otherwise, returns None, such that the block is parsed line by line.
+    """
+    chrm = block[:block.find('\t')]
+    numLines = block.count('\n')
+    if (not chrm or chrm.startswith(_HEADER_PREFIXES) or
+            ' ' in block or '\r' in block or
+            ('\n' + block).count('\n' + chrm + '\t') != numLines):
+        return None
+    chars = np.frombuffer(block, dtype=np.uint8)
+    lineEnds = np.flatnonzero(chars == ord('\n'))
+    numTabs = np.diff(np.searchsorted(np.flatnonzero(chars == ord('\t')),
+                                      np.concatenate(([0], lineEnds))))
+    if np.any(numTabs != 3):
+        return None
+    # Once the chromosome is removed, any empty or invalid field stops,
+    # or shortens, the remaining numbers.
+    fields = np.fromstring(('\n' + block).replace('\n' + chrm + '\t', '\n'),
+                           sep=' ')
+    if fields.size != 3 * numLines:
+        return None
+    fields = fields.reshape(-1, 3)
+    positions = fields[:, :2]
+    if np.any(positions != np.floor(positions)):
+        return None
+    records = np.empty(numLines, dtype=PARSED_RECORD_DTYPE)
+    records['start'] = positions[:, 0]
+    records['end'] = positions[:, 1]
+    records['value'] = fields[:, 2]
+    return chrm, records
+
+
+def _parseBlockLines(block, filename, firstLineNum):
+    """Returns the chromosome of each interval of the given block of lines
+    of a bedGraph, whose first line has the given number, along with their
+    records, parsing each line in turn.
+    Raises ValueError if any line is not a valid interval.
+    """
+    rows = []
+    for lineNum, line in enumerate(block.splitlines(), firstLineNum):
+        if line.strip() and not line.startswith(_HEADER_PREFIXES):
+            fields = line.split()
+            if len(fields) != 4:
+                raise ValueError("Line {} of track {} does not "
+                                 "have four fields.".
+                                 format(lineNum, filename))
+            rows.append(fields)
+    records = np.empty(len(rows), dtype=PARSED_RECORD_DTYPE)
+    if not rows:
+        return np.array([], dtype=str), records
+    fields = np.array(rows)
+    try:
+        records['start'] = fields[:, 1].astype(np.int64)
+        records['end'] = fields[:, 2].astype(np.int64)
+        records['value'] = fields[:, 3].astype(np.float64)
+    except ValueError:
+        raise ValueError("Track {} contains invalid positions or "
+                         "values, between lines {} and {}.".
+                         format(filename, firstLineNum, lineNum))
+    return fields[:, 0], records
+
+
+def iterBedGraphRecords(filename):
+    """Yields each chromosome of the given (optionally gzipped) bedGraph,
+    along with an array of the records (see PARSED_RECORD_DTYPE) of
+    its intervals, in the order given, for each block of the file.
+    Raises ValueError if any line of the file is not a valid interval.
+    """
+    lineNum = 1
+    with cUtils.maybe_gzip_open(filename) as file:
+        while True:
+            block = file.read(_PARSE_BLOCK_SIZE)
+            if not block:
+                break
+            block += file.readline()  # such that only entire lines are read
+            if not block.endswith('\n'):
+                block += '\n'
+            parsed = _parseUniformBlock(block)
+            if parsed:
+                chrms, records = [parsed[0]], [parsed[1]]
+            else:
+                chrmNames, blockRecords = _parseBlockLines(block, filename,
+                                                           lineNum)
+                # each chromosome, in the order of its first interval
+                chrms, firstIdxs, chrmIdxs = np.unique(chrmNames,
+                                                       return_index=True,
+                                                       return_inverse=True)
+                order = np.argsort(firstIdxs)
+                chrms = chrms[order]
+                records = [blockRecords[chrmIdxs == chrmIdx]
+                           for chrmIdx in order]
+            nextLineNum = lineNum + block.count('\n')
+            for chrm, chrmRecords in izip(chrms, records):
+                if (np.any(chrmRecords['start'] < 0) or
+                        np.any(chrmRecords['end'] <= chrmRecords['start'])):
+                    raise ValueError("Track {} contains an empty interval "
+                                     "or a negative position, between "
+                                     "lines {} and {}.".
+                                     format(filename, lineNum,
+                                            nextLineNum - 1))
+                yield str(chrm), chrmRecords
+            lineNum = nextLineNum
+
+
+def parseBedGraph(filename, outDir):
+    """Parses and validates the given bedGraph, writing the records of
+    each of its chromosomes to a separate file within the given directory,
+    such that memory use does not depend upon the size of the track.
+    Returns a dict of the parsed file of each chromosome.
+    Raises ValueError if the bedGraph is invalid.
+    """
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    parsedFiles = {}
+    for chrm, records in iterBedGraphRecords(filename):
+        if chrm not in parsedFiles:
+            parsedFiles[chrm] = os.path.join(outDir, str(len(parsedFiles)) +
+                                             _SUFFIX_PARSED)
+        with open(parsedFiles[chrm], 'ab') as parsedFile:
+            records.tofile(parsedFile)
+    return parsedFiles
+
+
+def loadParsedRecords(parsedFile):
+    """Returns the records of the given parsed file of a chromosome,
+    sorted by their start, and whether any of them overlap, in which case
+    the records are instead returned in the order of the track.
+    """
+    records = np.fromfile(parsedFile, dtype=PARSED_RECORD_DTYPE)
+    sortedRecords = records[np.argsort(records['start'], kind='mergesort')]
+    if np.any(sortedRecords['end'][:-1] > sortedRecords['start'][1:]):
+        return records, True
+    return sortedRecords, False
+
+
+def fillTrackValues(values, start, records, overlapping):
+    """Fills the given array of the values of a track from the given
+    position onwards with those of the given records (see
+    loadParsedRecords), clipping them to the array.
+    """
+    end = start + values.size
+    if not overlapping:
+        # Only the records within the array, which are sorted by both
+        # their start and (since they do not overlap) end, are used.
+        records = records[np.searchsorted(records['end'], start, 'right'):
+                          np.searchsorted(records['start'], end)]
+    else:
+        records = records[(records['end'] > start) &
+                          (records['start'] < end)]
+    starts = np.maximum(records['start'], start) - start
+    ends = np.minimum(records['end'], end) - start
+    lengths = ends - starts
+    if overlapping:  # each record in turn, such that the last takes effect
+        for s, e, value in izip(starts, ends, records['value']):
+            values[s:e] = value
+        return
+    expanded = lengths <= _MAX_EXPANDED_INTERVAL_LEN
+    for batchStart in xrange(0, np.count_nonzero(expanded),
+                             _EXPANSION_BATCH_SIZE):
+        batch = slice(batchStart, batchStart + _EXPANSION_BATCH_SIZE)
+        batchStarts = starts[expanded][batch]
+        batchLengths = lengths[expanded][batch]
+        # the offset of each position within its interval
+        offsets = (np.arange(batchLengths.sum()) -
+                   np.repeat(np.cumsum(batchLengths) - batchLengths,
+                             batchLengths))
+        values[np.repeat(batchStarts, batchLengths) + offsets] = \
+            np.repeat(records['value'][expanded][batch], batchLengths)
+    for s, e, value in izip(starts[~expanded], ends[~expanded],
+                            records['value'][~expanded]):
+        values[s:e] = value
+
+
+def loadParsedTrack(genome, trackName, parsedFiles):
+    """Loads the given parsed track (see parseBedGraph) into the given
+    track, which has already been added to the given Genomedata archive,
+    which must be open for writing. Chromosomes that are not in the
+    archive are ignored. The archive's metadata must then be written
+    (i.e. via Genomedata's close_data).
+    Returns the names of the chromosomes that were ignored.
+    """
+    ignoredChrms = []
+    for chrm, parsedFile in sorted(parsedFiles.iteritems()):
+        if chrm not in genome:
+            ignoredChrms.append(chrm)
+            continue
+        chromosome = genome[chrm]
+        trackIdx = chromosome.index_continuous(trackName)
+        records, overlapping = loadParsedRecords(parsedFile)
+        for supercontig, continuous in chromosome.itercontinuous():
+            values = np.empty(supercontig.end - supercontig.start,
+                              dtype=np.float32)
+            values.fill(np.nan)
+            fillTrackValues(values, supercontig.start, records, overlapping)
+            continuous[:, trackIdx] = values
+        chromosome.attrs.dirty = True  # such that its metadata is rewritten
+    return ignoredChrms
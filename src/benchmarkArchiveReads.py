@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Benchmarks the throughput of reading the continuous data of
+a Genomedata archive in segments, as is done by Cytomod, comparing
+segment boundaries that are aligned to the archive's HDF5 chunks
+to boundaries that straddle those chunks.
+Each chromosome is read in its entirety, for each of the two layouts,
+and the best time of the given number of repetitions is reported.
+"""
+
+from __future__ import with_statement, division, print_function
+
+import argparse
+import re
+import time
+import warnings
+
+import cytoUtils as cUtils
+
+__version__ = cUtils.__version__
+
+_DEFAULT_SEGMENT_LEN = 100000
+_DEFAULT_REPETITIONS = 3
+_BYTES_PER_MB = 1024 ** 2
+
+
+def getChunkLength(chromosome):
+    """Returns the number of bases in each HDF5 chunk of the continuous
+    data of the given chromosome, or None if it has no such data.
+    """
+    for supercontig in chromosome.supercontigs[chromosome.start:
+                                               chromosome.end]:
+        try:
+            return supercontig.continuous.chunkshape[0]
+        except NoSuchNodeError:
+            continue
+    return None
+
+
+def iterStraddlingSegments(start, end, segmentLen, chunkLen):
+    """Yields segments of the same length as the aligned segments,
+    but with boundaries offset by half a chunk, such that every
+    internal boundary straddles a chunk.
+    """
+    offset = min(chunkLen // 2, end - start)
+    if offset > 0:
+        yield start, start + offset
+    for segment in cUtils.iterChunkAlignedSegments(start + offset, end,
+                                                   segmentLen):
+        yield segment
+
+
+def timeReads(chromosome, segments):
+    """Reads the continuous data of the given chromosome over each
+    of the given segments and returns the time taken and bytes read.
+    """
+    bytesRead = 0
+    startTime = time.time()
+    for start, end in segments:
+        bytesRead += chromosome[start:end].nbytes
+    return time.time() - startTime, bytesRead
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('genomeDataArchive',
+                    help="The Genomedata archive to read.")
+parser.add_argument('-c', '--chromosomeRegex', default='.*',
+                    help="Only benchmark chromosomes with names \
+                    matching this regex. All are used by default.")
+parser.add_argument('-s', '--segmentLength', type=int,
+                    default=_DEFAULT_SEGMENT_LEN,
+                    help="The length of each segment read. \
+                    The default is {}.".format(_DEFAULT_SEGMENT_LEN))
+parser.add_argument('-n', '--repetitions', type=int,
+                    default=_DEFAULT_REPETITIONS,
+                    help="The number of times to read each layout. \
+                    The default is {}.".format(_DEFAULT_REPETITIONS))
+parser.add_argument('-V', '--version', action='version',
+                    version="%(prog)s " + __version__)
+args = parser.parse_args()
+
+from genomedata import Genome
+from tables import NoSuchNodeError
+
+with Genome(args.genomeDataArchive) as genome:
+    warnings.simplefilter("ignore")  # Ignore supercontig warnings
+    print("chromosome\tlayout\tseconds\tMB/s")
+    for chromosome in genome:
+        if not re.search(args.chromosomeRegex, chromosome.name):
+            continue
+        chunkLen = getChunkLength(chromosome)
+        if not chunkLen:
+            cUtils.warn("Chromosome " + chromosome.name + """ has no
+                        continuous data and has been skipped.""")
+            continue
+        start, end = int(chromosome.start), int(chromosome.end)
+        chunkOrigins = [supercontig.start for supercontig
+                        in chromosome.supercontigs[start:end]]
+        layouts = [('aligned', lambda:
+                    cUtils.iterChunkAlignedSegments(start, end,
+                                                    args.segmentLength,
+                                                    chunkLen, chunkOrigins)),
+                   ('straddling', lambda:
+                    iterStraddlingSegments(start, end, args.segmentLength,
+                                           chunkLen))]
+        for layout, getSegments in layouts:
+            bestTime, bytesRead = min(timeReads(chromosome, getSegments())
+                                      for _ in xrange(args.repetitions))
+            print("{}\t{}\t{:.3f}\t{:.1f}".format(chromosome.name, layout,
+                                                  bestTime,
+                                                  bytesRead / _BYTES_PER_MB /
+                                                  bestTime))
@@ -18,6 +18,14 @@
    Objects:
 
    AutoEnum                           - Auto-numbered Enums with docstrings.
+   QueuedWriter                       - Write to files from a separate thread.
+   IndexedFASTAWriter                 - Write an indexed, optionally BGZF,
+                                        FASTA file.
+   NonClosingFile                     - File proxy that is not closed.
+   RunMetrics                         - Per-stage timers and counts of a run.
+   TimedFile                          - File proxy whose writes are timed.
+   PackedGenomeWriter                 - Write a packed (5-bit) modified genome.
+   PackedGenome                       - Memory-mapped packed modified genome.
 
    Constants:
 
@@ -37,6 +45,7 @@
    FULL_MOD_BASE_NAMES                - Full names of modified bases.
    MODIFIED_DINUCL_ORDER              - Order of mod. bases used in H-testing.
    MASK_BASE                          - The base used to mask other bases.
+   PACKED_GENOME_ALPHABET             - Bases, in order of their packed codes.
    BASE_COLOURS                       - Map of unequivocal base colours, per
                                         the MEME custom alphabet specification.
    MOUSE_ESC_BACKGROUND               - mESC background (Booth/Ito MS/MS data).
@@ -46,6 +55,11 @@
 
    Utility:
    getAlteredSlice           - Return a modified version of an existing Slice.
+   iterChunkAlignedSegments  - Yield segments with chunk-aligned boundaries.
+   iterInThread              - Yield items produced by a separate thread.
+   timedStage                - Time a stage of a run, if recording metrics.
+   getFileStats              - Sizes and mod. times of a file or directory.
+   getFileDigest             - SHA-1 digest of a file's contents.
    duplicates                - Return duplicates contained within a list.
    indices                   - Return indices of a list of items as a dict.
    makeList                  - Create list from scalar else identity.
@@ -81,30 +95,63 @@ from __future__ import with_statement, division, print_function
 
 __version__ = "0.09"
 
+import bisect
 import collections
+import contextlib
 import datetime
 import enum
 import functools
+import hashlib
+import json
+import os
+import Queue
 import operator
 import re
+import struct
 import sys
 import textwrap
+import threading
+import time
+import zlib
 
 from collections import Counter, defaultdict, OrderedDict
 from functools import reduce
-from gzip import open as gzip_open
+from gzip import GzipFile, open as gzip_open
 from itertools import chain, izip
 from itertools import product as CartesianProd
+from multiprocessing.pool import ThreadPool
 from os import extsep
 from string import maketrans
 
 from bidict import bidict
 import chroma
+import numpy as np
 
 _EXIT_FAILURE = 1  # exit code used upon failure
 
+# the maximum uncompressed size of a BGZF block (as used by htslib)
+_BGZF_BLOCK_SIZE = 0xff00
+# the empty BGZF block which marks the end of a BGZF file
+_BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC'
+             '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+# the number of blocks pending compression, per thread, when writing BGZF
+_BGZF_PENDING_BLOCKS_PER_THREAD = 4
+
 EXT_GZ = "gz"
 SUFFIX_GZ = extsep + EXT_GZ
+EXT_PACKED = "pmg"
+SUFFIX_PACKED = extsep + EXT_PACKED
+
+# identifies (the version of) a packed modified genome file
+_PACKED_GENOME_MAGIC = 'CYTOPMG1'
+# the number of bits of each base's code and, since every eight codes
+# are packed together, the number of bytes of each group of codes
+_PACKED_BITS_PER_CODE = 5
+_PACKED_CODES_PER_GROUP = 8
+# the number of bases buffered before being packed and written
+_PACKED_WRITE_BUFFER_LEN = _PACKED_CODES_PER_GROUP * 2 ** 16
+# the number of bytes read at once when computing a file's digest
+_DIGEST_READ_SIZE = 2 ** 20
 
 _MAX_BASE_NUM = 9
 _PARAM_A_CONST_VAL = 999
@@ -374,6 +421,21 @@ FULL_MOD_BASE_NAMES = _consAmbigBaseNames(FULL_MOD_BASE_NAMES,
 
 MASK_BASE = AMBIG_MOD_BASES.keys()[0]
 
+# The 32 symbols of a modified genome, in the order of their 5-bit codes:
+# the unmodified IUPAC bases, followed by each modified base and
+# each ambiguity code, each immediately followed by its complement.
+PACKED_GENOME_ALPHABET = ''.join(
+    ['ACGTN'] + sorted(set(IUPAC_BASES) - set('ACGTN')) +
+    [base + COMPLEMENTS[base] for base in
+     MOD_BASES.values() + AMBIG_MOD_BASES.keys()])
+assert len(PACKED_GENOME_ALPHABET) == 2 ** _PACKED_BITS_PER_CODE
+# the code of each byte (or an invalid code, if it is not within the alphabet)
+_PACKED_CODES = np.full(256, 255, np.uint8)
+_PACKED_CODES[np.frombuffer(PACKED_GENOME_ALPHABET, np.uint8)] = \
+    np.arange(len(PACKED_GENOME_ALPHABET))
+# the value of each bit of a code, from the most significant
+_PACKED_CODE_BIT_VALUES = 2 ** np.arange(_PACKED_BITS_PER_CODE - 1, -1, -1)
+
 # --------------------------------------------------------------------------
 # define background based upon existing MS/MS data
 
@@ -652,6 +714,632 @@ def getAlteredSlice(slice_to_alter, slice_max, operation, value):
                          getattr(slice_to_alter, 'step'))
 
 
+def iterChunkAlignedSegments(start, end, segment_len, chunk_len=None,
+                             chunk_origins=(0,)):
+    """Yield (start, end) pairs of consecutive segments, of at most
+       segment_len, which cover the region from start to end.
+       If a chunk length is provided, each internal segment boundary
+       is moved back to the nearest chunk boundary, such that segments
+       consist of whole chunks. Chunks are laid out from the greatest
+       of the provided (sorted) chunk origins that precedes the boundary
+       (e.g. the start of each HDF5 dataset, such as a supercontig).
+       Boundaries are left as-is if they cannot be moved back without
+       producing an empty segment.
+    """
+    seg_start = start
+    while seg_start < end:
+        seg_end = min(seg_start + segment_len, end)
+        if chunk_len and seg_end < end:
+            origin_idx = bisect.bisect_right(chunk_origins, seg_end) - 1
+            origin = chunk_origins[origin_idx] if origin_idx >= 0 else 0
+            aligned_end = origin + ((seg_end - origin) // chunk_len) * \
+                chunk_len
+            if aligned_end > seg_start:
+                seg_end = aligned_end
+        yield seg_start, seg_end
+        seg_start = seg_end
+
+
+def iterInThread(iterable, item_queue):
+    """Yield the items of the given iterable, which are produced by a
+       separate (daemon) thread and passed via the given (bounded) queue,
+       such that producing items overlaps with consuming them.
+       The queue's size is thus the number of items produced in advance.
+       Any exception raised by the iterable is re-raised when reached.
+    """
+    end = object()  # marks the end of the items
+
+    def produce():
+        try:
+            for item in iterable:
+                item_queue.put((item, None))
+            item_queue.put((end, None))
+        except Exception:
+            item_queue.put((end, sys.exc_info()))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    while True:
+        item, exc_info = item_queue.get()
+        if item is end:
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            break
+        yield item
+
+
+class QueuedWriter(object):
+    """Writes data to files from a separate (daemon) thread, via a
+       queue of at most maxsize writes, such that writing (including any
+       compression) overlaps with the production of the data.
+       File-like objects, whose writes are queued, are obtained via wrap.
+       Any exception raised by a write is re-raised upon a subsequent
+       write or flush.
+    """
+
+    def __init__(self, maxsize):
+        self.queue = Queue.Queue(maxsize)
+        self._exc_info = None
+        writer = threading.Thread(target=self._write)
+        writer.daemon = True
+        writer.start()
+
+    def _write(self):
+        while True:
+            file, data = self.queue.get()
+            try:
+                if not self._exc_info:
+                    file.write(data)
+            except Exception:
+                self._exc_info = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self._exc_info:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def write(self, file, data):
+        """Queue the writing of the given data to the given file."""
+        self._raise()
+        self.queue.put((file, data))
+
+    def flush(self):
+        """Wait until all queued data has been written."""
+        self.queue.join()
+        self._raise()
+
+    def wrap(self, file):
+        """Return a file-like object, whose writes to the given file are
+           queued. Closing it flushes all queued data before closing
+           the file.
+        """
+        return _QueuedFile(self, file)
+
+
+class _QueuedFile(object):
+    def __init__(self, writer, file):
+        self._writer = writer
+        self._file = file
+
+    def write(self, data):
+        self._writer.write(self._file, data)
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.flush()
+        self._file.close()
+
+
+def compressBGZFBlock(data, compresslevel=6):
+    """Return the given data (of at most _BGZF_BLOCK_SIZE bytes),
+       compressed as a single BGZF block (i.e. a Gzip member with
+       an extra field specifying its compressed size).
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    # the header (18 bytes) with the block size (less 1), and the footer
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                         ord('B'), ord('C'), 2, len(compressed) + 25)
+    footer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + compressed + footer
+
+
+class IndexedFASTAWriter(object):
+    """Writes a FASTA file (replacing any existing file), along with its
+       samtools-compatible index (.fai), which is written upon closure.
+       If the file name ends in '.gz', the file is compressed as BGZF,
+       by the given number of threads, and its BGZF index (.gzi) is also
+       written, such that any region can be fetched without decompressing
+       the file from its start (e.g. by samtools faidx).
+       Each record's sequence lines must be of the same length, except for
+       its last line, and the sequence must not contain a '>'.
+    """
+
+    def __init__(self, filename, threads=1, compresslevel=6):
+        self.filename = filename
+        self._file = open(filename, 'wb')
+        self._compresslevel = compresslevel
+        self._BGZF = filename.endswith(SUFFIX_GZ)
+        self._buffer = []
+        self._buffer_len = 0
+        self._offset = 0  # the uncompressed offset of the data written
+        self._block_offsets = []  # (compressed, uncompressed) block ends
+        self._pending = collections.deque()
+        self._pool = None
+        self._threads = threads
+        # the index of each record, as a list of
+        # [name, length, offset, line bases, line width]
+        self._records = []
+        self._header = None  # the partial header line, if within one
+        self._line_len = 0  # the length of the first line, so far
+
+    def write(self, data):
+        """Write the given data, indexing its FASTA records."""
+        self._index(data)
+        self._offset += len(data)
+        if not self._BGZF:
+            self._file.write(data)
+            return
+        self._buffer.append(data)
+        self._buffer_len += len(data)
+        if self._buffer_len >= _BGZF_BLOCK_SIZE:
+            buffered = ''.join(self._buffer)
+            num_full = len(buffered) // _BGZF_BLOCK_SIZE * _BGZF_BLOCK_SIZE
+            for block_start in xrange(0, num_full, _BGZF_BLOCK_SIZE):
+                self._compress(buffered[block_start:block_start +
+                                        _BGZF_BLOCK_SIZE])
+            self._buffer = [buffered[num_full:]]
+            self._buffer_len = len(buffered) - num_full
+
+    def _index(self, data):
+        pos = 0
+        while pos < len(data):
+            if self._header is not None:  # within a header line
+                line_end = data.find('\n', pos)
+                if line_end < 0:
+                    self._header += data[pos:]
+                    return
+                self._header += data[pos:line_end]
+                self._records.append([self._header[1:].split()[0], 0,
+                                      self._offset + line_end + 1, None,
+                                      None])
+                self._header = None
+                self._line_len = 0
+                pos = line_end + 1
+                continue
+            header_start = data.find('>', pos)
+            seq = data[pos:header_start if header_start >= 0 else None]
+            if self._records:
+                record = self._records[-1]
+                record[1] += len(seq) - seq.count('\n')
+                if record[3] is None:  # the first line is not yet complete
+                    line_end = seq.find('\n')
+                    if line_end < 0:
+                        self._line_len += len(seq)
+                    else:
+                        record[3] = self._line_len + line_end
+                        record[4] = record[3] + 1
+            if header_start < 0:
+                return
+            self._header = ''
+            pos = header_start
+
+    def _compress(self, block):
+        if self._threads > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(self._threads)
+            if (len(self._pending) >=
+                    self._threads * _BGZF_PENDING_BLOCKS_PER_THREAD):
+                self._write_block(*self._pending.popleft())
+            self._pending.append((self._pool.apply_async(
+                compressBGZFBlock, (block, self._compresslevel)),
+                len(block)))
+        else:
+            self._write_block(compressBGZFBlock(block, self._compresslevel),
+                              len(block))
+
+    def _write_block(self, compressed, block_len):
+        if not isinstance(compressed, str):  # pending compression
+            compressed = compressed.get()
+        self._file.write(compressed)
+        prev_compressed, prev_uncompressed = (self._block_offsets[-1] if
+                                              self._block_offsets else (0, 0))
+        self._block_offsets.append((prev_compressed + len(compressed),
+                                    prev_uncompressed + block_len))
+
+    def close(self):
+        """Write any remaining data and the indices, and close the file."""
+        if self._BGZF:
+            if self._buffer_len:
+                self._compress(''.join(self._buffer))
+            while self._pending:
+                self._write_block(*self._pending.popleft())
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+            self._file.write(_BGZF_EOF)
+            # the (little-endian) number of entries and the (compressed,
+            # uncompressed) offsets of the start of each block,
+            # excluding the first block, which is at the start
+            block_starts = self._block_offsets[:-1]
+            with open(self.filename + extsep + 'gzi', 'wb') as gzi_file:
+                gzi_file.write(struct.pack('<Q', len(block_starts)))
+                for offsets in block_starts:
+                    gzi_file.write(struct.pack('<2Q', *offsets))
+        self._file.close()
+        with open(self.filename + extsep + 'fai', 'w') as fai_file:
+            for name, length, offset, line_bases, line_width in self._records:
+                if line_bases is None:  # a single, unterminated, line
+                    line_bases, line_width = length, length + 1
+                fai_file.write('\t'.join(str(field) for field in
+                                         [name, length, offset, line_bases,
+                                          line_width]) + '\n')
+
+
+class NonClosingFile(object):
+    """A proxy of the given file, which is not closed upon the closure of
+       the proxy (including via a with statement), such that a file that
+       remains open may be passed to code that would otherwise close it.
+    """
+
+    def __init__(self, file):
+        self._file = file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def write(self, data):
+        self._file.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RunMetrics(object):
+    """Records the metrics of a run: the (wall-clock) time spent in each
+       of its stages (see timed), initially the given stages, and, for each
+       chromosome, the number of bases and segments output and of cache
+       hits and misses. Stages may be nested, with the time of each stage
+       excluding that of the stages nested within it, and may be timed by
+       any number of threads, whose times are summed. The metrics of
+       other processes are added via popCounts and addCounts.
+    """
+
+    def __init__(self, stages=()):
+        self.startTime = time.time()
+        self.stageSeconds = OrderedDict((stage, 0.0) for stage in stages)
+        self.chromosomes = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()  # the stages being timed, per thread
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """Time the enclosed code as the given stage."""
+        if not hasattr(self._local, 'nested_seconds'):
+            self._local.nested_seconds = []
+        nested_seconds = self._local.nested_seconds
+        nested_seconds.append(0.0)  # the time of stages nested within it
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start_time
+            own_seconds = seconds - nested_seconds.pop()
+            if nested_seconds:
+                nested_seconds[-1] += seconds
+            with self._lock:
+                self.stageSeconds[stage] = (self.stageSeconds.get(stage, 0) +
+                                            own_seconds)
+
+    def _count(self, chrm, **counts):
+        with self._lock:
+            chrm_counts = self.chromosomes.setdefault(
+                chrm, OrderedDict([('bases', 0), ('segments', 0),
+                                   ('cacheHits', 0), ('cacheMisses', 0)]))
+            for name, count in counts.iteritems():
+                chrm_counts[name] += count
+
+    def countSegment(self, chrm, num_bases):
+        """Count a segment of the given number of bases as output."""
+        self._count(chrm, bases=num_bases, segments=1)
+
+    def countCacheLookups(self, chrm, hits, misses):
+        """Count the given number of cache hits and misses."""
+        self._count(chrm, cacheHits=hits, cacheMisses=misses)
+
+    def popCounts(self):
+        """Return the stage times and chromosome counts recorded so far,
+           as plain dicts, which are then reset.
+        """
+        with self._lock:
+            counts = (dict(self.stageSeconds),
+                      {chrm: dict(chrm_counts) for chrm, chrm_counts
+                       in self.chromosomes.iteritems()})
+            self.stageSeconds = OrderedDict((stage, 0.0) for stage
+                                            in self.stageSeconds)
+            self.chromosomes = OrderedDict()
+        return counts
+
+    def addCounts(self, counts):
+        """Add the given stage times and chromosome counts, as returned
+           by the popCounts of another process.
+        """
+        stage_seconds, chromosomes = counts
+        with self._lock:
+            for stage, seconds in stage_seconds.iteritems():
+                self.stageSeconds[stage] = (self.stageSeconds.get(stage, 0) +
+                                            seconds)
+        for chrm, chrm_counts in chromosomes.iteritems():
+            self._count(chrm, **chrm_counts)
+
+    def write(self, filename, **info):
+        """Write the metrics, along with the given information about the
+           run, to the given file, as JSON, including the totals of the
+           chromosome counts and the throughput, in bases per second of
+           the time elapsed since the metrics were created.
+        """
+        elapsed_seconds = time.time() - self.startTime
+        metrics = dict(info, elapsedSeconds=elapsed_seconds,
+                       stageSeconds=self.stageSeconds,
+                       chromosomes=self.chromosomes)
+        for name in ['bases', 'segments', 'cacheHits', 'cacheMisses']:
+            metrics[name] = sum(chrm_counts[name] for chrm_counts
+                                in self.chromosomes.itervalues())
+        metrics['basesPerSecond'] = (metrics['bases'] / elapsed_seconds
+                                     if elapsed_seconds else None)
+        with open(filename, 'w') as metrics_file:
+            json.dump(metrics, metrics_file, indent=1, sort_keys=True)
+            metrics_file.write('\n')
+
+
+@contextlib.contextmanager
+def _untimed():
+    yield
+
+
+def timedStage(metrics, stage):
+    """Return a context manager timing the enclosed code as the given
+       stage of the given RunMetrics, or doing nothing if it is None.
+    """
+    return metrics.timed(stage) if metrics is not None else _untimed()
+
+
+class TimedFile(object):
+    """A proxy of the given writable file, whose writes (and flushes)
+       are timed by the given RunMetrics, as the 'write' stage or, if the
+       file is compressed, the 'compression' stage. Where the compressed
+       data is written to an underlying file that can be reached (i.e. for
+       a GzipFile, IndexedFASTAWriter, or PackedGenomeWriter, whose
+       packing is its compression), its writes are timed separately,
+       as the 'write' stage.
+    """
+
+    def __init__(self, file, metrics, compressed=False):
+        self._file = file
+        self._metrics = metrics
+        self._stage = 'compression' if compressed else 'write'
+        if compressed:
+            for file_type, attr in [(GzipFile, 'fileobj'),
+                                    (IndexedFASTAWriter, '_file'),
+                                    (PackedGenomeWriter, '_file')]:
+                if isinstance(file, file_type):
+                    setattr(file, attr,
+                            TimedFile(getattr(file, attr), metrics))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def write(self, data):
+        with self._metrics.timed(self._stage):
+            self._file.write(data)
+
+    def flush(self):
+        with self._metrics.timed(self._stage):
+            self._file.flush()
+
+    def close(self):
+        with self._metrics.timed(self._stage):
+            self._file.close()
+
+
+def _packBases(bases):
+    """Returns the given bases, packed as their 5-bit codes, with the last
+       group of codes padded (with the first code) to a whole group.
+    """
+    codes = _PACKED_CODES[np.frombuffer(bases, np.uint8)]
+    invalid = codes >= len(PACKED_GENOME_ALPHABET)
+    if invalid.any():
+        raise ValueError("Base {!r} cannot be packed.".format(
+                         bases[np.argmax(invalid)]))
+    padded = np.zeros(-(-len(codes) // _PACKED_CODES_PER_GROUP) *
+                      _PACKED_CODES_PER_GROUP, np.uint8)
+    padded[:len(codes)] = codes
+    # keep only the low bits of each code, which are then packed contiguously
+    return np.packbits(np.unpackbits(padded[:, np.newaxis], axis=1)
+                       [:, -_PACKED_BITS_PER_CODE:]).tostring()
+
+
+class PackedGenomeWriter(object):
+    """Writes a modified genome (replacing any existing file) in a compact
+       binary format, given the same text as would be written to a FASTA
+       file. Each base is stored as a 5-bit code (its index within
+       PACKED_GENOME_ALPHABET), with each group of eight codes being packed
+       into five bytes. The file consists of a header (an identifier and
+       the alphabet), followed by the packed array of each record, which is
+       padded to a whole group. Its index (.idx), which is written upon
+       closure, lists the name, length, and offset of each record's array.
+       The genome can then be read by PackedGenome.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'wb')
+        self._file.write(_PACKED_GENOME_MAGIC + PACKED_GENOME_ALPHABET)
+        self._records = []  # the [name, length, offset] of each record
+        self._header = None  # the partial header line, if within one
+        self._buffer = []  # the bases of the current record to be packed
+        self._buffer_len = 0
+
+    def write(self, data):
+        """Write the given FASTA text, packing the bases of each record."""
+        pos = 0
+        while pos < len(data):
+            if self._header is not None:  # within a header line
+                line_end = data.find('\n', pos)
+                if line_end < 0:
+                    self._header += data[pos:]
+                    return
+                self._header += data[pos:line_end]
+                self._start_record()
+                pos = line_end + 1
+                continue
+            header_start = data.find('>', pos)
+            bases = data[pos:header_start if header_start >= 0
+                         else None].replace('\n', '')
+            if bases:
+                if not self._records:
+                    raise ValueError("The sequence is not preceded by "
+                                     "a FASTA header.")
+                self._buffer.append(bases)
+                self._buffer_len += len(bases)
+                if self._buffer_len >= _PACKED_WRITE_BUFFER_LEN:
+                    self._pack()
+            if header_start < 0:
+                return
+            self._header = ''
+            pos = header_start
+
+    def _start_record(self):
+        if self._records:
+            self._pack(True)
+        self._records.append([self._header[1:].split()[0], 0,
+                              self._file.tell()])
+        self._header = None
+
+    def _pack(self, record_end=False):
+        """Packs and writes the buffered bases, in whole groups,
+           unless the end of the record has been reached.
+        """
+        buffered = ''.join(self._buffer)
+        num_packed = (len(buffered) if record_end else
+                      len(buffered) // _PACKED_CODES_PER_GROUP *
+                      _PACKED_CODES_PER_GROUP)
+        self._file.write(_packBases(buffered[:num_packed]))
+        self._records[-1][1] += num_packed
+        self._buffer = [buffered[num_packed:]]
+        self._buffer_len = len(buffered) - num_packed
+
+    def close(self):
+        """Write any remaining bases and the index, and close the file."""
+        if self._header is not None:  # an unterminated, final, header
+            self._start_record()
+        if self._records:
+            self._pack(True)
+        self._file.close()
+        with open(self.filename + extsep + 'idx', 'w') as idx_file:
+            for record in self._records:
+                idx_file.write('\t'.join(str(field) for field in record) +
+                               '\n')
+
+
+class PackedGenome(object):
+    """A packed modified genome, as written by PackedGenomeWriter, which is
+       memory-mapped, such that fetching any region only reads and unpacks
+       the groups of codes that it spans.
+       The length of each record is given by its name, within lengths.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = np.memmap(filename, np.uint8, 'r')
+        header_len = len(_PACKED_GENOME_MAGIC) + len(PACKED_GENOME_ALPHABET)
+        if (self._data[:len(_PACKED_GENOME_MAGIC)].tostring() !=
+                _PACKED_GENOME_MAGIC):
+            raise ValueError(filename + " is not a packed modified genome.")
+        self._alphabet = np.frombuffer(
+            self._data[len(_PACKED_GENOME_MAGIC):header_len].tostring(), 'S1')
+        self.lengths = OrderedDict()
+        self._offsets = {}
+        with open(filename + extsep + 'idx') as idx_file:
+            for line in idx_file:
+                name, length, offset = line.rstrip('\n').split('\t')
+                self.lengths[name] = int(length)
+                self._offsets[name] = int(offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fetchArray(self, name, start=0, end=None):
+        """Returns the bases of the given region (zero-based and half-open)
+           of the named record, as an array of characters.
+        """
+        length = self.lengths[name]
+        end = length if end is None else end
+        if not 0 <= start <= end <= length:
+            raise ValueError("The region {}:{}-{} is not within the "
+                             "record.".format(name, start, end))
+        first_group = start // _PACKED_CODES_PER_GROUP
+        end_group = -(-end // _PACKED_CODES_PER_GROUP)
+        offset = self._offsets[name]
+        codes = np.unpackbits(self._data[
+            offset + first_group * _PACKED_BITS_PER_CODE:
+            offset + end_group * _PACKED_BITS_PER_CODE]).reshape(
+            -1, _PACKED_BITS_PER_CODE).dot(_PACKED_CODE_BIT_VALUES)
+        group_start = first_group * _PACKED_CODES_PER_GROUP
+        return self._alphabet[codes[start - group_start:end - group_start]]
+
+    def fetch(self, name, start=0, end=None):
+        """Returns the bases of the given region (zero-based and half-open)
+           of the named record, as a string.
+        """
+        return self.fetchArray(name, start, end).tostring()
+
+    def close(self):
+        """Unmap the file."""
+        self._data = None
+
+
+def getFileStats(path):
+    """Return a list of the [name, size, modification time] of the
+       given file or, for a directory, of each of its files, by name.
+    """
+    filenames = ([path] if os.path.isfile(path) else
+                 [os.path.join(path, name)
+                  for name in sorted(os.listdir(path))])
+    return [[os.path.basename(filename), os.path.getsize(filename),
+             os.path.getmtime(filename)] for filename in filenames]
+
+
+def getFileDigest(filename):
+    """Return the (hexadecimal) SHA-1 digest of the given file's contents."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for data in iter(lambda: file.read(_DIGEST_READ_SIZE), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
 def maybe_gzip_open(filename, *args, **kwargs):
     """Open a gzipped file with the gzip open file handler and open
        a non-gzipped file with the default open file handler.
@@ -16,18 +16,32 @@ to the cytosine nucleobase: {5mC, 5hmC, 5fC, 5caC}.
 import argparse
 import glob
 import gzip
-import math
+import importlib
+import json
+import multiprocessing
 import os
+import Queue
 import random
 import re
+import shutil
+import signal
+import SocketServer
+import stat
+import sys
+import tempfile
+import threading
 import warnings
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
+from cStringIO import StringIO
+from itertools import islice, izip
 
 import numpy as np
 
+import archiveTracks as aTracks
 import cytoUtils as cUtils
-from cytoUtils import duplicates, indices
+import directGenome as dGenome
+import modifiedGenome as mGenome
 
 __version__ = cUtils.__version__
 
@@ -47,19 +61,65 @@ MOD_BASE_REGEX = '5(m|hm|f|ca)C'
 REGION_REGEX = '(chr(?:\d+|[XYM]))(?::(?P<start>\d+)?-(?P<end>\d+)?)?'
 
 _DEFAULT_ARCHIVE_NAME = 'archive'
+# the manifest of the inputs of a created archive, which is stored
+# next to the archive, and the version of its format
+_ARCHIVE_MANIFEST_SUFFIX = '.manifest.json'
+_ARCHIVE_MANIFEST_VERSION = 1
+# (module, name) pairs of the internals of Genomedata, upon which loading
+# tracks parsed in parallel and updating existing archives rely.
+# NB: These are those of Genomedata 1.3.6, and must be re-checked upon any
+#     upgrade of it. Without them, archives are only ever created from
+#     scratch, by Genomedata's public load_genomedata (see createArchive).
+_GENOMEDATA_INTERNALS = [('genomedata', 'EXT'),
+                         ('genomedata', 'FILE_MODE_CHROMS'),
+                         ('genomedata', 'SUFFIX'),
+                         ('genomedata._close_data', 'close_data'),
+                         ('genomedata._erase_data', 'erase_data'),
+                         ('genomedata._load_data', 'load_data'),
+                         ('genomedata._load_seq', 'load_seq'),
+                         ('genomedata._open_data', 'open_data'),
+                         ('genomedata.load_genomedata', 'repack')]
 _DEFAULT_FASTA_FILENAME = 'modGenome.fa'
-# bases ordered by least frequent in our dataset with most ambiguous bases last
-_DEFAULT_BASE_PRIORITY = 'fhmc' + ''.join(cUtils.AMBIG_MOD_BASES.keys()[::-1])
+_DEFAULT_BASE_PRIORITY = mGenome.DEFAULT_BASE_PRIORITY
 _DEFAULT_CENTRED_REGION_LENGTH = 500
 _DEFAULT_BASE_PRIORITY_COMMENT = """the resolution of the biological protocol
 (i.e. single-base > any chemical > any DIP)"""
 _DEFAULT_RAN_LENGTH = 2000
 _DEFAULT_MASK_VALUE = 0
-_MAX_REGION_LEN = 2000000
+_MEMORY_SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+                         'T': 1024 ** 4}
+# the writer of all output, from a separate thread, when pipelining
+_pipelineWriter = None
+# the output file of the modified genome, when it remains open until all
+# records have been output (i.e. when it is being indexed or packed)
+_openModGenomeFile = None
+# the metrics of the run (or of a worker process), when they are recorded
+_metrics = None
+# the stages of the run that are timed, in the order in which they occur
+_METRIC_STAGES = ('archiveRead', 'callStates', 'priorityResolution',
+                  'maskHandling', 'substitution', 'BEDFormatting',
+                  'compression', 'write')
+_METRICS_VERSION = 1
+# maximum number of regions computed together (i.e. sharing their reads)
+# and given to a worker at once, when processed in parallel
+_REGION_BATCH_SIZE = 1000
+# maximum number of region batches, per worker, that are either being
+# processed or are awaiting output (i.e. bounding the reorder buffer)
+_MAX_PENDING_BATCHES_PER_JOB = 4
+_DEFAULT_PIPELINE_DEPTH = 4
+# default bounds of the in-memory segment cache, when serving regions,
+# and of the on-disk segment cache
+_DEFAULT_SERVE_CACHE_SIZE = '256M'
+_DEFAULT_DISK_CACHE_SIZE = '4G'
+# maximum number of region requests of a client that are computed together
+_MAX_REQUEST_BATCH_SIZE = _REGION_BATCH_SIZE
+# number of lines of a file of regions that are parsed at once
+_REGION_READ_BATCH_SIZE = 100000
+# prefixes of the header (i.e. non-region) lines of a BED file
+_BED_HEADER_PREFIXES = ('#', 'track', 'browser')
 _MAX_CONTIG_ATTEMPTS = 3
 # tracks to be displayed densely for output UCSC browser tracks
 _DENSE_TRACKS = 'ruler ensGene pubs cpgIslandExt oreganno rmsk snp128'
-_MASK_TNAME = 'MASK'
 
 
 def die(msg):
@@ -101,11 +161,15 @@ def _ensureRegionValidity(genome, chrm, start, end):
         die("Invalid region: invalid end position.")
 
 
-def _maybeGetAmbigMapping(base, ambigMap):
-    """Maps the given base to its ambiguous base, if possible."""
-    return (ambigMap.get(base) or
-            (cUtils.complement(ambigMap.get(cUtils.complement(base)))
-            if ambigMap.get(cUtils.complement(base)) else None) or base)
+def parseMemorySize(size):
+    """Parses a memory size, in bytes, with an optional (binary)
+    suffix of 'K', 'M', 'G', or 'T' (e.g. "512M" or "4G").
+    Used as an argparse type.
+    """
+    match = re.match('^(\d+)([KMGT]?)B?$', size.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError("invalid memory size: " + size)
+    return int(match.group(1)) * _MEMORY_SIZE_SUFFIXES[match.group(2)]
 
 
 def getTrackHeader(modBase):
@@ -123,194 +187,219 @@ def getTrackHeader(modBase):
         re.sub('[() ]', '', colour + "\n")
 
 
-def getModifiedGenome(genome, modOrder, chrm, start, end,
-                      suppressFASTA, suppressBED, tnames, ambigMap,
-                      maskRegionsFileVal, maskRegionTName,
-                      maskAllUnsetRegions):
-    """Returns the modified genome sequence, for the given genome,
-    over the given input region.
+def getBEDLines(chrm, base, coords):
+    """Returns the BED lines, for the given chromosome and modified base,
+    of single-base intervals starting at each of the given coordinates.
+    All lines are formatted at once, via a single string format operation,
+    rather than formatting each line in turn.
+    """
+    lineFormat = str(chrm) + "\t%d\t%d\t" + base + "\n"
+    return (lineFormat * coords.size) % \
+        tuple(np.column_stack((coords, coords + 1)).ravel().tolist())
+
+
+def openBEDTracks(tnames, indexBED=False):
+    """Opens each of the given BED tracks (keyed by modified base), replacing
+    any existing tracks, and writes their headers.
+    The tracks are kept open, as a single compressed stream per modified base,
+    such that they are written to throughout the run.
+    Returns the open tracks, keyed by modified base.
+    The tracks are compressed using BGZF if they are to be indexed,
+    and are otherwise Gzipped.
+    """
+    if indexBED:
+        from pysam.libcbgzf import BGZFile
+    BEDTracks = {}
+    for base, trackFileName in tnames.iteritems():
+        if indexBED:
+            BEDTracks[base] = BGZFile(trackFileName, 'wb')
+        else:
+            BEDTracks[base] = gzip.open(trackFileName, 'wb')
+        BEDTracks[base] = timeOutputFile(BEDTracks[base], True)
+        BEDTracks[base].write(getTrackHeader(base))
+    return BEDTracks
+
+
+def closeBEDTracks(BEDTracks, tnames, indexBED=False):
+    """Closes the given open BED tracks and, if requested,
+    creates a tabix index for each of them.
+    Tracks that cannot be indexed (e.g. those of unsorted regions)
+    are left unindexed, with a warning.
+    """
+    for BEDTrack in BEDTracks.itervalues():
+        BEDTrack.close()
+    if indexBED:
+        import pysam
+        for base in BEDTracks:
+            try:
+                pysam.tabix_index(tnames[base], force=True, seq_col=0,
+                                  start_col=1, end_col=2, zerobased=True,
+                                  line_skip=getTrackHeader(base).count("\n"))
+            except (IOError, OSError):
+                warn("""Unable to index the BED track {}.
+                     Its entries may not be sorted.""".format(tnames[base]))
+
+
+def iterModifiedGenome(modGenome, chrm, start, end, suppressFASTA,
+                       suppressBED, BEDTracks=None):
+    """Yields the sequence of the given modified genome
+    over the given input region, one segment at a time.
+    Each segment is yielded as soon as it is computed, such that memory
+    use is bounded by the segment length, rather than the region length.
+    Unless BED output is suppressed, BED lines are written to the given
+    BED tracks (writable file-like objects, keyed by modified base),
+    such as those returned by openBEDTracks.
+    Nothing is yielded if FASTA output is suppressed, but the generator
+    must still be exhausted for the BED tracks to be written.
     """
     hasModifiedBases = False
-    chromosome = genome[chrm]
-    allbasesResult = ""
 
-    # Only compute the modified genome in segments.
-    # This prevents the creation of excessively large NumPy arrays.
-    for s in range(start, end, _MAX_REGION_LEN):
-        e = s + _MAX_REGION_LEN if (end - start) >= _MAX_REGION_LEN else end
+    def iterSegmentReads():
+        """Yields the (start, end) coordinates of each segment,
+        along with its data, as read by readSegment, or, if segments
+        are cached, its result, as returned by getSegment."""
+        # Only compute the modified genome in segments.
+        # This prevents the creation of excessively large NumPy arrays.
+        for s, e in modGenome.iterSegmentBounds(chrm, start, end):
+            if modGenome.cache is None:
+                yield s, e, modGenome.readSegment(chrm, s, e), None
+            else:  # cached segments need not be read
+                yield s, e, None, modGenome.getSegment(chrm, s, e)
+
+    segmentReads = iterSegmentReads()
+    if _pipelineWriter:
+        # Segments are read in advance, by a separate thread, which is
+        # then the only one to access the archive.
+        readQueue = Queue.Queue(args.pipeline)
+        segmentReads = cUtils.iterInThread(segmentReads, readQueue)
+    for s, e, segmentRead, segment in segmentReads:
 
         v_print_timestamp(args.verbose, "Now outputting " + chrm +
                           " for region: (" + str(s) + ", " + str(e) + ")", 2)
-
-        modBaseScores = chromosome[s:e]
-        if _MASK_TNAME in tnames:
-            maskTrack = chromosome[s:e, maskRegionTName]
-            maskIndex = genome.tracknames_continuous.index(maskRegionTName)
-
-            modBaseScores[:, maskIndex] = \
-                np.where(np.logical_or(np.isnan(maskTrack),
-                         maskTrack > maskRegionsFileVal),
-                         np.zeros(maskTrack.shape[0]),
-                         np.ones(maskTrack.shape[0]))
-        else:  # may still need to remove mask track
-            # TODO this could be made more efficient
-            for item in genome.tracknames_continuous:
-                if item.find(_MASK_TNAME) >= 0:
-                    maskIndex = genome.tracknames_continuous.index(item)
-                    modBaseScores = np.delete(modBaseScores, maskIndex, axis=1)
-
-        if len(modOrder) != len(set(modOrder)):  # intersect, if duplicates
-            v_print_timestamp(args.verbose, "Intersection is enabled.")
-
-            # Convert 0s to nan s.t. below mean works correctly, as an
-            # intersection. Has no other impact, so fine to leave this way.
-            modBaseScores[modBaseScores == 0] = np.nan
-
-            for base_order, idxs in indices(modOrder,
-                                            duplicates(modOrder)).iteritems():
-                v_print_timestamp(args.verbose, "Intersecting for base '{}'."
-                                  .format([base for base in args.priority
-                                           if base in modBases][base_order]),
-                                  3)
-                #
-                # NB: mean is not really needed, could be more efficient w/0|1;
-                #     use of mean is, however, more general, permitting the
-                #     use of other non-binary values, although we do not
-                #     currently make particular use of this.
-                #
-                # key is to make any NaNs remain NaN, and leave others finite
-                modBaseScores[:, idxs] = np.mean(modBaseScores[:, idxs],
-                                                 axis=1, keepdims=True)
-
-        # use '0' for unmodified bases (results in the unmod. base after)
-        defaultBases = '0'
-
-        # if masking all unset regions, use mask base for those, and '0' o/w
-        if maskAllUnsetRegions:
-            defaultBases = np.where(np.all(np.isnan(modBaseScores), axis=1),
-                                    cUtils.MASK_BASE, '0')
-            defaultBases = np.tile(defaultBases, (len(modBases), 1)).T
-
-        modBasesA = np.where(np.logical_and(np.isfinite(modBaseScores),
-                             modBaseScores != 0), modBases,
-                             # either the modified base or the mask base
-                             # any masking applied here is only for masking
-                             # bases without any data
-                             defaultBases)
-
-        modOrderBasedPermutation = np.array(modOrder).argsort()
-        orderedmodBasesA = modBasesA[:, modOrderBasedPermutation]
-
-        referenceSeq = np.array(list(chromosome.seq[s:e].
-                                tostring().upper()), dtype=np.str)
-
-        # Filter the bases to take the modified bases in priority order.
-        x = np.transpose(np.nonzero(orderedmodBasesA != '0'))
-        u, idx = np.unique(x[:, 0], return_index=True)
-
-        def maybeGetModBase(m, r, ambigMap):
-            """Returns the modified base corresponding to
-            the given putatively modified base (m). The base returned
-            is the input putatively modified base if the corresponding
-            reference base (r) is modifiable to the input base, or the
-            complement of that base, if the complemented reference is
-            modifiable to it, otherwise the reference base (r) itself
-            is returned. This function also maps modified bases to any
-            applicable ambiguity codes that are provided in ambigMap.
-            """
-            m = ambigMap.get(m) or m  # maybe map to an ambiguous base
-            if m not in cUtils.MOD_MAP:
-                return ambigMap.get(r) or r
-            else:
-                if cUtils.MOD_MAP[m] == r:
-                    return m
-                elif cUtils.MOD_MAP[m] == cUtils.complement(r)[0]:
-                    return cUtils.complement(m)[0]
-                else:
-                    return ambigMap.get(r) or r
-
-        # Initially the sequence is unmodified and we successively modify it.
-        allModBases = np.copy(referenceSeq)
-        # We vectorize the function for convenience.
-        # NumPy vectorized functions still execute the Python code at
-        maybeGetModBase = np.vectorize(maybeGetModBase)
-        # Mask the sequence, allowing only base modifications
-        # that modify their 'target' base (i.e. '5fC' = 'f' only modifies 'C').
-        # Return the reference base for all non-modifiable bases
-        # and for unmodified bases.
-
-        if x.size > 0:
+        if _pipelineWriter:
+            v_print_timestamp(args.verbose, """Pipeline queue depths:
+                              {} segments read in advance and {} writes
+                              pending.""".
+                              format(readQueue.qsize(),
+                                     _pipelineWriter.queue.qsize()), 2)
+
+        referenceSeq = None
+        if segment is None:
+            modBaseScores, referenceSeq = segmentRead
+            segment = modGenome.computeSegment(modBaseScores, referenceSeq)
+        allModBases, modPositions = segment
+        if _metrics:
+            _metrics.countSegment(chrm, e - s)
+
+        if modPositions.size > 0:
             hasModifiedBases = True
-            # Modify bases
-            np.put(allModBases, x[idx][:, 0],
-                   maybeGetModBase(orderedmodBasesA[x[idx][:, 0],
-                                   x[idx][:, 1]],
-                                   allModBases[x[idx][:, 0]], ambigMap))
-            if ambigMap:  # Replace with ambiguous bases in unmodified sequence
-                unmodBaseIndices = np.delete(np.indices(np.shape(allModBases)),
-                                             x[idx][:, 0])
-                np.put(allModBases, unmodBaseIndices, np.vectorize(lambda base:
-                       _maybeGetAmbigMapping(base, ambigMap))
-                       (np.delete(allModBases, x[idx][:, 0])))
-
             if not suppressBED:
-                # Create a BED track for each modified base with track data
-                # Use unique modified bases only, since we may otherwise obtain
-                # redundant track lines.
-                for base in set(modBases + cUtils.complement(modBases)):
-                    # NB: This could be done in a more efficient manner.
-                    baseModIdxs = np.flatnonzero(allModBases[x[idx][:, 0]]
-                                                 == base)
-                    if baseModIdxs.size > 0:
-                        # Get the position of the modified bases in the
-                        # sequence, adding the genome start coordinate of
-                        # the sequence to operate in actual genome coordinates.
-                        modBaseCoords = x[idx][:, 0][baseModIdxs] + s
-
-                        modBaseStartEnd = np.column_stack((modBaseCoords,
-                                                          modBaseCoords+1))
-                        # Save the track, appending to a Gzipped BED file.
-                        # TODO save as string buffer (using list joins)
-                        # and gzip after (with cStringIO).
-                        # That will allow actual compression to occur.
-                        with gzip.open(tnames[base],
-                                       'ab') as BEDTrack:
-                            np.savetxt(BEDTrack, modBaseStartEnd,
-                                       str(chrm) + "\t%d\t%d\t" + base)
+                # Create a BED track for each modified base with track data,
+                # adding the genome start coordinate of the sequence
+                # to operate in actual genome coordinates.
+                with cUtils.timedStage(_metrics, 'BEDFormatting'):
+                    for base, positions in modGenome.iterBEDCoords(
+                            allModBases, modPositions):
+                        BEDTracks[base].write(getBEDLines(chrm, base,
+                                                          positions + s))
 
         if not suppressFASTA:
-            # Output the unmodified sequence at a verbosity level
-            # of at least 2, if not too long, otherwise only output
+            # Output the unmodified sequence (if it was read) at a verbosity
+            # level of at least 2, if not too long, otherwise only output
             # for a high verbosity level.
-            v_print_timestamp(args.verbose, """Corresponding unmodified
-                              reference sequence: \n""" +
-                              ''.join(referenceSeq), 2
-                              if len(referenceSeq) < 10000 else 6)
-            # Concatenate the vector together to form the (string) sequence
-            allbasesResult += ''.join(allModBases)
+            if referenceSeq is not None:
+                v_print_timestamp(args.verbose, """Corresponding unmodified
+                                  reference sequence: \n""" +
+                                  referenceSeq.tostring(), 2
+                                  if len(referenceSeq) < 10000 else 6)
+            yield allModBases.tostring()
 
     if (not hasModifiedBases and not suppressBED):
-        warn(""""There are no modified bases within the requested
-             region. Accordingly, no BED files have been output
-             for this region.""")
-    return allbasesResult
+        _warnNoModifiedBases()
+
+
+def _warnNoModifiedBases():
+    warn(""""There are no modified bases within the requested
+         region. Accordingly, no BED files have been output
+         for this region.""")
 
 
-def generateFASTAFile(file, id, genome, modOrder, chrm, start,
-                      end, suppressBED, tnames, ambigMap, maskRegionsFileVal,
-                      maskRegionTName, maskAllUnsetRegions):
+def getModifiedGenome(modGenome, chrm, start, end, suppressFASTA,
+                      suppressBED, BEDTracks=None):
+    """Returns the sequence of the given modified genome
+    over the given input region, as a single string.
+    See iterModifiedGenome, which should be used for large regions.
+    """
+    return ''.join(iterModifiedGenome(modGenome, chrm, start, end,
+                                      suppressFASTA, suppressBED, BEDTracks))
+
+
+def wrapSequence(segments, lineWidth, column=0):
+    """Yields the given sequence segments, with newlines inserted
+    such that the concatenated sequence is wrapped to lines of the
+    given width, irrespective of the length of each segment.
+    No newline is inserted after the final line.
+    The sequence is wrapped as though its first line already contains
+    the given number of columns (preceding it with a newline if full).
+    """
+    for segment in segments:
+        lines = []
+        pos = 0
+        while pos < len(segment):
+            if column == lineWidth:
+                lines.append("\n")
+                column = 0
+            lineEnd = min(pos + lineWidth - column, len(segment))
+            lines.append(segment[pos:lineEnd])
+            column += lineEnd - pos
+            pos = lineEnd
+        yield ''.join(lines)
+
+
+def timeOutputFile(file, compressed=False):
+    """Returns the given open output file or, if metrics are recorded,
+    a proxy of it whose writes are timed (see cytoUtils.TimedFile),
+    as compression, if it is compressed, and otherwise as writing.
+    """
+    return cUtils.TimedFile(file, _metrics, compressed) if _metrics else file
+
+
+def openFASTAFile(file):
+    """Opens the given FASTA file for appending, which is Gzipped iff its
+    name ends in '.gz'. If the output is being indexed or packed, the
+    output file, which remains open until all records have been output,
+    is instead returned (via a proxy, whose closure leaves it open).
+    """
+    if _openModGenomeFile:
+        return cUtils.NonClosingFile(_openModGenomeFile)
+    # Write either a Gzipped file or not, by using the appropriate function
+    return timeOutputFile(cUtils.maybe_gzip_open(file, 'ab'),
+                          file.endswith(cUtils.SUFFIX_GZ))
+
+
+def generateFASTAFile(file, id, modGenome, chrm, start, end, suppressBED,
+                      BEDTracks=None, lineWidth=None):
     """Writes an optionally Gzipped FASTA file of the modified genome
     appending to the given file, using the given ID.
     No FASTA ID (i.e. '> ...') is written if no ID is given.
+    The sequence is streamed to the file, one segment at a time,
+    and is wrapped to lines of the given width, if provided.
+    BED lines are written to the given open BED tracks.
     """
-    # Write either a Gzipped file or not, by using the appropriate function
-    with cUtils.maybe_gzip_open(file, 'ab') as modGenomeFile:
+    with openFASTAFile(file) as FASTAFile:
+        modGenomeFile = (_pipelineWriter.wrap(FASTAFile) if _pipelineWriter
+                         else FASTAFile)
         if id:
             modGenomeFile.write(">" + id + "\n")
-        modGenomeFile.write(getModifiedGenome(genome, modOrder, chrm,
-                            start, end, False, suppressBED, tnames, ambigMap,
-                            maskRegionsFileVal, maskRegionTName,
-                            maskAllUnsetRegions) + "\n")
+        segments = iterModifiedGenome(modGenome, chrm, start, end, False,
+                                      suppressBED, BEDTracks)
+        if lineWidth:
+            segments = wrapSequence(segments, lineWidth)
+        for segment in segments:
+            modGenomeFile.write(segment)
+        modGenomeFile.write("\n")
+        if _pipelineWriter:
+            modGenomeFile.flush()  # before the file is closed
 
 
 def selectRandomRegion(genome, length):
@@ -363,6 +452,426 @@ def parseRegion(genome, region):
     return chrm, start, end
 
 
+def _isBEDFile(filename):
+    """Returns whether the given (optionally gzipped) file of regions is
+    a BED file, as determined by its first non-header line, whose second
+    and third columns must be integer coordinates.
+    """
+    with cUtils.maybe_gzip_open(filename) as regionsFile:
+        for line in regionsFile:
+            if line.startswith('##fileformat=VCF'):
+                return False
+            if not line.strip() or line.startswith(_BED_HEADER_PREFIXES):
+                continue
+            fields = line.split('\t', 3)
+            return (len(fields) >= 3 and fields[1].strip().isdigit() and
+                    fields[2].strip().isdigit())
+    return True
+
+
+def _iterRegionFileRows(filename, batchSize):
+    """Yields lists, of at most the given number of
+    (chromosome, start, end) rows, of the regions of the given file.
+    BED files are parsed directly. Other formats (i.e. VCF and GFF)
+    are parsed by pybedtools, in which all regions behave as if they
+    are 0-based, despite non-BED files being 1-based.
+    """
+    if _isBEDFile(filename):
+        with cUtils.maybe_gzip_open(filename) as regionsFile:
+            lines = (line for line in regionsFile if line.strip() and
+                     not line.startswith(_BED_HEADER_PREFIXES))
+            while True:
+                rows = [line.split('\t', 3)[:3]
+                        for line in islice(lines, batchSize)]
+                if not rows:
+                    break
+                yield rows
+    else:
+        import pybedtools
+        intervals = ((interval.chrom, interval.start, interval.end)
+                     for interval in pybedtools.BedTool(filename))
+        while True:
+            rows = list(islice(intervals, batchSize))
+            if not rows:
+                break
+            yield rows
+
+
+def iterRegionFileBatches(filename, chrmNames,
+                          batchSize=_REGION_READ_BATCH_SIZE):
+    """Streams the regions of the given file, in batches of at most the
+    given number of regions. Each batch is a tuple of three arrays:
+    the ID of each region's chromosome, which is its index in the given
+    list of chromosome names (to which new chromosomes are appended),
+    and each region's start and end coordinates.
+    Regions of chromosomes matching CHROMOSOME_EXCLUSION_REGEX are
+    omitted. The regex is only searched once per chromosome,
+    with regions then excluded from each batch as a whole.
+    """
+    chrmIDs = {}
+    chrmIncluded = []
+    for rows in _iterRegionFileRows(filename, batchSize):
+        chrms, starts, ends = izip(*rows)
+        batchChrms, batchChrmIdxs = np.unique(chrms, return_inverse=True)
+        for chrm in batchChrms:
+            if chrm not in chrmIDs:
+                chrmIDs[chrm] = len(chrmNames)
+                chrmNames.append(str(chrm))
+                chrmIncluded.append(not re.search(CHROMOSOME_EXCLUSION_REGEX,
+                                                  chrm))
+        regionChrmIDs = np.array([chrmIDs[chrm] for chrm in batchChrms],
+                                 dtype=np.intp)[batchChrmIdxs]
+        included = np.array(chrmIncluded)[regionChrmIDs]
+        if included.any():
+            yield (regionChrmIDs[included],
+                   np.array(starts, dtype=np.int64)[included],
+                   np.array(ends, dtype=np.int64)[included])
+
+
+def centreRegions(starts, ends, chrmEnds, regionLen):
+    """Returns the start and end coordinates of regions of the given
+    length, centred around each of the given regions, and truncated to
+    their chromosomes (the ends of which are given for each region).
+    """
+    centres = (starts + ends) // 2
+    return (np.maximum(centres - regionLen // 2, 0),
+            np.minimum(centres + regionLen // 2, chrmEnds))
+
+
+def iterRegionCoords(genome, regionBatches, chrmNames, centredRegionLen=None):
+    """Yields the (chromosome, start, end) coordinates of each region of
+    the given batches (see iterRegionFileBatches), centring them around
+    regions of the given length, if one is provided.
+    """
+    chrmEnds = {}
+    for chrmIDs, starts, ends in regionBatches:
+        if centredRegionLen:
+            batchChrmIDs, batchChrmIdxs = np.unique(chrmIDs,
+                                                    return_inverse=True)
+            for chrmID in batchChrmIDs:
+                if chrmID not in chrmEnds:
+                    chrmEnds[chrmID] = int(genome[chrmNames[chrmID]].end)
+            starts, ends = centreRegions(
+                starts, ends, np.array([chrmEnds[chrmID] for chrmID
+                                        in batchChrmIDs],
+                                       dtype=np.int64)[batchChrmIdxs],
+                centredRegionLen)
+        for chrmID, start, end in izip(chrmIDs.tolist(), starts.tolist(),
+                                       ends.tolist()):
+            yield chrmNames[chrmID], start, end
+
+
+def getInputRecord(filename, previousRecord=None):
+    """Returns the manifest record of the given input file of an archive,
+    a dict of its size, modification time, and content digest.
+    The digest of the given previous record of the file is reused,
+    rather than being recomputed, if its size and modification time
+    are unchanged.
+    """
+    record = {'size': os.path.getsize(filename),
+              'mtime': os.path.getmtime(filename)}
+    if (previousRecord and previousRecord['size'] == record['size'] and
+            previousRecord['mtime'] == record['mtime']):
+        record['digest'] = previousRecord['digest']
+    else:
+        record['digest'] = cUtils.getFileDigest(filename)
+    return record
+
+
+def loadArchiveManifest(archive):
+    """Returns the manifest of the given archive (see createArchive),
+    or None if it has none, or if the archive has been changed since.
+    """
+    manifestFilename = os.path.normpath(archive) + _ARCHIVE_MANIFEST_SUFFIX
+    try:
+        with open(manifestFilename) as manifestFile:
+            manifest = json.load(manifestFile)
+        if (manifest['version'] == _ARCHIVE_MANIFEST_VERSION and
+                manifest['archive'] == cUtils.getFileStats(archive)):
+            return manifest
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def writeArchiveManifest(archive, manifest):
+    """Writes the given manifest of the given archive, which records
+    the archive's own files, as they now are.
+    """
+    manifest['version'] = _ARCHIVE_MANIFEST_VERSION
+    manifest['archive'] = cUtils.getFileStats(archive)
+    with open(os.path.normpath(archive) + _ARCHIVE_MANIFEST_SUFFIX,
+              'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=1, sort_keys=True)
+
+
+def removeArchiveManifest(archive):
+    """Removes the manifest of the given archive, if any."""
+    manifestFilename = os.path.normpath(archive) + _ARCHIVE_MANIFEST_SUFFIX
+    if os.path.exists(manifestFilename):
+        os.remove(manifestFilename)
+
+
+def findSequenceFiles(genomeDir):
+    """Returns the (optionally gzipped) FASTA files of the given genome
+    directory, or, if there are none, its repeat masked sequence files.
+    Dies if there are neither.
+    """
+    seqFilenames = (glob.glob(genomeDir + "/*.fa") or
+                    glob.glob(genomeDir + "/*.fa.gz"))
+    if not seqFilenames:
+        seqFilenames = (glob.glob(genomeDir + "/*.mask") or
+                        glob.glob(genomeDir + "/*.mask.gz"))
+        v_print_timestamp(args.verbose, """Detected that a repeat masked
+                          genome is being used.""")
+    if not seqFilenames:
+        die("Unable to locate FASTA input files.")
+    return seqFilenames
+
+
+def findTrackFiles(tracksPath):
+    """Returns the (track name, track filename) pairs of the supported
+    track files of the given directory of tracks, or of the given track
+    file itself.
+    """
+    # TODO check for a valid track path, that actually
+    #      contains tracks, otherwise throw an error.
+    if (os.path.isfile(tracksPath) and
+            re.search(SUPPORTED_FORMATS_REGEX, tracksPath)):
+        return [(os.path.basename(tracksPath), tracksPath)]
+    return [(track, os.path.join(tracksPath, track))
+            for track in os.listdir(tracksPath)
+            if re.search(SUPPORTED_FORMATS_REGEX, track)]
+
+
+def startParsingTracks(tracks, jobs, parsedTracksDir):
+    """Starts parsing each of the bedGraphs of the given (track name,
+    track filename) pairs (see archiveTracks.parseBedGraph) into the given
+    directory, using the given number of worker processes.
+    Returns the pool of workers, which must be started before any
+    archive is opened, and a dict of the pending result of each track.
+    """
+    pool = multiprocessing.Pool(jobs)
+    parsedTracks = {trackName: pool.apply_async(
+                    aTracks.parseBedGraph,
+                    (trackFilename, os.path.join(parsedTracksDir,
+                                                 str(trackIdx))))
+                    for trackIdx, (trackName, trackFilename)
+                    in enumerate(tracks) if aTracks.isBedGraph(trackFilename)}
+    pool.close()
+    return pool, parsedTracks
+
+
+def hasGenomedataInternals():
+    """Returns whether all of the internals of Genomedata, upon which
+    loading parsed tracks and updating archives rely, are available
+    (see _GENOMEDATA_INTERNALS).
+    """
+    try:
+        for moduleName, name in _GENOMEDATA_INTERNALS:
+            getattr(importlib.import_module(moduleName), name)
+    except (ImportError, AttributeError):
+        return False
+    return True
+
+
+def loadArchiveTracks(archive, tracks, parsedTracks):
+    """Loads each of the given (track name, track filename) pairs into the
+    given archive, to which the tracks have already been added, either
+    from its pending result in the given dict of parsed tracks (see
+    startParsingTracks) or, otherwise, via Genomedata's own loader.
+    Dies if a parsed track is invalid.
+    """
+    from genomedata import Genome
+    # NB: Genomedata internals (see _GENOMEDATA_INTERNALS)
+    from genomedata._load_data import load_data
+
+    for trackName, trackFilename in tracks:
+        if trackName not in parsedTracks:
+            load_data(archive, trackName, trackFilename, verbose=args.verbose)
+            continue
+        try:
+            parsedFiles = parsedTracks[trackName].get()
+        except ValueError as e:
+            die(str(e))
+        v_print_timestamp(args.verbose, "Loading the parsed track {}.".
+                          format(trackName))
+        with Genome(archive, mode='r+') as genome:
+            ignoredChrms = aTracks.loadParsedTrack(genome, trackName,
+                                                   parsedFiles)
+        if ignoredChrms:
+            v_print_timestamp(args.verbose, """The following chromosomes
+                              of track {}, which are not in the archive,
+                              have been ignored: {}.""".
+                              format(trackName, ', '.join(ignoredChrms)))
+
+
+def buildArchive(archive, tracks, seqFilenames, parsedTracks):
+    """Creates the given genome data archive from the given
+    (track name, track filename) pairs and sequence filenames,
+    as Genomedata's load_genomedata does (i.e. within a temporary
+    archive, which is then repacked), but loading the tracks with a
+    pending result in the given dict of parsed tracks from it
+    (see loadArchiveTracks).
+    """
+    # NB: Genomedata internals (see _GENOMEDATA_INTERNALS)
+    from genomedata import EXT, FILE_MODE_CHROMS, SUFFIX
+    from genomedata._close_data import close_data
+    from genomedata._load_seq import load_seq
+    from genomedata._open_data import open_data
+    from genomedata.load_genomedata import repack
+
+    mode = 'file' if len(seqFilenames) > FILE_MODE_CHROMS else 'dir'
+    tempDir = tempfile.mkdtemp(prefix=EXT + os.extsep)
+    tempArchive = (tempDir if mode == 'dir' else
+                   os.path.join(tempDir, _DEFAULT_ARCHIVE_NAME + SUFFIX))
+    try:
+        load_seq(tempArchive, seqFilenames, verbose=args.verbose, mode=mode)
+        open_data(tempArchive, [trackName for trackName, _ in tracks],
+                  verbose=args.verbose)
+        loadArchiveTracks(tempArchive, tracks, parsedTracks)
+        close_data(tempArchive, verbose=args.verbose)
+        if mode == 'dir':  # each file of the archive is repacked
+            if not os.path.isdir(archive):
+                os.makedirs(archive)
+            for filename in sorted(os.listdir(tempArchive)):
+                repack(os.path.join(tempArchive, filename),
+                       os.path.join(archive, filename), args.verbose)
+        else:
+            repack(tempArchive, archive, args.verbose)
+    finally:
+        shutil.rmtree(tempDir)
+
+
+def createArchive(archive, tracks, seqFilenames, rebuild=False, jobs=1):
+    """Creates the given genome data archive from the given
+    (track name, track filename) pairs and sequence filenames,
+    recording the size, modification time, and content digest of each
+    input in a manifest next to the archive (see loadArchiveManifest).
+    Unless a rebuild is requested, an existing archive with a manifest
+    is reused, if all of its inputs are unchanged, or, if its sequences
+    are unchanged and its tracks were only added or replaced, is updated
+    by only loading those tracks into it. Otherwise, the archive is
+    created from scratch.
+    When using multiple jobs, the bedGraph tracks that are loaded are
+    first parsed and validated in parallel, by separate processes,
+    while the sequences and any other tracks are loaded.
+    If the internals of Genomedata upon which this relies are unavailable
+    (see _GENOMEDATA_INTERNALS), any changed archive is instead created
+    from scratch, with its tracks loaded by Genomedata itself.
+    """
+    from genomedata import load_genomedata
+
+    previous = None if rebuild else loadArchiveManifest(archive)
+    previousSeqs = previous['sequences'] if previous else {}
+    previousTracks = previous['tracks'] if previous else {}
+    manifest = {'sequences': {}, 'tracks': {}}
+    for seqFilename in seqFilenames:
+        seqPath = os.path.realpath(seqFilename)
+        manifest['sequences'][seqPath] = getInputRecord(
+            seqFilename, previousSeqs.get(seqPath))
+    for trackName, trackFilename in tracks:
+        trackPath = os.path.realpath(trackFilename)
+        previousTrack = previousTracks.get(trackName)
+        manifest['tracks'][trackName] = getInputRecord(
+            trackFilename, previousTrack
+            if previousTrack and previousTrack['path'] == trackPath else None)
+        manifest['tracks'][trackName]['path'] = trackPath
+
+    def getDigests(records):
+        return {name: record['digest'] for name, record in records.iteritems()}
+
+    changedTracks = [(trackName, trackFilename) for trackName, trackFilename
+                     in tracks if trackName in previousTracks and
+                     previousTracks[trackName]['digest'] !=
+                     manifest['tracks'][trackName]['digest']]
+    addedTracks = [(trackName, trackFilename) for trackName, trackFilename
+                   in tracks if trackName not in previousTracks]
+    recreate = (not previous or
+                getDigests(previousSeqs) != getDigests(manifest['sequences'])
+                or set(previousTracks) - set(manifest['tracks']))
+    if not recreate and not changedTracks and not addedTracks:
+        v_print_timestamp(args.verbose, """The inputs of the existing
+                          genomedata archive are unchanged, so it has
+                          been reused.""")
+        return
+    useInternals = hasGenomedataInternals()
+    if not recreate and not useInternals:
+        v_print_timestamp(args.verbose, """The existing genomedata archive
+                          cannot be updated with this version of
+                          Genomedata, so it will be re-created.""")
+        recreate = True
+    loadedTracks = tracks if recreate else changedTracks + addedTracks
+    pool, parsedTracks, parsedTracksDir = None, {}, None
+    if jobs > 1 and useInternals and any(aTracks.isBedGraph(trackFilename)
+                                         for _, trackFilename in loadedTracks):
+        v_print_timestamp(args.verbose, """Parsing the bedGraph tracks
+                          using {} processes.""".format(jobs))
+        parsedTracksDir = tempfile.mkdtemp(prefix='cytomod.tracks.')
+        pool, parsedTracks = startParsingTracks(loadedTracks, jobs,
+                                                parsedTracksDir)
+    try:
+        if recreate:
+            # The archive is (re-)created, without a manifest until it is.
+            removeArchiveManifest(archive)
+            if parsedTracks:
+                buildArchive(archive, tracks, seqFilenames, parsedTracks)
+            else:
+                load_genomedata.load_genomedata(archive, tracks=tracks,
+                                                seqfilenames=seqFilenames,
+                                                verbose=args.verbose)
+        else:
+            # NB: Genomedata internals (see _GENOMEDATA_INTERNALS)
+            from genomedata._close_data import close_data
+            from genomedata._erase_data import erase_data
+            from genomedata._open_data import open_data
+
+            v_print_timestamp(args.verbose, """Updating the existing
+                              genomedata archive with {} added and {}
+                              replaced tracks.""".
+                              format(len(addedTracks), len(changedTracks)))
+            # The archive is updated in place, without a manifest until it
+            # has been, such that an interrupted update is later re-created.
+            removeArchiveManifest(archive)
+            for trackName, _ in changedTracks:
+                erase_data(archive, trackName, verbose=args.verbose)
+            if addedTracks:
+                open_data(archive,
+                          [trackName for trackName, _ in addedTracks],
+                          verbose=args.verbose)
+            loadArchiveTracks(archive, loadedTracks, parsedTracks)
+            close_data(archive, verbose=args.verbose)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(parsedTracksDir)
+    writeArchiveManifest(archive, manifest)
+
+
+def loadCallIndex(archive, genome):
+    """Returns the call index of the given archive, which is open as the
+    given genome, loading it from alongside the archive, unless the archive
+    has since changed, in which case it is built and then saved.
+    """
+    callIndex = mGenome.CallIndex.load(archive)
+    if callIndex is not None:
+        v_print_timestamp(args.verbose, "Loaded the call index of the "
+                          "genomedata archive.")
+        return callIndex
+    v_print_timestamp(args.verbose, "Building the call index of the "
+                      "genomedata archive.")
+    callIndex = mGenome.CallIndex.build(genome, archive)
+    try:
+        callIndex.save(archive)
+    except (IOError, OSError) as e:
+        warn("The call index could not be saved alongside the genomedata "
+             "archive, so will be rebuilt by subsequent runs: " + str(e))
+    v_print_timestamp(args.verbose, "Built the call index, of {} runs.".
+                      format(callIndex.getNumRuns()))
+    return callIndex
+
+
 def determineTrackPriority(genome):
     """Currently, an ad hoc and contrived means of determining
     which epigenetic modification has precedence. This is done by
@@ -382,6 +891,442 @@ def determineTrackPriority(genome):
         break
 
 
+def _initGenomeWorker(modGenome):
+    """Initializes a worker process, by reopening the given modified genome
+    with its own handle to the genomedata archive, since handles cannot be
+    shared between processes.
+    """
+    global _workerModGenome, _metrics
+    warnings.simplefilter("ignore")  # Ignore supercontig warnings
+    # Close the HDF5 files inherited from the parent process, since HDF5
+    # would otherwise share their (process-shared) file descriptors
+    # when the same file is re-opened, corrupting concurrent reads.
+    # This does not affect the parent's own handles.
+    import tables
+    for h5file in list(tables.file._open_files.handlers):
+        h5file.close()
+    _workerModGenome = modGenome.reopen()
+    if modGenome.metrics is not None:
+        # The worker's metrics are returned with each of its results.
+        _metrics = _workerModGenome.metrics = cUtils.RunMetrics()
+
+
+def iterPooledResults(pool, jobs, func, tasks):
+    """Yields the result of applying the given function to the arguments
+    of each of the given (key, arguments) tasks, via the given pool of
+    the given number of worker processes, along with the task's key.
+    Results are yielded in the order of the tasks. The number of tasks
+    either being processed or awaiting output is bounded, such that
+    tasks are only submitted as their results are consumed.
+    """
+    pending = deque()
+    for key, funcArgs in tasks:
+        if len(pending) >= jobs * _MAX_PENDING_BATCHES_PER_JOB:
+            pendingKey, result = pending.popleft()
+            yield pendingKey, result.get()
+        pending.append((key, pool.apply_async(func, funcArgs)))
+    while pending:
+        pendingKey, result = pending.popleft()
+        yield pendingKey, result.get()
+
+
+def _gzipMember(data):
+    """Returns the given data, compressed as a single Gzip member.
+    Gzip members may be concatenated to form a valid Gzipped file.
+    """
+    memberFile = StringIO()
+    with gzip.GzipFile(fileobj=memberFile, mode='wb') as gzipFile:
+        gzipFile.write(data)
+    return memberFile.getvalue()
+
+
+def _computeSegmentOutput(chrm, start, end, column, prefix, suffix,
+                          suppressFASTA, suppressBED, lineWidth,
+                          compressFASTA):
+    """Computes the output of a single segment, using the worker's modified
+    genome. Returns its FASTA text, enclosed by the given prefix and suffix
+    (and optionally compressed as a Gzip member), whose sequence is wrapped
+    as though its line already contains the given number of columns,
+    along with a dict, keyed by modified base, of its BED lines,
+    whether it has any modified bases, and, if metrics are recorded,
+    those of the worker, since its last result (see RunMetrics.popCounts).
+    """
+    v_print_timestamp(args.verbose, "Now outputting " + chrm +
+                      " for region: (" + str(start) + ", " + str(end) + ")",
+                      2)
+    allModBases, modPositions = _workerModGenome.getSegment(chrm, start, end)
+    if _metrics:
+        _metrics.countSegment(chrm, end - start)
+    BEDLines = {}
+    if not suppressBED:
+        with cUtils.timedStage(_metrics, 'BEDFormatting'):
+            for base, positions in _workerModGenome.iterBEDCoords(
+                    allModBases, modPositions):
+                BEDLines[base] = getBEDLines(chrm, base, positions + start)
+    seq = ''
+    if not suppressFASTA:
+        seq = allModBases.tostring()
+        if lineWidth:
+            seq = ''.join(wrapSequence([seq], lineWidth, column))
+    text = prefix + seq + suffix
+    if compressFASTA:
+        with cUtils.timedStage(_metrics, 'compression'):
+            text = _gzipMember(text)
+    return (text, BEDLines, modPositions.size > 0,
+            _metrics.popCounts() if _metrics else None)
+
+
+def generateFASTAInParallel(file, modGenome, records, jobs, suppressFASTA,
+                            suppressBED, BEDTracks, lineWidth):
+    """Outputs the given modified genome for each of the given records,
+    (ID, chromosome, start, end) tuples, by distributing their segments
+    to a pool of the given number of worker processes, such that even
+    a single chromosome or region is computed in parallel.
+    The segments are reassembled in coordinate order: each FASTA record
+    is appended to the given file (with its ID, if any) or, if no file is
+    given, its sequence is printed to STDOUT, and its BED lines are written
+    to the given open BED tracks. The output is identical to that of
+    generating each record in turn. If the file is Gzipped, each segment
+    is compressed by its worker, as a separate Gzip member.
+    """
+    compressFASTA = (bool(file) and file.endswith(cUtils.SUFFIX_GZ) and
+                     not _openModGenomeFile)
+
+    def iterSegmentTasks():
+        """Yields the task of each segment of each record."""
+        for id, chrm, start, end in records:
+            segments = list(modGenome.iterSegmentBounds(chrm, start,
+                                                        end)) or [(start, end)]
+            for segmentIdx, (s, e) in enumerate(segments):
+                column = ((s - start - 1) % lineWidth + 1
+                          if lineWidth and s > start else 0)
+                isFirst = segmentIdx == 0
+                isLast = segmentIdx == len(segments) - 1
+                yield ((id or chrm + ":" + str(start) + "-" + str(end),
+                        isFirst, isLast),
+                       (chrm, s, e, column,
+                        ">" + id + "\n" if id and isFirst else '',
+                        "\n" if isLast else '', suppressFASTA, suppressBED,
+                        lineWidth, compressFASTA))
+
+    # Gzipped segments are already compressed, so are written as-is.
+    modGenomeFile = ((timeOutputFile(open(file, 'ab')) if compressFASTA else
+                      openFASTAFile(file)) if file else
+                     timeOutputFile(sys.stdout))
+    pool = multiprocessing.Pool(jobs, _initGenomeWorker, (modGenome,))
+    hasModifiedBases = False
+    try:
+        for (recordStr, isFirst, isLast), \
+                (text, BEDLines, segmentHasMods, workerMetrics) \
+                in iterPooledResults(pool, jobs, _computeSegmentOutput,
+                                     iterSegmentTasks()):
+            if workerMetrics:
+                _metrics.addCounts(workerMetrics)
+            if isFirst:
+                v_print_timestamp(args.verbose, """Outputting the modified
+                                  genome for: """ + recordStr + ".")
+            modGenomeFile.write(text)
+            for base, lines in BEDLines.iteritems():
+                BEDTracks[base].write(lines)
+            hasModifiedBases |= segmentHasMods
+            if isLast:
+                if not hasModifiedBases and not suppressBED:
+                    _warnNoModifiedBases()
+                hasModifiedBases = False
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        if file:
+            modGenomeFile.close()
+
+
+def planRegionSpans(regions, maxSpanLen):
+    """Plans the reading of the given regions, a list of
+    (chromosome, start, end) tuples, by sorting them and coalescing
+    overlapping or adjacent regions of each chromosome into spans.
+    Regions are only coalesced if the resultant span is no longer than
+    the given maximum length, such that spans are computed in one segment.
+    Returns the list of spans, as (chromosome, start, end) tuples,
+    and, for each region in its input order, the index of its span.
+    """
+    spans = []
+    spanIdxs = [None] * len(regions)
+    for regionIdx in sorted(xrange(len(regions)),
+                            key=lambda regionIdx: regions[regionIdx]):
+        chrm, start, end = regions[regionIdx]
+        if spans:
+            spanChrm, spanStart, spanEnd = spans[-1]
+            if (chrm == spanChrm and start <= spanEnd and
+                    max(end, spanEnd) - spanStart <= maxSpanLen):
+                spans[-1] = (chrm, spanStart, max(end, spanEnd))
+                spanIdxs[regionIdx] = len(spans) - 1
+                continue
+        spans.append((chrm, start, end))
+        spanIdxs[regionIdx] = len(spans) - 1
+    return spans, spanIdxs
+
+
+def computeRegions(modGenome, regions, suppressFASTA, suppressBED):
+    """Computes the given modified genome for each of the given regions,
+    a list of (chromosome, start, end) tuples.
+    Overlapping regions are coalesced into spans (see planRegionSpans),
+    each of which is read and computed only once, with each region
+    then sliced from the result of its span.
+    Returns a list containing, for each region, in the input order,
+    its modified sequence and a dict, keyed by modified base,
+    of its BED lines.
+    """
+    spans, spanIdxs = planRegionSpans(regions, modGenome.segmentLen)
+    spanResults = []
+    for chrm, spanStart, spanEnd in spans:
+        spanSeqs = [np.empty(0, dtype=np.uint8)]
+        spanPositions = [np.empty(0, dtype=np.intp)]
+        for s, e in modGenome.iterSegmentBounds(chrm, spanStart, spanEnd):
+            v_print_timestamp(args.verbose, "Now computing " + chrm +
+                              " for span: (" + str(s) + ", " + str(e) + ")",
+                              2)
+            allModBases, modPositions = modGenome.getSegment(chrm, s, e)
+            if modGenome.metrics is not None:
+                modGenome.metrics.countSegment(chrm, e - s)
+            spanSeqs.append(allModBases)
+            spanPositions.append(modPositions + (s - spanStart))
+        spanResults.append((np.concatenate(spanSeqs),
+                            np.concatenate(spanPositions)))
+
+    results = []
+    for (chrm, start, end), spanIdx in izip(regions, spanIdxs):
+        spanStart = spans[spanIdx][1]
+        spanSeq, spanPositions = spanResults[spanIdx]
+        # the positions (relative to the span) with calls, in the region
+        positions = spanPositions[slice(*np.searchsorted(
+            spanPositions, [start - spanStart, end - spanStart]))]
+        BEDLines = {}
+        if not suppressBED:
+            if positions.size == 0:
+                _warnNoModifiedBases()
+            with cUtils.timedStage(modGenome.metrics, 'BEDFormatting'):
+                for base, basePositions in modGenome.iterBEDCoords(
+                        spanSeq, positions):
+                    BEDLines[base] = getBEDLines(chrm, base,
+                                                 basePositions + spanStart)
+        seq = ('' if suppressFASTA else
+               spanSeq[start - spanStart:end - spanStart].tostring())
+        results.append((seq, BEDLines))
+    return results
+
+
+def iterRegionBatches(regions, maxBatchLen):
+    """Yields lists of consecutive regions from the given regions,
+    each of at most _REGION_BATCH_SIZE regions, spanning a total of at most
+    the given length (unless consisting of a single longer region),
+    such that the memory used to compute each batch is bounded.
+    """
+    batch = []
+    batchLen = 0
+    for region in regions:
+        regionLen = region[2] - region[1]
+        if batch and (len(batch) == _REGION_BATCH_SIZE or
+                      batchLen + regionLen > maxBatchLen):
+            yield batch
+            batch = []
+            batchLen = 0
+        batch.append(region)
+        batchLen += regionLen
+    if batch:
+        yield batch
+
+
+def outputRegions(regions, results, modGenomeFile, BEDTracks, lineWidth):
+    """Outputs the given results of computeRegions for the given regions.
+    The FASTA records are appended to the given open file or,
+    if no file is given, each sequence is printed to STDOUT.
+    """
+    for (chrm, start, end), (seq, BEDLines) in izip(regions, results):
+        regionStr = chrm + ":" + str(start) + "-" + str(end)
+        v_print_timestamp(args.verbose, """Outputting the modified
+                          genome for: """ + regionStr + ".")
+        if lineWidth:
+            seq = ''.join(wrapSequence([seq], lineWidth))
+        if modGenomeFile:
+            modGenomeFile.write(">" + regionStr + "\n" + seq + "\n")
+        else:
+            with cUtils.timedStage(_metrics, 'write'):
+                print(seq)
+        for base, lines in BEDLines.iteritems():
+            BEDTracks[base].write(lines)
+
+
+def _computeRegions(regions, suppressFASTA, suppressBED):
+    """Computes the given regions using the worker's modified genome.
+    See computeRegions. Returns its results, along with the metrics of
+    the worker, if recorded, as for _computeSegmentOutput.
+    """
+    return (computeRegions(_workerModGenome, regions, suppressFASTA,
+                           suppressBED),
+            _metrics.popCounts() if _metrics else None)
+
+
+def generateRegions(file, modGenome, regions, jobs, suppressFASTA,
+                    suppressBED, BEDTracks, lineWidth):
+    """Outputs the given modified genome for each of the given regions,
+    a sequence of (chromosome, start, end) tuples, in their given order.
+    The FASTA records are appended to the given file or, if no file
+    is given, each sequence is printed to STDOUT.
+    Regions are computed in batches (see iterRegionBatches), within which
+    overlapping regions share their reads and computation.
+    If more than one job is requested, batches are computed by a pool of
+    worker processes. The number of batches either being processed or
+    awaiting output is then bounded, such that memory use does not depend
+    upon the number of regions. The output is identical irrespective of
+    the number of jobs.
+    """
+    modGenomeFile = openFASTAFile(file) if file else None
+    computeArgs = (suppressFASTA, suppressBED)
+    regionBatches = iterRegionBatches(regions, modGenome.segmentLen)
+    if jobs == 1:
+        try:
+            for batch in regionBatches:
+                outputRegions(batch,
+                              computeRegions(modGenome, batch, *computeArgs),
+                              modGenomeFile, BEDTracks, lineWidth)
+        finally:
+            if modGenomeFile:
+                modGenomeFile.close()
+        return
+
+    pool = multiprocessing.Pool(jobs, _initGenomeWorker, (modGenome,))
+    try:
+        for batch, (result, workerMetrics) in iterPooledResults(
+                pool, jobs, _computeRegions,
+                ((batch, (batch,) + computeArgs)
+                 for batch in regionBatches)):
+            if workerMetrics:
+                _metrics.addCounts(workerMetrics)
+            outputRegions(batch, result, modGenomeFile, BEDTracks, lineWidth)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        if modGenomeFile:
+            modGenomeFile.close()
+
+
+def parseRegionRequest(modGenome, request):
+    """Parses a region request of serveRegions, which is either a region
+    or chromosome, as for '-r' (e.g. "chr1:1000-2000" or "chr1"), or a
+    BED-like line (i.e. a chromosome, zero-based start, and end, followed
+    by any other fields). Raises ValueError if the request is invalid.
+    """
+    fields = request.split()
+    if len(fields) >= 3:
+        chrm, start, end = fields[:3]
+    else:
+        regionMatch = re.match(REGION_REGEX + '$', re.sub('[, ]', '', request))
+        if not regionMatch:
+            raise ValueError("Invalid region: invalid format.")
+        chrm, start, end = regionMatch.group(1, 'start', 'end')
+    try:
+        start, end = [int(pos) if pos is not None else None
+                      for pos in (start, end)]
+    except ValueError:
+        raise ValueError("Invalid region: invalid position.")
+    return (chrm,) + modGenome.getRegionBounds(chrm, start, end)
+
+
+def answerRegionRequests(modGenome, requests):
+    """Returns the response to the given batch of region requests
+    (see serveRegions): a line for each request, in order, of either
+    its modified sequence or, if it is invalid, an error message.
+    The valid regions are computed together (see computeRegions).
+    """
+    regions = []
+    errors = []
+    for request in requests:
+        try:
+            regions.append(parseRegionRequest(modGenome, request))
+            errors.append(None)
+        except ValueError as e:
+            errors.append(str(e))
+    seqs = iter([seq for seq, _ in computeRegions(modGenome, regions,
+                                                  False, True)])
+    return ''.join(("ERROR " + error if error else next(seqs)) + "\n"
+                   for error in errors)
+
+
+class _RegionRequestHandler(SocketServer.StreamRequestHandler):
+    """Answers the region requests of a single client of serveRegions."""
+
+    def handle(self):
+        batch = []
+        for request in iter(self.rfile.readline, ''):
+            request = request.strip()
+            if request:
+                batch.append(request)
+            if batch and (not request or
+                          len(batch) == _MAX_REQUEST_BATCH_SIZE):
+                # The archive (and cache) is only accessed by one thread.
+                with self.server.lock:
+                    response = answerRegionRequests(self.server.modGenome,
+                                                    batch)
+                self.wfile.write(response)
+                batch = []
+        if batch:
+            with self.server.lock:
+                response = answerRegionRequests(self.server.modGenome, batch)
+            self.wfile.write(response)
+
+
+class _UnixRegionServer(SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPRegionServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serveRegions(modGenome, address):
+    """Serves the given modified genome, which remains open throughout,
+    at the given address, which is either the path of a Unix socket or
+    a TCP port, optionally preceded by a host (i.e. "[HOST:]PORT"),
+    which defaults to localhost, until interrupted or terminated.
+    Each client sends region requests (see parseRegionRequest),
+    one per line, and receives a line for each request, in order,
+    of its modified sequence or, if it is invalid, of "ERROR" and the
+    reason. Requests are answered in batches, once a blank line is sent,
+    the connection is shut down for writing, or the maximum batch size
+    is reached, with overlapping regions of a batch computed together.
+    Each client is served by its own thread, but the modified genome
+    is only accessed by a single thread at a time.
+    """
+    TCPAddress = re.match('^(?:(?P<host>[^:/]*):)?(?P<port>\d+)$', address)
+    if TCPAddress:
+        server = _TCPRegionServer((TCPAddress.group('host') or 'localhost',
+                                   int(TCPAddress.group('port'))),
+                                  _RegionRequestHandler)
+    else:
+        if (os.path.exists(address) and
+                stat.S_ISSOCK(os.stat(address).st_mode)):
+            os.remove(address)  # a socket left by a previous server
+        server = _UnixRegionServer(address, _RegionRequestHandler)
+    server.modGenome = modGenome
+    server.lock = threading.Lock()
+    # Terminate, like an interrupt, such that the socket is removed.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    v_print_timestamp(args.verbose, "Serving region requests at " +
+                      address + ".")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        v_print_timestamp(args.verbose, "Stopped serving region requests.")
+    finally:
+        server.server_close()
+        if not TCPAddress:
+            os.remove(address)
+
+
 # TODO add a custom action to parse all directories, which ensures
 #      that each directory contains a trailing slash.
 
@@ -440,9 +1385,29 @@ genomeArchive.add_argument("-d", "--archiveCompDirs", nargs=2,
                            genome provided. This will \
                            create a genome data archive in an \"archive\" \
                            sub-directory of the provided track directory. \
+                           A manifest of the inputs is stored next to the \
+                           archive, such that a subsequent run reuses the \
+                           archive, if its inputs are unchanged, or only \
+                           loads any added or replaced tracks into it. \
                            Use '-G' instead to use an existing \
                            archive.".format(cUtils.MOD_BASES.keys(),
-                                            _MASK_TNAME))
+                                            mGenome.MASK_TNAME))
+genomeArchive.add_argument("--direct", nargs=2,
+                           metavar=('GENOME_DIR', 'TRACKS_DIR'),
+                           help="As for '-d', but without creating a \
+                           genome data archive, which is best suited to \
+                           one-off runs upon sparse tracks. \
+                           The FASTA files and tracks are instead read \
+                           directly, once each track has been parsed \
+                           (using '-j' processes) into its intervals for \
+                           each chromosome, which are then merged with \
+                           the sequence of each chromosome, as it is \
+                           output. The output is identical to that of an \
+                           archive created from the same files, except \
+                           that the chromosomes of a single FASTA file \
+                           are output in its order, such that it is read \
+                           in a single pass. \
+                           Only bedGraph tracks are supported.")
 parser.add_argument("--archiveOutDir",
                     help="Only applicable if '-d' is used. \
                     The directory in which to save the created \
@@ -455,6 +1420,25 @@ parser.add_argument("--archiveOutName", default=_DEFAULT_ARCHIVE_NAME,
                     The name of the archive (i.e. the name \
                     of the directory which comprises the genome data \
                     archive).")
+parser.add_argument("--rebuildArchive", action='store_true',
+                    help="Only applicable if '-d' is used. \
+                    Create the genome data archive from scratch, \
+                    even if an existing archive could be reused \
+                    or updated.")
+parser.add_argument("--callIndex", action='store_true',
+                    help="Read the calls of the genome data archive from \
+                    a sparse index of the runs of positions at which each \
+                    track has a call, rather than from the archive's track \
+                    data, such that segments without any calls are copied \
+                    from the reference sequence, and other segments are \
+                    only modified at their calls. The index is built upon \
+                    first use and saved alongside the archive (as \
+                    ARCHIVE{}), from where it is loaded by subsequent runs, \
+                    unless the archive has since changed. The output is \
+                    identical to that computed from the track data. \
+                    Not applicable to '--direct' or \
+                    '--maskAllUnsetRegions'.".
+                    format(mGenome.CALL_INDEX_SUFFIX))
 region = parser.add_mutually_exclusive_group()
 region.add_argument('-r', '--region', help="Only output the modified genome \
                     for the given region. This can either be via a file \
@@ -524,6 +1508,28 @@ parser.add_argument("--BEDOutDir", default='.',
                     The directory in which to save the created \
                     BED tracks. If not specified, this \
                     defaults to the current working directory.")
+parser.add_argument("--indexBED", action='store_true',
+                    help="Only applicable if '-b' is not used. \
+                    Compress the created BED tracks using BGZF \
+                    and index them using tabix (creating \".tbi\" files), \
+                    permitting random access to the tracks. \
+                    Tracks of unsorted regions cannot be indexed. \
+                    This requires pysam.")
+parser.add_argument("--indexFASTA", action='store_true',
+                    help="Only applicable if a FASTA file is output. \
+                    Index the output FASTA file (creating a samtools \
+                    \".fai\" file), which then replaces, rather than \
+                    being appended to, any existing file. If the file is \
+                    Gzipped, it is compressed using BGZF, by multiple \
+                    threads, and its BGZF index is also created \
+                    (a \".gzi\" file), permitting any region of the \
+                    modified genome to be fetched without decompressing \
+                    the file from its start (e.g. via samtools faidx).")
+parser.add_argument("--compressionThreads", type=int,
+                    default=multiprocessing.cpu_count(),
+                    help="The number of threads used to compress an \
+                    indexed (\"--indexFASTA\") and Gzipped FASTA file. \
+                    This defaults to the number of CPUs.")
 parser.add_argument('-f', '--fastaFile', nargs='?', type=str,
                     const=_DEFAULT_FASTA_FILENAME, help="Output to \
                     a file instead of STDOUT. Provide a full path \
@@ -534,12 +1540,30 @@ parser.add_argument('-f', '--fastaFile', nargs='?', type=str,
                     This will override the '-B' parameter \
                     (i.e. a FASTA file with always be produced). \
                     The output file will be Gzipped iff the \
-                    path provided ends in \".gz\".")
+                    path provided ends in \".gz\". \
+                    If the path ends in \".{}\", the modified genome \
+                    is instead output in a compact binary format, \
+                    which replaces any existing file, storing each base \
+                    in 5 bits, along with an index (a \".idx\" file), \
+                    such that any region can be read via memory mapping \
+                    (using cytoUtils.PackedGenome).".
+                    format(cUtils.EXT_PACKED))
+parser.add_argument('-w', '--lineWidth', type=int,
+                    help="Wrap the output sequences to lines of the given \
+                    width (e.g. 60). By default, each sequence is output \
+                    on a single line.")
 parser.add_argument('-I', '--intersection', action='store_true',
                     help="If multiple files of the same modification \
                     type are given, take their intersection. \
                     This option is used to override the default, \
                     which is to take their union.")
+parser.add_argument('-k', '--minAgreeingTracks', type=int,
+                    help="When taking the intersection ('-I'), \
+                    consider a base to have a given modification if \
+                    at least this many of the files of that modification \
+                    type call it (i.e. k-of-n agreement, which permits \
+                    replicates to be intersected less stringently). \
+                    By default, all of the files must agree.")
 ambigModUsage = \
     parser.add_argument_group(title="Ambiguous Modification",
                               description="Specify that some of the data \
@@ -577,7 +1601,7 @@ ambigModUsage.add_argument('-M', '--maskRegions', nargs='?', type=float,
                            help="Hard mask C/G nucleobases to unknown state. \
                            Assumes that the archive contains or is \
                            being built with a trackname containing \"" +
-                           _MASK_TNAME + "\". \
+                           mGenome.MASK_TNAME + "\". \
                            The containing loci will be interpreted as \
                            nucleobases of unknown modification state. \
                            They will be accordingly set to the appropriate \
@@ -624,6 +1648,78 @@ ambigModUsage.add_argument('--maskAllUnsetRegions', action='store_true',
 #                     or from Frith et al., respectively. \
 #                     Default behaviour is equivalent to providing the \
 #                     'F' sub-argument.", action='store_const', const='F')
+parser.add_argument('--memory-budget', type=parseMemorySize,
+                    dest='memoryBudget',
+                    help="The approximate memory, per process, to use \
+                    for computing the modified genome (e.g. \"512M\" or \
+                    \"4G\"). The genome is computed in segments, \
+                    the length of which is then chosen according \
+                    to the number of tracks in the archive. \
+                    Otherwise, segments of {} bases are used. \
+                    When using '-j', each worker process uses this budget. \
+                    ".format(mGenome.MAX_SEGMENT_LEN))
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="The number of worker processes to use. \
+                    The segments of each chromosome (or of a single \
+                    region) are processed in parallel, while a file of \
+                    regions provided via '-r' is processed in batches, \
+                    with each worker opening its own handle to the \
+                    genome data archive. The output FASTA file and \
+                    BED tracks are identical to those of a serial run. \
+                    When creating an archive via '-d', its bedGraph tracks \
+                    are instead parsed and validated in parallel.")
+parser.add_argument('--pipeline', nargs='?', type=int,
+                    const=_DEFAULT_PIPELINE_DEPTH,
+                    help="Pipeline the reading, computation, and writing \
+                    (including compression) of the output, such that they \
+                    overlap, using a separate reader and writer thread. \
+                    The stages are connected by queues of the given depth \
+                    (defaults to {}), in segments read in advance and \
+                    writes pending, respectively, which are reported at \
+                    a verbosity of at least 2. Memory use increases with \
+                    the depth. Only applicable without '-j' and to a \
+                    single region or the whole genome.".
+                    format(_DEFAULT_PIPELINE_DEPTH))
+parser.add_argument('--serve', metavar='ADDRESS',
+                    help="Instead of outputting the modified genome, \
+                    keep the genome data archive open and serve region \
+                    requests at the given address: either the path of \
+                    a Unix socket or a local TCP port (\"[HOST:]PORT\"). \
+                    Clients send one region per line, either as for '-r' \
+                    or as BED-like lines, with each batch of requests \
+                    ended by a blank line, and receive one line of \
+                    modified sequence (or of \"ERROR\" and the reason) \
+                    per region, in order. Clients are served concurrently, \
+                    with computed segments cached in memory.")
+parser.add_argument('--serveCacheSize', type=parseMemorySize,
+                    default=_DEFAULT_SERVE_CACHE_SIZE,
+                    help="The size of the in-memory cache of computed \
+                    segments, from which the least recently used \
+                    segments are evicted, when serving regions. \
+                    The default is {}.".format(_DEFAULT_SERVE_CACHE_SIZE))
+parser.add_argument('--cacheDir',
+                    help="Cache computed segments in this directory, \
+                    such that they are reused by subsequent runs \
+                    (or requests) for the same genome data archive and \
+                    parameters (i.e. priority, ambiguity codes, \
+                    intersection, and masking), instead of being read \
+                    and computed again. A directory can be shared by any \
+                    number of archives, parameters, and concurrent runs.")
+parser.add_argument('--cacheSize', type=parseMemorySize,
+                    default=_DEFAULT_DISK_CACHE_SIZE,
+                    help="The size of the segment cache directory, from \
+                    which the least recently used segments are evicted. \
+                    The default is {}.".format(_DEFAULT_DISK_CACHE_SIZE))
+parser.add_argument('--metrics', metavar='FILE',
+                    help="Write the metrics of the run to the given file, \
+                    as JSON: the (wall-clock) seconds spent in each stage \
+                    ({}), summed across threads and processes, the bases \
+                    and segments output and the segment cache hits and \
+                    misses of each chromosome, and their totals, and the \
+                    throughput, in bases per second. Compression is timed \
+                    separately from the writing of the compressed output, \
+                    except for BED tracks indexed via '--indexBED'.".
+                    format(', '.join(_METRIC_STAGES)))
 parser.add_argument('-v', '--verbose', help="increase output verbosity",
                     action="count")
 parser.add_argument('-V', '--version', action='version',
@@ -645,15 +1741,82 @@ if args.onlyBED and args.fastaFile:
             since an output FASTA path was provided.""")
 
 if not args.archiveCompDirs and (args.archiveOutDir or args.archiveOutName !=
-                                 _DEFAULT_ARCHIVE_NAME):
-    warn("""Neither the output directory nor the output name of a
-            genome archive are applicable, because an archive
-            is not being created.""")
+                                 _DEFAULT_ARCHIVE_NAME or args.rebuildArchive):
+    warn("""Neither the output directory, the output name, nor the
+            rebuilding of a genome archive are applicable, because
+            an archive is not being created.""")
+
+if args.lineWidth is not None and args.lineWidth < 1:
+    die("The line width must be a positive integer.")
+
+if args.jobs < 1:
+    die("The number of jobs must be a positive integer.")
+
+if args.pipeline is not None:
+    if args.pipeline < 1:
+        die("The pipeline depth must be a positive integer.")
+    if args.jobs > 1:
+        warn("""The request to pipeline the output has been ignored,
+                since multiple jobs were requested.""")
+        args.pipeline = None
+
+if args.minAgreeingTracks is not None:
+    if args.minAgreeingTracks < 1:
+        die("""The minimum number of agreeing tracks must be
+               a positive integer.""")
+    if not args.intersection:
+        warn("""The minimum number of agreeing tracks has been ignored,
+                since an intersection was not requested.
+                Specify '-I' with '-k' to use it.""")
+        args.minAgreeingTracks = None
+
+if args.indexFASTA and not args.fastaFile and (args.region or
+                                               args.randomRegion):
+    warn("""The request to index the FASTA output has been ignored,
+            since it is output to STDOUT.""")
+    args.indexFASTA = False
+
+if (args.fastaFile and args.fastaFile.endswith(cUtils.SUFFIX_PACKED) and
+        args.indexFASTA):
+    warn("""The request to index the FASTA output has been ignored,
+            since the packed output is always indexed.""")
+    args.indexFASTA = False
+
+if args.compressionThreads < 1:
+    die("The number of compression threads must be a positive integer.")
+
+if args.suppressBED and args.indexBED:
+    warn("""The request to index the BED tracks has been ignored, since
+            BED output has been suppressed.""")
 
 if args.suppressBED and args.BEDOutDir:
     warn("""The directory provided for BED output has been ignored, since
             BED output has been suppressed.""")
 
+if args.serve:
+    if (args.region or args.randomRegion or args.fastaFile or args.onlyBED or
+            args.jobs > 1 or args.pipeline):
+        warn("""Output options (i.e. '-r', '-R', '-f', '-B', '-j', and
+                '--pipeline') have been ignored, since region requests
+                are being served.""")
+    # Only modified sequences are served, so no other output is opened.
+    args.suppressBED = True
+    args.indexFASTA = False
+    args.fastaFile = None
+    args.pipeline = None
+
+if args.callIndex and (args.direct or args.maskAllUnsetRegions):
+    warn("""The request to use a call index has been ignored, since the
+            genome is read directly or all unset regions are masked.""")
+    args.callIndex = False
+
+if (args.metrics and
+        not os.path.isdir(os.path.dirname(os.path.abspath(args.metrics)))):
+    die("The directory of the metrics file does not exist.")
+
+if args.cacheSize < 1 or args.serveCacheSize < 1:
+    die("The size of a segment cache must be positive.")
+
 if args.alterIncludedChromosomes:
     _modifychrmExclusionRegex(args.alterIncludedChromosomes)
 # NB: Ensure to update this to include all arguments in the ambigModUsage group
@@ -670,8 +1833,6 @@ for k in [args.fC, args.mh, args.fc]:
 v_print_timestamp(args.verbose, "Using the following ambiguity map: " +
                   str(ambigMap) + ".", 2)
 
-from genomedata import Genome, load_genomedata
-
 genomeDataArchiveFullname = ""
 if args.archiveCompDirs:
     # Create the archive in the directory of the track files
@@ -685,92 +1846,58 @@ if args.archiveCompDirs:
     # Create the genome data archive
     # Load all supported track files in the tracks directory
     # Load all FASTA files in the sequences directory
-    # TODO this could be generalized and could be made less redundant
-    FASTA_file_list = glob.glob(args.archiveCompDirs[0] + "/*.fa") or \
-        glob.glob(args.archiveCompDirs[0] + "/*.fa.gz")
-    if not FASTA_file_list:
-        FASTA_file_list = glob.glob(args.archiveCompDirs[0] + "/*.mask") or \
-            glob.glob(args.archiveCompDirs[0] + "/*.mask.gz")
-        v_print_timestamp(args.verbose, """Detected that a repeat masked
-                          genome is being used for archive creation.""")
-    if not FASTA_file_list:
-        die("Unable to locate FASTA input files for archive creation.")
-    load_genomedata.load_genomedata(
-        genomeDataArchiveFullname,
-        # args.archiveCompDirs[1] is either a directory of tracks
-        # or is the full path to a single track.
-        # TODO check for a valid track path, that actually
-        #      contains tracks, otherwise throw an error.
-        # NB: the tracks parameter must be a *list of pair(s)*,
-        #     specifying: (track name, track/directory path).
-        tracks=([(os.path.basename(args.archiveCompDirs[1]),
-                  args.archiveCompDirs[1])]
-                if os.path.isfile(args.archiveCompDirs[1]) and
-                re.search(SUPPORTED_FORMATS_REGEX, args.archiveCompDirs[1])
-                else [(track, args.archiveCompDirs[1] + track)
-                for track in os.listdir(args.archiveCompDirs[1])
-                if re.search(SUPPORTED_FORMATS_REGEX, track)]),
-        # args.archiveCompDirs[0] contains the directory with all FASTAs
-        seqfilenames=FASTA_file_list, verbose=args.verbose)
-
+    createArchive(genomeDataArchiveFullname,
+                  findTrackFiles(args.archiveCompDirs[1]),
+                  findSequenceFiles(args.archiveCompDirs[0]),
+                  args.rebuildArchive, args.jobs)
+elif args.direct:
+    v_print_timestamp(args.verbose, """Reading the genome and tracks
+                      directly, without a genomedata archive.""")
 else:
     v_print_timestamp(args.verbose, "Using existing genomedata archive.")
     genomeDataArchiveFullname = args.genomeDataArchiveFullname
 
-with Genome(genomeDataArchiveFullname) as genome:
-    warnings.simplefilter("ignore")  # Ignore supercontig warnings
+warnings.simplefilter("ignore")  # Ignore supercontig warnings
+try:
+    if args.direct:
+        modGenome = dGenome.DirectModifiedGenome(
+            findSequenceFiles(args.direct[0]), findTrackFiles(args.direct[1]),
+            args.priority, ambigMap, args.intersection,
+            args.minAgreeingTracks, args.maskRegions,
+            args.maskAllUnsetRegions, args.memoryBudget, jobs=args.jobs)
+    else:
+        modGenome = mGenome.ModifiedGenome(genomeDataArchiveFullname,
+                                           args.priority, ambigMap,
+                                           args.intersection,
+                                           args.minAgreeingTracks,
+                                           args.maskRegions,
+                                           args.maskAllUnsetRegions,
+                                           args.memoryBudget)
+except ValueError as e:
+    die(str(e))
+if args.callIndex:
+    modGenome.callIndex = loadCallIndex(genomeDataArchiveFullname,
+                                        modGenome.genome)
+if args.metrics:
+    _metrics = modGenome.metrics = cUtils.RunMetrics(_METRIC_STAGES)
+if args.cacheDir:
+    modGenome.cache = mGenome.DiskSegmentCache(args.cacheDir, args.cacheSize,
+                                               modGenome.getCacheNamespace())
+if args.serve:
+    modGenome.cache = mGenome.MemorySegmentCache(args.serveCacheSize,
+                                                 modGenome.cache)
+
+with modGenome:
+    genome = modGenome.genome
     v_print_timestamp(args.verbose, "Genomedata archive successfully loaded.")
 
-    maskRegionTName = ''
-    modBases = []
-    modOrder = []
+    modBases = modGenome.modBases
     tnames = {}
 
-    for track in genome.tracknames_continuous:
-        if _MASK_TNAME in str(track):
-            if args.maskRegions is not None:
-                modBases.append(cUtils.MASK_BASE)
-
-                tnames[_MASK_TNAME] = track
-                maskRegionTName = track
-            else:
-                warn("""Genomedata archive contains a mask track, but
-                        '-M' was not given.
-                        Masking will not be performed.""")
-        else:
-            trackToBase = {covalent_mod_base for
-                           covalent_mod, covalent_mod_base in
-                           cUtils.COVALENT_MOD_BASES_TO_BASE_MAP.iteritems()
-                           if covalent_mod in track}.pop()
-            if trackToBase:  # add a regular or ambigous modified base track
-                modBases.append(trackToBase)
-            else:
-                warn("Unrecognized track " + track + " has been ignored.")
-    if args.maskRegions is not None and _MASK_TNAME not in tnames:
-        die("""Masking of genome regions requires the generation of a
-               Genomedata archive containing a mask track.""")
-
-    # For modOrder, lowest numbers have higher priority (i.e. 0 is highest).
-    for i, base in enumerate(modBases):  # get rel. ordering
-        modOrder += [(args.priority.index(base) if args.intersection
-                      # in else, no int., so ensure unique orders
-                      #
-                      # take fourth power to ensure priority always
-                      # outweighs index and overcomes similar priorities
-                      # to ensure unique orders
-                      else i + (args.priority.index(base) + 1)**4)]
-
-    # Get absolute (index-based) ordering from the relative ordering.
-    modOrder = [sorted(modOrder).index(x) for x in modOrder]
-
     addtl_mask_msg = ""
     if args.maskRegions is not None:
         addtl_mask_msg = """All loci implicated by the mask will be masked
                             irrespective of any mods at those loci."""
-
-        # Masked bases are assigned the highest priority (mask all others).
-        modOrder = [order + 1 for order in modOrder]
-        modOrder[modBases.index(cUtils.MASK_BASE)] = 0
     elif args.maskAllUnsetRegions:
         addtl_mask_msg = """All loci with missing data will be masked."""
         # No priority assigned, since this masking is performed separately.
@@ -782,9 +1909,24 @@ with Genome(genomeDataArchiveFullname) as genome:
                       modifications (from highest to lowest) is: """ +
                       ','.join(list(args.priority)) + ".")
 
-    # Before computing modified bases in blocks, remove any existing BED files
-    # and write the tracks' headers.
+    for trackIdxs, minCalls in modGenome.trackGroups:
+        if len(trackIdxs) > 1:
+            v_print_timestamp(args.verbose, """Intersecting {} tracks for
+                              base '{}', requiring {} of them to agree.""".
+                              format(len(trackIdxs),
+                                     modBases[trackIdxs[0]], minCalls))
+
+    v_print_timestamp(args.verbose, """Computing the modified genome in
+                      segments of {} bases, for {} tracks,
+                      aligned to archive chunks of {} bases.""".
+                      format(modGenome.segmentLen,
+                             genome.num_tracks_continuous,
+                             modGenome.chunkLen))
+
+    # Before computing modified bases in blocks, open the BED tracks,
+    # replacing any existing BED files, and write the tracks' headers.
     # Also, store the tracks' names, keyed by modified base, for future use.
+    BEDTracks = {}
     if not args.suppressBED:
         trackID = os.path.splitext(os.path.basename(args.fastaFile
                                    or _DEFAULT_FASTA_FILENAME))[0]
@@ -794,57 +1936,109 @@ with Genome(genomeDataArchiveFullname) as genome:
             trackFileName = "{}/track-{}{}.bed.gz".\
                 format(args.BEDOutDir, trackID, base)
             tnames[base] = trackFileName
-            # 'EAFP' way of removing any existing old tracks
-            try:
-                os.remove(trackFileName)
-            except OSError:
-                pass
-            with gzip.open(trackFileName, 'ab') as BEDTrack:
-                BEDTrack.write(getTrackHeader(base))
-
-    if args.region or args.randomRegion:
-        if args.randomRegion:  # Random region
-            chrms, starts, ends = selectRandomRegion(genome, args.randomRegion)
-            regions = np.matrix([chrms, starts, ends])
-        elif os.path.isfile(args.region):  # 'BED-like' set of regions
-            import pybedtools
-            # NB: In pybedtools, all regions behave as if they are 0-based,
-            # despite non-BED files being 1-based. Thus, we do not need to
-            # alter any code in our program.
-            BEDTool = pybedtools.BedTool(args.region)
-            # generate regions, only including the appropriate chromosomes
-            regions = np.matrix([[interval['chrom'], interval['start'],
-                                interval['end']] for interval in BEDTool
-                                if not re.search(CHROMOSOME_EXCLUSION_REGEX,
-                                                 interval['chrom'])])
-        else:  # A single, specific, region ('genome browser-like')
-            chrms, starts, ends = parseRegion(genome, args.region)
-            regions = np.matrix([chrms, starts, ends])
-        for i in xrange(0, len(regions.flat), 3):
-            chrm, start, end = regions.flat[i], int(regions.flat[i + 1]), \
-                int(regions.flat[i + 2])
-            if args.centeredRegion:
-                centre = int(math.floor((start + end) / 2))
-                start = int(centre - args.centeredRegion / 2)
-                if start < 0:
-                    start = 0
-                end = int(centre + args.centeredRegion / 2)
-                if end > int(genome[chrm].end):
-                    end = int(genome[chrm].end)
-            regionStr = chrm + ":" + str(start) + "-" + str(end)
+        BEDTracks = openBEDTracks(tnames, args.indexBED)
+
+    if args.pipeline:
+        # All output is written (and compressed) by a separate thread,
+        # with the tracks being flushed by that thread as they are closed.
+        _pipelineWriter = cUtils.QueuedWriter(args.pipeline)
+        BEDTracks = {base: _pipelineWriter.wrap(BEDTrack)
+                     for base, BEDTrack in BEDTracks.iteritems()}
+
+    if args.fastaFile and args.fastaFile.endswith(cUtils.SUFFIX_PACKED):
+        # The packed genome remains open throughout, with its index
+        # being written upon its closure, once all records are output.
+        _openModGenomeFile = timeOutputFile(
+            cUtils.PackedGenomeWriter(args.fastaFile), True)
+    elif args.indexFASTA:
+        # The indexed FASTA file remains open throughout, with its
+        # index being written upon its closure, once all records are output.
+        _openModGenomeFile = timeOutputFile(
+            cUtils.IndexedFASTAWriter(args.fastaFile or
+                                      _DEFAULT_FASTA_FILENAME,
+                                      args.compressionThreads),
+            (args.fastaFile or '').endswith(cUtils.SUFFIX_GZ))
+
+    if args.serve:
+        serveRegions(modGenome, args.serve)
+    elif args.region or args.randomRegion:
+        chrmNames = []
+        if args.region and os.path.isfile(args.region):
+            # 'BED-like' set of regions, only including the appropriate
+            # chromosomes, which is streamed in typed batches
+            regionBatches = iterRegionFileBatches(args.region, chrmNames)
+        else:
+            if args.randomRegion:  # Random region
+                chrm, start, end = selectRandomRegion(genome,
+                                                      args.randomRegion)
+            else:  # A single, specific, region ('genome browser-like')
+                chrm, start, end = parseRegion(genome, args.region)
+            chrmNames.append(chrm)
+            regionBatches = [(np.zeros(1, dtype=np.intp),
+                              np.array([start], dtype=np.int64),
+                              np.array([end], dtype=np.int64))]
+        regionCoords = iterRegionCoords(genome, regionBatches, chrmNames,
+                                        args.centeredRegion)
+
+        if args.region and os.path.isfile(args.region):
+            if args.jobs > 1:
+                v_print_timestamp(args.verbose, """Outputting the modified
+                                  genome using {} processes.""".
+                                  format(args.jobs))
+            generateRegions(args.fastaFile, modGenome, regionCoords,
+                            args.jobs, args.onlyBED and not args.fastaFile,
+                            args.suppressBED, BEDTracks, args.lineWidth)
+        elif args.jobs > 1:  # a single region, in parallel segments
             v_print_timestamp(args.verbose, """Outputting the modified
-                              genome for: """ + regionStr + ".")
-            if args.fastaFile:
-                generateFASTAFile(args.fastaFile, regionStr, genome, modOrder,
-                                  chrm, start, end, args.suppressBED, tnames,
-                                  ambigMap, args.maskRegions,
-                                  maskRegionTName, args.maskAllUnsetRegions)
-            else:
-                print(getModifiedGenome(genome, modOrder, chrm, start, end,
-                                        args.onlyBED, args.suppressBED,
-                                        tnames, ambigMap,
-                                        args.maskRegions, maskRegionTName,
-                                        args.maskAllUnsetRegions))
+                              genome using {} processes.""".
+                              format(args.jobs))
+            generateFASTAInParallel(args.fastaFile, modGenome,
+                                    [((regionChrm + ":" + str(regionStart) +
+                                       "-" + str(regionEnd))
+                                      if args.fastaFile else None,
+                                      regionChrm, regionStart, regionEnd)
+                                     for regionChrm, regionStart, regionEnd
+                                     in regionCoords],
+                                    args.jobs,
+                                    args.onlyBED and not args.fastaFile,
+                                    args.suppressBED, BEDTracks,
+                                    args.lineWidth)
+        else:  # a single region, which is output directly
+            for chrm, start, end in regionCoords:
+                regionStr = chrm + ":" + str(start) + "-" + str(end)
+                v_print_timestamp(args.verbose, """Outputting the modified
+                                  genome for: """ + regionStr + ".")
+                if args.fastaFile:
+                    generateFASTAFile(args.fastaFile, regionStr, modGenome,
+                                      chrm, start, end, args.suppressBED,
+                                      BEDTracks, args.lineWidth)
+                else:
+                    segments = iterModifiedGenome(modGenome, chrm, start,
+                                                  end, args.onlyBED,
+                                                  args.suppressBED,
+                                                  BEDTracks)
+                    if args.lineWidth:
+                        segments = wrapSequence(segments, args.lineWidth)
+                    output = timeOutputFile(sys.stdout)
+                    output = (_pipelineWriter.wrap(output)
+                              if _pipelineWriter else output)
+                    for segment in segments:
+                        output.write(segment)
+                    output.write("\n")
+                    output.flush()
+    elif args.jobs > 1:
+        v_print_timestamp(args.verbose, """Outputting the modified
+                          genome using {} processes.""".format(args.jobs))
+        generateFASTAInParallel(args.fastaFile or _DEFAULT_FASTA_FILENAME,
+                                modGenome, [(chromosome.name, chromosome.name,
+                                             int(chromosome.start),
+                                             int(chromosome.end))
+                                            for chromosome in genome
+                                            if not re.search(
+                                                CHROMOSOME_EXCLUSION_REGEX,
+                                                chromosome.name)],
+                                args.jobs, False, args.suppressBED,
+                                BEDTracks, args.lineWidth)
     else:
         for chromosome in [chromosome for chromosome in genome
                            if not re.search(CHROMOSOME_EXCLUSION_REGEX,
@@ -852,10 +2046,20 @@ with Genome(genomeDataArchiveFullname) as genome:
             v_print_timestamp(args.verbose, """Outputting the modified
                               genome for: """ + chromosome.name)
             generateFASTAFile(args.fastaFile or _DEFAULT_FASTA_FILENAME,
-                              chromosome.name, genome, modOrder,
-                              chromosome.name, int(chromosome.start),
-                              int(chromosome.end), args.suppressBED, tnames,
-                              ambigMap, args.maskRegions, maskRegionTName,
-                              args.maskAllUnsetRegions)
+                              chromosome.name, modGenome, chromosome.name,
+                              int(chromosome.start), int(chromosome.end),
+                              args.suppressBED, BEDTracks, args.lineWidth)
+
+    if _openModGenomeFile:
+        v_print_timestamp(args.verbose, "Indexing the modified genome output.")
+        _openModGenomeFile.close()
+    closeBEDTracks(BEDTracks, tnames, args.indexBED)
+
+if _metrics:
+    _metrics.write(args.metrics, version=_METRICS_VERSION,
+                   cytomodVersion=__version__, arguments=sys.argv[1:],
+                   jobs=args.jobs, segmentLength=modGenome.segmentLen)
+    v_print_timestamp(args.verbose, "Wrote the metrics of the run to {}.".
+                      format(args.metrics))
 
 v_print_timestamp(args.verbose, "Program complete.")
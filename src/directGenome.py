@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+"""Reads a genome directly from its (optionally gzipped) FASTA files and
+bedGraph tracks, rather than from a Genomedata archive, such that the
+modified genome of a one-off run is computed without creating an archive:
+
+    with DirectModifiedGenome(seqFilenames, tracks, maskRegions=0) \\
+            as modGenome:
+        seq = modGenome.fetch('chrY', 1000000, 1000500)
+
+The genome has the same sequence and track data as an archive created
+from the same files, including Genomedata's supercontigs, outside of which
+the sequence is unknown (i.e. 'N') and the tracks have no data.
+Each track is first parsed into its intervals for each chromosome
+(see archiveTracks), which are then swept, for each segment, along with
+the sequence of the chromosome, which is read once it is first used.
+
+Exports:
+
+Objects:
+
+DirectGenome               - Genome read directly from FASTA and bedGraphs.
+DirectModifiedGenome       - The modified genome of a DirectGenome.
+
+Constants:
+
+MIN_GAP_LEN                - Shortest gap that separates supercontigs.
+
+Functions:
+
+iterFASTARecords           - Parse the records of a FASTA file.
+readFASTASequence          - Read the sequence of a single FASTA record.
+getSupercontigBounds       - The supercontigs of a chromosome's sequence.
+"""
+
+from __future__ import with_statement, division, print_function
+
+import copy
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import archiveTracks as aTracks
+import cytoUtils as cUtils
+import modifiedGenome as mGenome
+
+__version__ = cUtils.__version__
+
+# as for Genomedata, the shortest run of unknown (i.e. not unambiguous)
+# bases that is a gap between supercontigs
+MIN_GAP_LEN = 100000
+# whether each byte value of a sequence is an unknown base
+_UNKNOWN_BASE_TABLE = np.ones(256, dtype=bool)
+_UNKNOWN_BASE_TABLE[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] = False
+
+
+def iterFASTARecords(filename):
+    """Yields the name and sequence of each record of the given
+    (optionally gzipped) FASTA file, with any whitespace within its
+    name replaced, as Genomedata does, along with the (uncompressed)
+    offset of its sequence within the file (see readFASTASequence).
+    """
+    name, lines, offset, seqOffset = None, [], 0, None
+    with cUtils.maybe_gzip_open(filename) as FASTAFile:
+        for line in FASTAFile:
+            offset += len(line)
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(lines), seqOffset
+                name, lines = '_'.join(line[1:].split()), []
+                seqOffset = offset
+            elif name is None:
+                if line.strip():
+                    raise ValueError("The FASTA file {} does not start with "
+                                     "a definition line.".format(filename))
+            else:
+                lines.append(line.rstrip())
+    if name is not None:
+        yield name, ''.join(lines), seqOffset
+
+
+def readFASTASequence(FASTAFile):
+    """Returns the sequence of the FASTA record at the current position of
+    the given open FASTA file (i.e. at the offset of its sequence), which
+    is then positioned at the sequence of the next record, if any.
+    """
+    lines = []
+    for line in iter(FASTAFile.readline, ''):
+        if line.startswith('>'):
+            break
+        lines.append(line.rstrip())
+    return ''.join(lines)
+
+
+def getSupercontigBounds(seq):
+    """Returns the (start, end) coordinates of the supercontigs of the
+    given sequence (a uint8 array of base codes), which are separated by
+    gaps of at least MIN_GAP_LEN unknown bases, as for Genomedata.
+    """
+    # the starts and ends of each run of unknown bases
+    runBounds = np.flatnonzero(np.diff(np.concatenate((
+        [False], _UNKNOWN_BASE_TABLE[seq], [False])).view(np.int8)))
+    runStarts, runEnds = runBounds[::2], runBounds[1::2]
+    gaps = runEnds - runStarts >= MIN_GAP_LEN
+    starts = np.concatenate(([0], runEnds[gaps]))
+    ends = np.concatenate((runStarts[gaps], [seq.size]))
+    return [(int(start), int(end)) for start, end
+            in zip(starts, ends) if end > start]
+
+
+class _DirectSupercontig(object):
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class _DirectSupercontigs(object):
+    def __init__(self, chromosome):
+        self._chromosome = chromosome
+
+    def __getitem__(self, key):
+        """Returns the supercontigs that overlap the given slice."""
+        start = max(key.start, self._chromosome.start)
+        end = min(key.stop, self._chromosome.end)
+        return [supercontig for supercontig in self._chromosome.bounds
+                if start < supercontig.end and end > supercontig.start]
+
+
+class _DirectChromosomeSeq(object):
+    def __init__(self, chromosome):
+        self._chromosome = chromosome
+
+    def __getitem__(self, key):
+        """Returns the sequence of the given slice."""
+        return self._chromosome.genome._getSeq(self._chromosome.name)[key]
+
+
+class _DirectChromosome(object):
+    """A chromosome of a DirectGenome, presenting the subset of
+    the interface of Genomedata's Chromosome that is used.
+    """
+
+    def __init__(self, genome, name, length, bounds):
+        self.genome = genome
+        self.name = name
+        self.start = 0
+        self.end = length
+        self.bounds = [_DirectSupercontig(start, end)
+                       for start, end in bounds]
+
+    @property
+    def supercontigs(self):
+        return _DirectSupercontigs(self)
+
+    @property
+    def seq(self):
+        return _DirectChromosomeSeq(self)
+
+    def __getitem__(self, key):
+        """Returns the (positions x tracks) matrix of the scores of the
+        given tracks (a slice or list of track indices) over the given
+        slice, which have no data (i.e. are NaN) outside of any interval.
+        """
+        baseKey, trackKey = key
+        trackIdxs = (range(self.genome.num_tracks_continuous)[trackKey]
+                     if isinstance(trackKey, slice) else trackKey)
+        start, end = baseKey.start, baseKey.stop
+        scores = np.empty((end - start, len(trackIdxs)), dtype=np.float32)
+        scores.fill(np.nan)
+        trackRecords = self.genome._getTrackRecords(self.name)
+        for supercontig in self.supercontigs[baseKey]:
+            s, e = max(start, supercontig.start), min(end, supercontig.end)
+            for col, trackIdx in enumerate(trackIdxs):
+                aTracks.fillTrackValues(scores[s - start:e - start, col], s,
+                                        *trackRecords[trackIdx])
+        return scores
+
+
+class DirectGenome(object):
+    """A genome read directly from the given (optionally gzipped) FASTA
+    files and (track name, bedGraph filename) pairs, presenting the subset
+    of the interface of Genomedata's Genome that is used.
+    The sequences are scanned (for their supercontigs) upon opening,
+    while the sequence and the intervals of the tracks of a chromosome
+    are only read once it is used, with only those of the last chromosome
+    used being retained. Each sequence is read from its offset within its
+    FASTA file, which is kept open, such that chromosomes that are used
+    in the order of the file (as they are iterated, if all of them are
+    within a single file) are read in a single pass.
+    The tracks are parsed upon opening (see archiveTracks.parseBedGraph),
+    using the given number of worker processes, which, if there are
+    several, parse them while the sequences are scanned.
+    Raises ValueError if any file is invalid.
+    """
+
+    def __init__(self, seqFilenames, tracks, jobs=1):
+        self.tracknames_continuous = [trackName for trackName, _ in tracks]
+        self.num_tracks_continuous = len(tracks)
+        for _, trackFilename in tracks:
+            if not aTracks.isBedGraph(trackFilename):
+                raise ValueError("Only bedGraph tracks can be read "
+                                 "directly, which {} is not.".
+                                 format(trackFilename))
+        self._ownerPID = os.getpid()
+        self._openSeqFile = (None, None)  # the FASTA file last read
+        self._parsedTracksDir = tempfile.mkdtemp(prefix='cytomod.tracks.')
+        self._loadedTrackRecords = (None, None)
+        pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        try:
+            parseArgs = [(trackFilename,
+                          os.path.join(self._parsedTracksDir, str(trackIdx)))
+                         for trackIdx, (_, trackFilename) in enumerate(tracks)]
+            if pool:  # the tracks are parsed while the sequences are scanned
+                parsedTracks = [pool.apply_async(aTracks.parseBedGraph, args)
+                                for args in parseArgs]
+                pool.close()
+            else:
+                parsedTracks = [aTracks.parseBedGraph(*args)
+                                for args in parseArgs]
+            self._scanSequences(seqFilenames)
+            # the parsed files of each track (see archiveTracks.parseBedGraph)
+            self._parsedTracks = [parsedTrack.get() if pool else parsedTrack
+                                  for parsedTrack in parsedTracks]
+        except:
+            self.close()
+            raise
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def _scanSequences(self, seqFilenames):
+        """Scans the given FASTA files for the length and supercontigs
+        of each of their chromosomes.
+        """
+        # the FASTA file of each chromosome and the offset of its sequence
+        self._seqFiles = {}
+        self._chromosomes = {}
+        self._fileOrder = []  # the names of the chromosomes, as scanned
+        name, seq, bounds = None, None, None
+        for seqFilename in seqFilenames:
+            for name, seq, seqOffset in iterFASTARecords(seqFilename):
+                if name in self._chromosomes:
+                    raise ValueError("The chromosome {} is duplicated.".
+                                     format(name))
+                seq = np.frombuffer(seq, dtype=np.uint8)
+                bounds = getSupercontigBounds(seq)
+                self._seqFiles[name] = (seqFilename, seqOffset)
+                self._chromosomes[name] = _DirectChromosome(self, name,
+                                                            seq.size, bounds)
+                self._fileOrder.append(name)
+        # The last chromosome scanned is retained, as if it had been used.
+        self._loadedSeq = ((name, self._maskGaps(seq, bounds))
+                           if name else (None, None))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        """Yields each chromosome, in the order of its FASTA file, if all of
+        them are within a single file, such that the file is read in a
+        single pass, and otherwise in sorted order (as for a directory
+        archive).
+        """
+        if len(set(seqFilename for seqFilename, _
+                   in self._seqFiles.itervalues())) == 1:
+            names = self._fileOrder
+        else:
+            names = sorted(self._chromosomes)
+        for name in names:
+            yield self._chromosomes[name]
+
+    def __getitem__(self, name):
+        try:
+            return self._chromosomes[name]
+        except KeyError:
+            raise KeyError("Could not find chromosome: " + name)
+
+    def __contains__(self, name):
+        return name in self._chromosomes
+
+    def close(self):
+        """Closes the FASTA file last read and removes the tracks parsed
+        upon opening.
+        """
+        if self._openSeqFile[1]:
+            self._openSeqFile[1].close()
+            self._openSeqFile = (None, None)
+        if self._parsedTracksDir and os.getpid() == self._ownerPID:
+            shutil.rmtree(self._parsedTracksDir, ignore_errors=True)
+            self._parsedTracksDir = None
+
+    def reopen(self):
+        """Returns a copy of this genome, for use by another process, which
+        opens its own FASTA files, since the position of an open file would
+        otherwise be shared with this process.
+        """
+        reopened = copy.copy(self)
+        reopened._openSeqFile = (None, None)
+        return reopened
+
+    @staticmethod
+    def _maskGaps(seq, bounds):
+        """Returns a copy of the given sequence in which all bases outside
+        of the given supercontigs are unknown (i.e. 'N').
+        """
+        maskedSeq = np.empty_like(seq)
+        maskedSeq.fill(ord('N'))
+        for start, end in bounds:
+            maskedSeq[start:end] = seq[start:end]
+        return maskedSeq
+
+    def _getSeq(self, name):
+        """Returns the sequence of the given chromosome, reading it if it
+        is not the last chromosome whose sequence was used.
+        """
+        if self._loadedSeq[0] != name:
+            self._loadedSeq = (None, None)  # such that only one is retained
+            seqFilename, seqOffset = self._seqFiles[name]
+            openFilename, FASTAFile = self._openSeqFile
+            # The open file is only reused to read forwards, since seeking
+            # backwards within a gzipped file decompresses it from its start.
+            if openFilename != seqFilename or FASTAFile.tell() > seqOffset:
+                if FASTAFile:
+                    FASTAFile.close()
+                FASTAFile = cUtils.maybe_gzip_open(seqFilename)
+                self._openSeqFile = (seqFilename, FASTAFile)
+            FASTAFile.seek(seqOffset)
+            seq = readFASTASequence(FASTAFile)
+            self._loadedSeq = (name, self._maskGaps(
+                np.frombuffer(seq, dtype=np.uint8),
+                [(supercontig.start, supercontig.end) for supercontig
+                 in self._chromosomes[name].bounds]))
+        return self._loadedSeq[1]
+
+    def _getTrackRecords(self, name):
+        """Returns the records of each track for the given chromosome,
+        along with whether they overlap (see archiveTracks.loadParsedRecords),
+        reading them if it is not the last chromosome whose records were used.
+        """
+        if self._loadedTrackRecords[0] != name:
+            self._loadedTrackRecords = (name, [
+                aTracks.loadParsedRecords(parsedFiles[name])
+                if name in parsedFiles else
+                (np.empty(0, dtype=aTracks.PARSED_RECORD_DTYPE), False)
+                for parsedFiles in self._parsedTracks])
+        return self._loadedTrackRecords[1]
+
+
+class DirectModifiedGenome(mGenome.ModifiedGenome):
+    """The modified genome of the given (optionally gzipped) FASTA files and
+    (track name, bedGraph filename) pairs, which are read directly
+    (see DirectGenome), rather than from an archive, whose tracks
+    are parsed using the given number of jobs (as a keyword argument).
+    All other arguments are as for ModifiedGenome.
+    Raises ValueError if any file is invalid.
+    """
+
+    def __init__(self, seqFilenames, tracks, *args, **kwargs):
+        self._inputs = (seqFilenames, tracks, kwargs.pop('jobs', 1))
+        mGenome.ModifiedGenome.__init__(self, None, *args, **kwargs)
+
+    def _openGenome(self):
+        return DirectGenome(*self._inputs)
+
+    def _getChunkLength(self):
+        return None  # since the tracks are not chunked
+
+    def _getInputPaths(self):
+        seqFilenames, tracks = self._inputs[:2]
+        return [os.path.realpath(filename) for filename in
+                list(seqFilenames) + [filename for _, filename in tracks]]
+
+    def reopen(self):
+        """Returns a copy of this modified genome, which, having no
+        handles to an archive, can be used by another process, once its
+        genome no longer shares any open FASTA file with this process.
+        """
+        reopened = copy.copy(self)
+        reopened.genome = self.genome.reopen()
+        return reopened
@@ -0,0 +1,1079 @@
+#!/usr/bin/env python
+
+"""Computes the modified genome of a Genomedata archive, whose continuous
+tracks denote the locations of modified nucleobases, by replacing
+the appropriate symbols of its reference genome sequence.
+This is the engine of Cytomod, which may also be imported, such that
+a single archive can be kept open across any number of queries:
+
+    with ModifiedGenome(archive, maskRegions=0) as modGenome:
+        seq = modGenome.fetch('chr1', 1000000, 1000500)
+
+Exports:
+
+Objects:
+
+ModifiedGenome             - The modified genome of an open archive.
+MemorySegmentCache         - In-memory LRU cache of computed segments.
+DiskSegmentCache           - Persistent cache of computed segments.
+CallIndex                  - Sparse index of the calls of an archive.
+
+Constants:
+
+DEFAULT_BASE_PRIORITY      - Default priority of the modified bases.
+MASK_TNAME                 - Identifies the mask track of an archive.
+MAX_SEGMENT_LEN            - Longest segment computed at once.
+MIN_SEGMENT_LEN            - Shortest segment, irrespective of memory budget.
+CALL_INDEX_SUFFIX          - Suffix of the call index of an archive.
+
+Functions:
+
+getBaseSubstitutionTables  - Lookup tables of all base substitutions.
+getTrackGroups             - Group tracks of equal priority.
+packTrackStates            - Reduce track scores to packed states.
+getTrackBits               - Unpack the states of a single track.
+resolveTrackGroups         - Resolve the calls of each group of tracks.
+resolveModBasePriority     - Resolve the call of highest priority.
+getSegmentLength           - Segment length for a memory budget.
+getArchiveChunkLength      - Length of the HDF5 chunks of an archive.
+getTrackColumnKey          - Key with which to read the given tracks.
+getValueRuns               - Runs of equal values of a track.
+"""
+
+from __future__ import with_statement, division, print_function
+
+import bisect
+import copy
+import hashlib
+import os
+import tempfile
+import zipfile
+
+from collections import OrderedDict
+
+import numpy as np
+
+import cytoUtils as cUtils
+
+__version__ = cUtils.__version__
+
+# bases ordered by least frequent in our dataset with most ambiguous bases last
+DEFAULT_BASE_PRIORITY = 'fhmc' + ''.join(cUtils.AMBIG_MOD_BASES.keys()[::-1])
+MASK_TNAME = 'MASK'
+# the length of the segments in which the modified genome is computed,
+# unless a memory budget is provided
+MAX_SEGMENT_LEN = 2000000
+# the shortest segment used, irrespective of any memory budget
+MIN_SEGMENT_LEN = 10000
+# estimated working set, in bytes, per base of a segment, for each track
+# (float32 scores, as read, and the Boolean temporaries from which their
+# packed states are computed, which is all that is retained of them)
+# and for the sequence buffers and index arrays, irrespective of track count
+_BYTES_PER_BASE_PER_TRACK = 14
+_BYTES_PER_BASE = 64
+# byte translation table, used to uppercase reference sequence buffers
+_UPPERCASE_TABLE = np.array([ord(chr(code).upper()) for code in xrange(256)],
+                            dtype=np.uint8)
+# the version of the cached segments' representation, which is part of their
+# namespace, such that segments cached by other versions are never used
+_CACHE_FORMAT_VERSION = 1
+_SUFFIX_CACHED_SEGMENT = '.npz'
+# the call index of an archive is stored alongside it, with this suffix
+CALL_INDEX_SUFFIX = '.calls.npz'
+# the version of the call index's representation, such that an index
+# written by another version is rebuilt
+_CALL_INDEX_FORMAT_VERSION = 1
+
+
+def warn(msg):
+    cUtils.warn(msg, os.path.basename(__file__))
+
+
+def _maybeGetAmbigMapping(base, ambigMap):
+    """Maps the given base to its ambiguous base, if possible."""
+    return (ambigMap.get(base) or
+            (cUtils.complement(ambigMap.get(cUtils.complement(base)))
+            if ambigMap.get(cUtils.complement(base)) else None) or base)
+
+
+def _maybeGetModBase(m, r, ambigMap):
+    """Returns the modified base corresponding to
+    the given putatively modified base (m). The base returned
+    is the input putatively modified base if the corresponding
+    reference base (r) is modifiable to the input base, or the
+    complement of that base, if the complemented reference is
+    modifiable to it, otherwise the reference base (r) itself
+    is returned. This function also maps modified bases to any
+    applicable ambiguity codes that are provided in ambigMap.
+    """
+    m = ambigMap.get(m) or m  # maybe map to an ambiguous base
+    if m not in cUtils.MOD_MAP:
+        return ambigMap.get(r) or r
+    else:
+        if cUtils.MOD_MAP[m] == r:
+            return m
+        elif cUtils.MOD_MAP[m] == cUtils.complement(r)[0]:
+            return cUtils.complement(m)[0]
+        else:
+            return ambigMap.get(r) or r
+
+
+def getBaseSubstitutionTables(modBases, ambigMap):
+    """Returns a pair of lookup tables, precomputing the result of
+    _maybeGetModBase and _maybeGetAmbigMapping for every base
+    that could be encountered, such that bases can be substituted
+    via array indexing alone.
+    The first table is indexed by (modified base code, reference base code)
+    and the second by the reference base code alone, where each code is
+    the byte value of the respective base.
+    Rows of the first table for bases that are never used as putatively
+    modified bases (i.e. neither in modBases nor the mask base) are left
+    as the identity on the reference base.
+    """
+    allCodes = np.arange(256, dtype=np.uint8)
+    modBaseTable = np.tile(allCodes, (256, 1))
+    for m in set(modBases + [cUtils.MASK_BASE]):
+        modBaseTable[ord(m)] = [ord(_maybeGetModBase(m, chr(r), ambigMap))
+                                for r in allCodes]
+    unmodBaseTable = np.array([ord(_maybeGetAmbigMapping(chr(r), ambigMap))
+                               for r in allCodes], dtype=np.uint8)
+    return modBaseTable, unmodBaseTable
+
+
+def getTrackGroups(modOrder, minAgreeingTracks=None):
+    """Groups the tracks by their order, from highest to lowest priority,
+    such that tracks of equal order (i.e. duplicate tracks of a single
+    modification type, when taking their intersection) form a group.
+    Returns a list containing, for each group, an array of its tracks'
+    indices and the number of its tracks that must call a base for
+    the group to call it. This is all of them, unless fewer are
+    given as the minimum number of agreeing tracks (i.e. k-of-n agreement).
+    """
+    trackGroups = []
+    for order in sorted(set(modOrder)):
+        trackIdxs = np.array([trackIdx for trackIdx, trackOrder in
+                              enumerate(modOrder) if trackOrder == order],
+                             dtype=np.intp)
+        trackGroups.append((trackIdxs,
+                            min(len(trackIdxs), minAgreeingTracks or
+                                len(trackIdxs))))
+    return trackGroups
+
+
+def packTrackStates(modBaseScores, maskIndex, maskRegionsFileVal):
+    """Reduces the given (positions x tracks) matrix of scores to a
+    2-bit state for each track at each position: no data, zero,
+    or called (i.e. finite and non-zero data or, for the mask track,
+    data that is at most the mask value, such that the base is masked).
+    The states are stored as two Boolean planes, of which tracks have data
+    and of which tracks have a call, each packed (via np.packbits) into
+    (positions x ceil(tracks / 8)) bytes.
+    Returns the packed data and call planes.
+    """
+    hasData = np.isfinite(modBaseScores)
+    calls = modBaseScores != 0
+    calls &= hasData
+    if maskIndex is not None:
+        calls[:, maskIndex] = modBaseScores[:, maskIndex] <= maskRegionsFileVal
+    return np.packbits(hasData, axis=1), np.packbits(calls, axis=1)
+
+
+def getTrackBits(packedBits, trackIdx):
+    """Returns the Boolean column of the given track, for each position,
+    from the given packed plane (see packTrackStates).
+    """
+    return ((packedBits[:, trackIdx >> 3] >> (7 - (trackIdx & 7))) &
+            1).astype(bool)
+
+
+def resolveTrackGroups(packedCalls, trackGroups):
+    """Returns a Boolean matrix of (positions x groups) indicating which
+    groups (see getTrackGroups) have a call at each position, given the
+    packed plane of the tracks' calls (see packTrackStates).
+    A group with a single track has its track's calls, while a group of
+    multiple tracks has a call where sufficiently many of them do.
+    Only the columns of each group's tracks are unpacked, one at a time.
+    """
+    groupCalls = np.empty((packedCalls.shape[0], len(trackGroups)),
+                          dtype=bool)
+    for groupIdx, (trackIdxs, minCalls) in enumerate(trackGroups):
+        groupCall = getTrackBits(packedCalls, trackIdxs[0])
+        if minCalls == len(trackIdxs):  # all (including a single track)
+            for trackIdx in trackIdxs[1:]:
+                groupCall &= getTrackBits(packedCalls, trackIdx)
+        elif minCalls == 1:  # any
+            for trackIdx in trackIdxs[1:]:
+                groupCall |= getTrackBits(packedCalls, trackIdx)
+        else:  # k-of-n
+            numCalls = groupCall.astype(np.uint16)
+            for trackIdx in trackIdxs[1:]:
+                numCalls += getTrackBits(packedCalls, trackIdx)
+            groupCall = numCalls >= minCalls
+        groupCalls[:, groupIdx] = groupCall
+    return groupCalls
+
+
+def resolveModBasePriority(orderedCalls):
+    """Resolves the modification of highest priority at each position,
+    given a Boolean matrix of (positions x tracks) indicating which
+    tracks have a call at each position, with the tracks ordered
+    from highest to lowest priority.
+    Returns the column index of the first track with a call for each
+    position (0 where there are no calls) and a Boolean mask indicating
+    which positions have any call at all.
+    """
+    if orderedCalls.shape[1] == 0:  # no tracks, so nothing is called
+        return (np.zeros(orderedCalls.shape[0], dtype=np.intp),
+                np.zeros(orderedCalls.shape[0], dtype=bool))
+    # argmax returns the first maximal (i.e. True) column of each row
+    firstCall = np.argmax(orderedCalls, axis=1)
+    hasCall = orderedCalls[np.arange(orderedCalls.shape[0]), firstCall]
+    return firstCall, hasCall
+
+
+def getSegmentLength(memoryBudget, numTracks):
+    """Returns the length of the segments in which to compute the
+    modified genome, such that the estimated working set of each segment,
+    given the number of tracks in the archive, fits within the given
+    memory budget (in bytes). The length is never less than
+    MIN_SEGMENT_LEN, even if the budget cannot then be met.
+    """
+    bytesPerBase = numTracks * _BYTES_PER_BASE_PER_TRACK + _BYTES_PER_BASE
+    return max(MIN_SEGMENT_LEN, memoryBudget // bytesPerBase)
+
+
+def getArchiveChunkLength(genome):
+    """Returns the number of bases in each HDF5 chunk of the continuous
+    data of the given archive, as found in its first supercontig that has
+    continuous data, or None if there is no such supercontig.
+    """
+    from tables import NoSuchNodeError
+    for chromosome in genome:
+        for supercontig in chromosome.supercontigs[chromosome.start:
+                                                   chromosome.end]:
+            try:
+                return supercontig.continuous.chunkshape[0]
+            except NoSuchNodeError:
+                continue
+    return None
+
+
+def getTrackColumnKey(trackIdxs):
+    """Returns the key with which to read only the given (ascending)
+    track columns from a chromosome of the archive, or None if there
+    are no such columns. Contiguous columns are read as a single slice,
+    avoiding the copy made when selecting a subset of the columns read.
+    """
+    if not trackIdxs:
+        return None
+    if trackIdxs == range(trackIdxs[0], trackIdxs[-1] + 1):
+        return slice(trackIdxs[0], trackIdxs[-1] + 1)
+    return trackIdxs
+
+
+def getValueRuns(values, isIndexed):
+    """Returns the start and end (relative to the given values of a track)
+    and the value of each run of consecutive positions at which the
+    track has the same value, amongst the positions indicated by
+    the given Boolean mask.
+    """
+    positions = np.flatnonzero(isIndexed)
+    runValues = values[positions]
+    runBreaks = np.flatnonzero((np.diff(positions) != 1) |
+                               (runValues[1:] != runValues[:-1])) + 1
+    runStarts = np.concatenate(([0], runBreaks)).astype(np.intp)
+    runEnds = np.concatenate((runBreaks, [positions.size])).astype(np.intp)
+    if not positions.size:
+        runStarts, runEnds = runStarts[:0], runEnds[:0]
+    return (positions[runStarts], positions[runEnds - 1] + 1,
+            runValues[runStarts])
+
+
+def _expandRuns(starts, ends):
+    """Returns the positions within each of the given (start, end) runs."""
+    lengths = ends - starts
+    return (np.arange(lengths.sum()) +
+            np.repeat(starts - (np.cumsum(lengths) - lengths), lengths))
+
+
+def _getSegmentSize(segment):
+    """Returns the size, in bytes, of the given cached segment."""
+    return sum(array.nbytes for array in segment)
+
+
+class MemorySegmentCache(object):
+    """A bounded, in-memory cache of computed segments, each of which is
+    a pair of its modified sequence and packed Boolean mask of the
+    positions at which any modification (or masking) was called,
+    keyed by its (chromosome, start, end), from which the least recently
+    used segments are evicted, such that their total size is at most
+    the given number of bytes. Segments that are not in the cache are
+    sought in the given backing cache (e.g. a DiskSegmentCache), if any,
+    to which all new segments are also added. The number of hits and
+    misses is recorded.
+    """
+
+    def __init__(self, maxBytes, backingCache=None):
+        self.maxBytes = maxBytes
+        self.backingCache = backingCache
+        self.hits = 0
+        self.misses = 0
+        self._segments = OrderedDict()  # ordered from least recently used
+        self._numBytes = 0
+
+    def get(self, key):
+        """Returns the cached segment of the given key, or None."""
+        segment = self._segments.pop(key, None)
+        if segment is None and self.backingCache is not None:
+            segment = self.backingCache.get(key)
+            if segment is not None:
+                self._numBytes += _getSegmentSize(segment)
+                self._evict()
+        if segment is None:
+            self.misses += 1
+            return None
+        self._segments[key] = segment  # now the most recently used
+        self.hits += 1
+        return segment
+
+    def put(self, key, segment):
+        """Adds the given segment to the cache."""
+        if self.backingCache is not None:
+            self.backingCache.put(key, segment)
+        if key in self._segments:
+            self._numBytes -= _getSegmentSize(self._segments.pop(key))
+        self._segments[key] = segment
+        self._numBytes += _getSegmentSize(segment)
+        self._evict()
+
+    def _evict(self):
+        while self._numBytes > self.maxBytes and self._segments:
+            _, segment = self._segments.popitem(last=False)
+            self._numBytes -= _getSegmentSize(segment)
+
+
+class DiskSegmentCache(object):
+    """A persistent, content-addressed cache of computed segments (see
+    MemorySegmentCache), stored as files within the given directory,
+    from which the least recently used files are evicted, such that
+    their total size is at most the given number of bytes.
+    Each segment's file is named by a hash of its key and of the given
+    namespace, which identifies the archive and the parameters of the
+    modified genome (see ModifiedGenome.getCacheNamespace), such that
+    a directory can be shared by any number of archives and parameters.
+    Files are written atomically, such that a directory can also be
+    shared by concurrent processes, each of which bounds the size of
+    the files that it knows of, with a file removed by another process
+    merely being a miss. The number of hits and misses is recorded.
+    """
+
+    def __init__(self, directory, maxBytes, namespace):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # the size of each cached file, ordered from least recently used
+        # (by modification time, which is updated upon each use)
+        self._files = OrderedDict()
+        cachedFiles = []
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.endswith(_SUFFIX_CACHED_SEGMENT):
+                    path = os.path.join(dirpath, filename)
+                    fileStat = os.stat(path)
+                    cachedFiles.append((fileStat.st_mtime, path,
+                                        fileStat.st_size))
+        for _, path, size in sorted(cachedFiles):
+            self._files[path] = size
+        self._numBytes = sum(self._files.itervalues())
+        self._evict()
+
+    def _getPath(self, key):
+        digest = hashlib.sha1(self.namespace + "{}:{}-{}".
+                              format(*key)).hexdigest()
+        return os.path.join(self.directory, digest[:2],
+                            digest + _SUFFIX_CACHED_SEGMENT)
+
+    def get(self, key):
+        """Returns the cached segment of the given key, or None."""
+        path = self._getPath(key)
+        try:
+            with np.load(path) as segmentFile:
+                segment = (segmentFile['seq'], segmentFile['hasCall'])
+            os.utime(path, None)  # now the most recently used
+            size = os.path.getsize(path)
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+            # not cached, removed by another process, or incomplete
+            self._numBytes -= self._files.pop(path, 0)
+            self.misses += 1
+            return None
+        self._numBytes += size - self._files.pop(path, 0)
+        self._files[path] = size
+        self.hits += 1
+        return segment
+
+    def put(self, key, segment):
+        """Adds the given segment to the cache."""
+        path = self._getPath(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:  # created concurrently, by another process
+                pass
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                         suffix='.tmp',
+                                         delete=False) as segmentFile:
+            np.savez(segmentFile, seq=segment[0], hasCall=segment[1])
+        os.rename(segmentFile.name, path)
+        self._numBytes -= self._files.pop(path, 0)
+        self._files[path] = os.path.getsize(path)
+        self._numBytes += self._files[path]
+        self._evict()
+
+    def _evict(self):
+        while self._numBytes > self.maxBytes and self._files:
+            path, size = self._files.popitem(last=False)
+            self._numBytes -= size
+            try:
+                os.remove(path)
+            except OSError:  # already removed, by another process
+                pass
+
+
+class CallIndex(object):
+    """A sparse index of the calls of each track of a Genomedata archive,
+    such that segments can be computed without reading their track data.
+    For each track and chromosome, the index holds the runs of consecutive
+    positions with the same value, sorted by position, at which the track
+    has a call (i.e. finite and non-zero data) or, for the mask track,
+    at which it has any data, since which bases are masked depends upon
+    the mask value (see packTrackStates).
+    The index is built from an open archive, and is saved alongside it
+    (see getPath), along with a digest of the archive's files, such that
+    an index is only loaded for the archive from which it was built.
+    """
+
+    def __init__(self, archiveDigest, trackNames, runs):
+        self.archiveDigest = archiveDigest
+        self.trackNames = list(trackNames)
+        # the (starts, ends, values) of the runs, by (track name, chromosome)
+        self._runs = runs
+
+    @staticmethod
+    def getPath(archive):
+        """Returns the path of the call index of the given archive."""
+        return os.path.normpath(archive) + CALL_INDEX_SUFFIX
+
+    @staticmethod
+    def getArchiveDigest(archive):
+        """Returns a digest of the name, size and modification time of
+        each of the given archive's files.
+        """
+        return hashlib.sha1(repr((_CALL_INDEX_FORMAT_VERSION,
+                                  cUtils.getFileStats(
+                                      os.path.normpath(archive))))).hexdigest()
+
+    @classmethod
+    def build(cls, genome, archive):
+        """Builds the call index of the given open archive, at the given
+        path, reading each of its supercontigs in turn, in segments.
+        """
+        archiveDigest = cls.getArchiveDigest(archive)
+        trackNames = [str(trackName) for trackName
+                      in genome.tracknames_continuous]
+        trackRuns = [{} for _ in trackNames]
+        for chromosome in genome:
+            chrmRuns = [[] for _ in trackNames]
+            for supercontig in chromosome.supercontigs[chromosome.start:
+                                                       chromosome.end]:
+                for start in xrange(supercontig.start, supercontig.end,
+                                    MAX_SEGMENT_LEN):
+                    end = min(start + MAX_SEGMENT_LEN, supercontig.end)
+                    scores = chromosome[start:end, :]
+                    for trackIdx, trackName in enumerate(trackNames):
+                        values = scores[:, trackIdx]
+                        isIndexed = np.isfinite(values)
+                        if MASK_TNAME not in trackName:
+                            isIndexed &= values != 0
+                        runStarts, runEnds, runValues = \
+                            getValueRuns(values, isIndexed)
+                        chrmRuns[trackIdx].append((runStarts + start,
+                                                   runEnds + start,
+                                                   runValues))
+            for trackIdx, runs in enumerate(chrmRuns):
+                if runs:
+                    trackRuns[trackIdx][chromosome.name] = tuple(
+                        np.concatenate(arrays) for arrays in zip(*runs))
+        return cls(archiveDigest, trackNames,
+                   {(trackName, chrm): runs for trackName, chrmRuns
+                    in zip(trackNames, trackRuns)
+                    for chrm, runs in chrmRuns.iteritems()})
+
+    @classmethod
+    def load(cls, archive):
+        """Loads the call index of the given archive, returning None if it
+        has none, or if its index was built from different files
+        (i.e. the archive has since changed).
+        """
+        try:
+            with np.load(cls.getPath(archive)) as indexFile:
+                archiveDigest = str(indexFile['archiveDigest'])
+                if archiveDigest != cls.getArchiveDigest(archive):
+                    return None
+                keys = zip(indexFile['keyTrackNames'],
+                           indexFile['keyChrms'])
+                offsets = indexFile['offsets']
+                starts, ends, values = (indexFile['starts'],
+                                        indexFile['ends'],
+                                        indexFile['values'])
+                trackNames = list(indexFile['trackNames'])
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+            return None
+        runs = {}
+        for keyIdx, (trackName, chrm) in enumerate(keys):
+            runSlice = slice(offsets[keyIdx], offsets[keyIdx + 1])
+            runs[(str(trackName), str(chrm))] = (starts[runSlice],
+                                                 ends[runSlice],
+                                                 values[runSlice])
+        return cls(archiveDigest, trackNames, runs)
+
+    def save(self, archive):
+        """Saves the call index alongside the given archive. The file is
+        written atomically, such that concurrent runs never see a partial
+        index.
+        """
+        path = self.getPath(archive)
+        keys = sorted(self._runs)
+        runs = [self._runs[key] for key in keys]
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.',
+                                         suffix='.tmp',
+                                         delete=False) as indexFile:
+            np.savez(indexFile, archiveDigest=self.archiveDigest,
+                     trackNames=np.array(self.trackNames, dtype=str),
+                     keyTrackNames=np.array([trackName for trackName, _
+                                             in keys], dtype=str),
+                     keyChrms=np.array([chrm for _, chrm in keys],
+                                       dtype=str),
+                     offsets=np.cumsum([0] + [len(starts) for
+                                              starts, _, _ in runs]),
+                     starts=np.concatenate([np.empty(0, dtype=np.intp)] +
+                                           [starts for starts, _, _
+                                            in runs]),
+                     ends=np.concatenate([np.empty(0, dtype=np.intp)] +
+                                         [ends for _, ends, _ in runs]),
+                     values=np.concatenate([np.empty(0, dtype=np.float32)] +
+                                           [values for _, _, values
+                                            in runs]))
+        os.rename(indexFile.name, path)
+
+    def getNumRuns(self):
+        """Returns the total number of runs in the index."""
+        return sum(len(starts) for starts, _, _ in self._runs.itervalues())
+
+    def getRuns(self, trackName, chrm, start, end):
+        """Returns the starts, ends and values of the runs of the given
+        track within the given region of the given chromosome, sorted by
+        position and clipped to the region.
+        """
+        starts, ends, values = self._runs.get(
+            (trackName, chrm), (np.empty(0, dtype=np.intp),
+                                np.empty(0, dtype=np.intp),
+                                np.empty(0, dtype=np.float32)))
+        # Runs do not overlap, so are sorted by both their start and end.
+        runSlice = slice(np.searchsorted(ends, start, 'right'),
+                         np.searchsorted(starts, end))
+        return (np.maximum(starts[runSlice], start),
+                np.minimum(ends[runSlice], end), values[runSlice])
+
+
+class ModifiedGenome(object):
+    """The modified genome of the given Genomedata archive, which is
+    kept open (as the genome attribute) until the modified genome is
+    closed, such that any number of regions can be computed in-process.
+    Each base is modified by the track of the modified base of highest
+    (given) priority that calls it. If the intersection is requested,
+    duplicate tracks of a modified base instead call a base together,
+    when all of them (or at least the given minimum number of them) do.
+    Unmodified bases are replaced per the given map of bases to
+    ambiguity codes. If a mask value is given (as maskRegions), bases
+    at which the mask track is at most that value are masked,
+    and, if requested, all bases without any data are masked.
+    The modified genome is computed in segments, whose length is
+    bounded by the given memory budget (in bytes), if any.
+    Computed segments are cached by the given cache (e.g. a
+    MemorySegmentCache or DiskSegmentCache), if any, which can also be
+    set (as the cache attribute) once the modified genome is opened.
+    Likewise, segments are read from the given call index of the archive
+    (see CallIndex), if any, rather than from its track data, unless all
+    bases without any data are masked, which requires the track data.
+    The time spent in each stage of computing segments, and the cache
+    hits and misses of each chromosome, are recorded by the given
+    metrics (a cytoUtils.RunMetrics), if any, which can also be set.
+    """
+
+    def __init__(self, archive, priority=DEFAULT_BASE_PRIORITY,
+                 ambigMap=None, intersection=False, minAgreeingTracks=None,
+                 maskRegions=None, maskAllUnsetRegions=False,
+                 memoryBudget=None, cache=None, callIndex=None,
+                 metrics=None):
+        self.filename = archive
+        self.genome = self._openGenome()
+        self.cache = cache
+        self.callIndex = callIndex
+        self.metrics = metrics
+        self.ambigMap = ambigMap or {}
+        self.maskRegions = maskRegions
+        self.maskAllUnsetRegions = maskAllUnsetRegions
+
+        self.modBases = []
+        modTrackIdxs = []  # the archive's track index of each of modBases
+        self.maskTrackName = None
+        for trackIdx, track in enumerate(self.genome.tracknames_continuous):
+            if MASK_TNAME in str(track):
+                if maskRegions is not None:
+                    self.modBases.append(cUtils.MASK_BASE)
+                    modTrackIdxs.append(trackIdx)
+                    self.maskTrackName = track
+                else:
+                    warn("""Genomedata archive contains a mask track, but
+                            masking was not requested (i.e. '-M').
+                            Masking will not be performed.""")
+            else:
+                trackToBase = {covalent_mod_base for
+                               covalent_mod, covalent_mod_base in
+                               cUtils.COVALENT_MOD_BASES_TO_BASE_MAP.
+                               iteritems() if covalent_mod in track}.pop()
+                if trackToBase:  # add a regular or ambigous mod. base track
+                    self.modBases.append(trackToBase)
+                    modTrackIdxs.append(trackIdx)
+                else:
+                    warn("Unrecognized track " + track + " has been ignored.")
+        if maskRegions is not None and self.maskTrackName is None:
+            self.genome.close()
+            raise ValueError("Masking of genome regions requires the "
+                             "generation of a Genomedata archive "
+                             "containing a mask track.")
+        # the column of the mask track, amongst the tracks read
+        self._maskIndex = (self.modBases.index(cUtils.MASK_BASE)
+                           if self.maskTrackName else None)
+        # Only the tracks used are read, via this precomputed column key.
+        self._modTrackKey = getTrackColumnKey(modTrackIdxs)
+        self._modTrackNames = [str(self.genome.tracknames_continuous[trackIdx])
+                               for trackIdx in modTrackIdxs]
+
+        # For modOrder, lowest numbers have higher priority (0 is highest).
+        modOrder = []
+        for i, base in enumerate(self.modBases):  # get rel. ordering
+            modOrder += [(priority.index(base) if intersection
+                          # in else, no int., so ensure unique orders
+                          #
+                          # take fourth power to ensure priority always
+                          # outweighs index and overcomes similar priorities
+                          # to ensure unique orders
+                          else i + (priority.index(base) + 1)**4)]
+        # Get absolute (index-based) ordering from the relative ordering.
+        self.modOrder = [sorted(modOrder).index(x) for x in modOrder]
+        if self.maskTrackName:
+            # Masked bases are assigned the highest priority
+            # (i.e. mask all others).
+            self.modOrder = [order + 1 for order in self.modOrder]
+            self.modOrder[self._maskIndex] = 0
+        # The tracks, grouped by priority, with each group (of duplicate
+        # tracks, for an intersection) resolved as a single track.
+        self.trackGroups = getTrackGroups(self.modOrder, minAgreeingTracks)
+        self._modBaseCodes = np.array([ord(self.modBases[trackIdxs[0]])
+                                       for trackIdxs, _ in self.trackGroups],
+                                      dtype=np.uint8)
+
+        self.segmentLen = MAX_SEGMENT_LEN
+        if memoryBudget:
+            self.segmentLen = getSegmentLength(
+                memoryBudget, self.genome.num_tracks_continuous)
+            if self.segmentLen == MIN_SEGMENT_LEN:
+                warn("""The memory budget provided is too small for the
+                     number of tracks in the archive. The minimum segment
+                     length has been used.""")
+        # the number of bases in each HDF5 chunk of the archive's continuous
+        # data, to which segment boundaries are aligned (None if not known)
+        self.chunkLen = self._getChunkLength()
+
+        # Precompute all base substitutions once, for use in every segment.
+        self._substitutionTables = getBaseSubstitutionTables(self.modBases,
+                                                             self.ambigMap)
+
+        # Segments are cached in blocks of whole chunks (and of at most
+        # the segment length), laid out from the start of each supercontig,
+        # such that any region is composed of the same cached blocks.
+        self._cacheBlockLen = min(self.chunkLen or MIN_SEGMENT_LEN,
+                                  self.segmentLen)
+        self._cacheBlockLayouts = {}  # keyed by chromosome
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _openGenome(self):
+        """Opens the genome (i.e. the archive) of the modified genome."""
+        from genomedata import Genome
+        return Genome(self.filename)
+
+    def _getChunkLength(self):
+        """Returns the length of the chunks of the genome's track data
+        (see getArchiveChunkLength).
+        """
+        return getArchiveChunkLength(self.genome)
+
+    def _getInputPaths(self):
+        """Returns the paths of the inputs of the genome (i.e. the archive),
+        which identify it.
+        """
+        return [os.path.realpath(self.filename)]
+
+    def close(self):
+        """Closes the archive."""
+        self.genome.close()
+
+    def reopen(self):
+        """Returns a copy of this modified genome, with its own handle to
+        the archive, since handles cannot be shared between processes.
+        """
+        reopened = copy.copy(self)
+        reopened.genome = self._openGenome()
+        return reopened
+
+    def iterSegmentBounds(self, chrm, start, end):
+        """Yields the (start, end) coordinates of each segment of the given
+        region, of at most the segment length. Segment boundaries are
+        aligned to whole HDF5 chunks, which are laid out from the start of
+        each supercontig, such that no chunk is read (and decompressed)
+        for more than one segment.
+        """
+        chunkOrigins = [supercontig.start for supercontig
+                        in self.genome[chrm].supercontigs[start:end]]
+        return cUtils.iterChunkAlignedSegments(start, end, self.segmentLen,
+                                               self.chunkLen, chunkOrigins)
+
+    def readSegment(self, chrm, start, end):
+        """Reads the given segment of the given chromosome.
+        Returns the (positions x tracks) matrix of the scores of the tracks
+        in use and the (uppercased) reference sequence, as a byte buffer
+        (a uint8 array of base codes).
+        If the call index is used, the scores are instead the bounds,
+        relative to the segment start, of the intervals within which the
+        tracks' calls do not change, and the (intervals x tracks) Boolean
+        matrix of the tracks' calls within each (see readIndexedCalls).
+        """
+        with cUtils.timedStage(self.metrics, 'archiveRead'):
+            chromosome = self.genome[chrm]
+            if self.callIndex is not None and not self.maskAllUnsetRegions:
+                return (self.readIndexedCalls(chrm, start, end),
+                        _UPPERCASE_TABLE[chromosome.seq[start:end]])
+            # Only read the tracks in use, which correspond to modBases.
+            # An unused mask track is therefore never read.
+            if self._modTrackKey is None:
+                modBaseScores = np.empty((end - start, 0), dtype=np.float32)
+            else:
+                modBaseScores = chromosome[start:end, self._modTrackKey]
+            # The sequence is kept as a byte buffer (of uint8 base codes)
+            # throughout, to avoid creating large arrays of Python strings.
+            return modBaseScores, _UPPERCASE_TABLE[chromosome.seq[start:end]]
+
+    def readIndexedCalls(self, chrm, start, end):
+        """Returns the bounds, relative to the start of the given segment
+        of the given chromosome, of consecutive intervals within which
+        the calls of the tracks in use do not change, and the
+        (intervals x tracks) Boolean matrix of the tracks' calls within
+        each, as found in the call index. The calls are kept as runs,
+        such that no position within them is enumerated here.
+        """
+        trackRuns = []
+        for trackIdx, trackName in enumerate(self._modTrackNames):
+            runStarts, runEnds, runValues = self.callIndex.getRuns(
+                trackName, chrm, start, end)
+            if trackIdx == self._maskIndex:  # only runs that are masked
+                isMasked = runValues <= self.maskRegions
+                runStarts, runEnds = runStarts[isMasked], runEnds[isMasked]
+            trackRuns.append((runStarts - start, runEnds - start))
+        bounds = np.unique(np.concatenate(
+            [np.empty(0, dtype=np.intp)] +
+            [bound for runs in trackRuns for bound in runs]))
+        calls = np.empty((max(bounds.size - 1, 0), len(trackRuns)),
+                         dtype=bool)
+        for trackIdx, (runStarts, runEnds) in enumerate(trackRuns):
+            # A track's runs do not overlap, so an interval has a call
+            # if it is after more of their starts than of their ends.
+            boundDeltas = np.zeros(bounds.size, dtype=np.intp)
+            boundDeltas[np.searchsorted(bounds, runStarts)] += 1
+            boundDeltas[np.searchsorted(bounds, runEnds)] -= 1
+            calls[:, trackIdx] = np.cumsum(boundDeltas[:-1]) > 0
+        return bounds, calls
+
+    def computeSegment(self, modBaseScores, referenceSeq):
+        """Computes the modified sequence of a segment, given its scores and
+        reference sequence, as returned by readSegment.
+        Returns the modified sequence, as a byte buffer, and the positions,
+        relative to the segment start, at which any modification
+        (or masking) was called.
+        """
+        if isinstance(modBaseScores, tuple):  # read from the call index
+            return self._computeIndexedSegment(modBaseScores, referenceSeq)
+
+        # Immediately reduce the scores to their packed states,
+        # upon which all subsequent computation is performed.
+        with cUtils.timedStage(self.metrics, 'callStates'):
+            packedHasData, packedCalls = packTrackStates(modBaseScores,
+                                                         self._maskIndex,
+                                                         self.maskRegions)
+
+        # The groups' calls, ordered from highest to lowest priority.
+        with cUtils.timedStage(self.metrics, 'priorityResolution'):
+            firstCall, hasCall = resolveModBasePriority(
+                resolveTrackGroups(packedCalls, self.trackGroups))
+            modBaseCodes = self._modBaseCodes[firstCall]
+
+        # if masking all unset regions, use the mask base for those
+        # any masking applied here is only for masking bases without any data
+        with cUtils.timedStage(self.metrics, 'maskHandling'):
+            self._maskUnsetBases(packedHasData, modBaseCodes, hasCall)
+
+        with cUtils.timedStage(self.metrics, 'substitution'):
+            return self._substituteBases(referenceSeq, modBaseCodes, hasCall)
+
+    def _maskUnsetBases(self, packedHasData, modBaseCodes, hasCall):
+        """Masks all bases without any data, if requested, by calling the
+        mask base at them, given the packed data plane of computeSegment,
+        along with the modified base called at each position, and whether
+        there is any call, which are updated in place.
+        """
+        if self.maskAllUnsetRegions:
+            if any(len(trackIdxs) > 1 for trackIdxs, _ in self.trackGroups):
+                # When intersecting, zeros are treated as missing data,
+                # so bases without any (intersected) call are unset.
+                unsetBases = np.logical_not(hasCall)
+            elif self._maskIndex is None:
+                # bases at which no track (i.e. no packed bit) has data
+                unsetBases = np.logical_not(np.any(packedHasData, axis=1))
+            else:
+                # The mask track is defined at every base (i.e. its missing
+                # values are unmasked), so no base is without any data.
+                unsetBases = np.zeros(hasCall.size, dtype=bool)
+            modBaseCodes[unsetBases] = ord(cUtils.MASK_BASE)
+            hasCall |= unsetBases
+
+    def _substituteBases(self, referenceSeq, modBaseCodes, hasCall):
+        """Returns the modified sequence and the positions of its calls,
+        as for computeSegment, given the reference sequence, the modified
+        base called at each position, and whether there is any call.
+        """
+        modBaseTable, unmodBaseTable = self._substitutionTables
+
+        # Initially the sequence is unmodified and we successively modify it.
+        allModBases = np.copy(referenceSeq)
+        # Mask the sequence, allowing only base modifications
+        # that modify their 'target' base (i.e. '5fC' = 'f' only modifies
+        # 'C'). Return the reference base for all non-modifiable bases
+        # and for unmodified bases.
+        # This is done via the precomputed lookup tables, indexed by the
+        # byte values of the (putatively) modified and reference bases.
+        modPositions = np.flatnonzero(hasCall)
+
+        if modPositions.size > 0:
+            # Modify bases
+            allModBases[modPositions] = \
+                modBaseTable[modBaseCodes[modPositions],
+                             allModBases[modPositions]]
+            # Replace with ambiguous bases in unmodified sequence
+            if self.ambigMap:
+                unmodPositions = np.logical_not(hasCall)
+                allModBases[unmodPositions] = \
+                    unmodBaseTable[allModBases[unmodPositions]]
+
+        return allModBases, modPositions
+
+    def _computeIndexedSegment(self, indexedCalls, referenceSeq):
+        """Computes the modified sequence of a segment, as for
+        computeSegment, given the bounds of the intervals within which the
+        tracks' calls do not change and the tracks' calls within each
+        (see readIndexedCalls), such that each interval is resolved once
+        and only the positions of those with a call are modified.
+        A segment without any calls is a copy of its reference sequence.
+        """
+        bounds, calls = indexedCalls
+        with cUtils.timedStage(self.metrics, 'priorityResolution'):
+            firstCall, hasCall = resolveModBasePriority(resolveTrackGroups(
+                np.packbits(calls, axis=1), self.trackGroups))
+            modStarts, modEnds = bounds[:-1][hasCall], bounds[1:][hasCall]
+            modPositions = _expandRuns(modStarts, modEnds)
+            modBaseCodes = np.repeat(self._modBaseCodes[firstCall[hasCall]],
+                                     modEnds - modStarts)
+
+        with cUtils.timedStage(self.metrics, 'substitution'):
+            modBaseTable, unmodBaseTable = self._substitutionTables
+            # Unmodified bases are those of the reference, replaced with
+            # ambiguous bases if the segment has any calls,
+            # as for computeSegment.
+            allModBases = (unmodBaseTable[referenceSeq]
+                           if self.ambigMap and modPositions.size > 0
+                           else np.copy(referenceSeq))
+            if modPositions.size > 0:
+                allModBases[modPositions] = \
+                    modBaseTable[modBaseCodes, referenceSeq[modPositions]]
+            return allModBases, modPositions
+
+    def getCacheNamespace(self):
+        """Returns a digest of the archive, as identified by its path and
+        by the name, size and modification time of each of its files,
+        and of all parameters upon which the modified genome depends,
+        such that cached segments are only ever reused for the same
+        archive and parameters (see DiskSegmentCache).
+        """
+        inputPaths = self._getInputPaths()
+        digest = hashlib.sha1(repr((_CACHE_FORMAT_VERSION, inputPaths,
+                                    [cUtils.getFileStats(inputPath)
+                                     for inputPath in inputPaths])))
+        digest.update(repr((self.modBases, self.modOrder, self._modTrackKey,
+                            [(trackIdxs.tolist(), minCalls) for
+                             trackIdxs, minCalls in self.trackGroups],
+                            sorted(self.ambigMap.items()), self.maskRegions,
+                            self.maskAllUnsetRegions)))
+        return digest.hexdigest()
+
+    def _iterCacheBlocks(self, chrm, start, end):
+        """Yields the (start, end) coordinates of each cache block of
+        the given chromosome that overlaps the given region.
+        """
+        if chrm not in self._cacheBlockLayouts:
+            chromosome = self.genome[chrm]
+            self._cacheBlockLayouts[chrm] = (
+                int(chromosome.start), int(chromosome.end),
+                [int(supercontig.start) for supercontig in
+                 chromosome.supercontigs[chromosome.start:chromosome.end]])
+        chrmStart, chrmEnd, chunkOrigins = self._cacheBlockLayouts[chrm]
+        pos = start
+        while pos < end:
+            originIdx = bisect.bisect_right(chunkOrigins, pos) - 1
+            origin = chunkOrigins[originIdx] if originIdx >= 0 else 0
+            blockStart = (origin + ((pos - origin) // self._cacheBlockLen) *
+                          self._cacheBlockLen)
+            blockEnd = blockStart + self._cacheBlockLen
+            if originIdx + 1 < len(chunkOrigins):
+                blockEnd = min(blockEnd, chunkOrigins[originIdx + 1])
+            yield max(blockStart, chrmStart), min(blockEnd, chrmEnd)
+            pos = blockEnd
+
+    def getSegment(self, chrm, start, end):
+        """Computes the modified sequence of the given chromosome over the
+        given segment, which should be no longer than the segment length.
+        Returns the modified sequence, as a byte buffer (a uint8 array of
+        base codes), and the positions, relative to the segment start,
+        at which any modification (or masking) was called.
+        See readSegment and computeSegment.
+        If segments are cached, the segment is instead composed of its
+        cache blocks, with each consecutive run of blocks that are not
+        cached being read and computed together, and then cached.
+        """
+        if self.cache is None:
+            return self.computeSegment(*self.readSegment(chrm, start, end))
+
+        blocks = list(self._iterCacheBlocks(chrm, start, end))
+        blockSegments = [self.cache.get((chrm, s, e)) for s, e in blocks]
+        if self.metrics is not None:
+            numHits = sum(segment is not None for segment in blockSegments)
+            self.metrics.countCacheLookups(chrm, numHits,
+                                           len(blocks) - numHits)
+        runStartIdx = 0
+        while runStartIdx < len(blocks):
+            if blockSegments[runStartIdx] is not None:
+                runStartIdx += 1
+                continue
+            runEndIdx = runStartIdx + 1
+            while (runEndIdx < len(blocks) and
+                   blockSegments[runEndIdx] is None and
+                   (blocks[runEndIdx][1] - blocks[runStartIdx][0] <=
+                    self.segmentLen)):
+                runEndIdx += 1
+            runStart, runEnd = blocks[runStartIdx][0], blocks[runEndIdx - 1][1]
+            runModBases, runPositions = self.computeSegment(
+                *self.readSegment(chrm, runStart, runEnd))
+            runHasCall = np.zeros(runEnd - runStart, dtype=bool)
+            runHasCall[runPositions] = True
+            for blockIdx in xrange(runStartIdx, runEndIdx):
+                s, e = (pos - runStart for pos in blocks[blockIdx])
+                # Blocks are copied, such that each is stored on its own,
+                # with their positions stored as a packed Boolean mask.
+                blockSegments[blockIdx] = (runModBases[s:e].copy(),
+                                           np.packbits(runHasCall[s:e]))
+                self.cache.put((chrm,) + blocks[blockIdx],
+                               blockSegments[blockIdx])
+            runStartIdx = runEndIdx
+
+        seqs = [np.empty(0, dtype=np.uint8)]
+        positions = [np.empty(0, dtype=np.intp)]
+        for (blockStart, blockEnd), (blockModBases, blockHasCall) in \
+                zip(blocks, blockSegments):
+            s, e = max(start, blockStart), min(end, blockEnd)
+            seqs.append(blockModBases[s - blockStart:e - blockStart])
+            positions.append(np.flatnonzero(np.unpackbits(blockHasCall)
+                                            [s - blockStart:e - blockStart]) +
+                             (s - start))
+        return np.concatenate(seqs), np.concatenate(positions)
+
+    def iterBEDCoords(self, allModBases, modPositions):
+        """Yields each modified base, present at any of the given positions
+        of the given modified sequence, along with those of the positions
+        at which it is present.
+        """
+        # Use unique modified bases only, since we may otherwise obtain
+        # redundant track lines.
+        for base in set(self.modBases + cUtils.complement(self.modBases)):
+            baseModIdxs = np.flatnonzero(allModBases[modPositions] ==
+                                         ord(base))
+            if baseModIdxs.size > 0:
+                yield base, modPositions[baseModIdxs]
+
+    def getRegionBounds(self, chrm, start=None, end=None):
+        """Returns the start and end of the given region of the given
+        chromosome, which default to those of the chromosome.
+        Raises ValueError if the region is not within the chromosome.
+        """
+        try:
+            chromosome = self.genome[chrm]
+        except KeyError:
+            raise ValueError("There is no chromosome " + chrm + ".")
+        start = int(chromosome.start) if start is None else start
+        end = int(chromosome.end) if end is None else end
+        if not chromosome.start <= start <= end <= chromosome.end:
+            raise ValueError("The region {}:{}-{} is not within the "
+                             "chromosome.".format(chrm, start, end))
+        return start, end
+
+    def iterChromosome(self, chrm, start=None, end=None):
+        """Yields the modified sequence of the given chromosome (or of the
+        given region of it), one segment at a time, as strings, such that
+        memory use is bounded by the segment length.
+        """
+        start, end = self.getRegionBounds(chrm, start, end)
+        for s, e in self.iterSegmentBounds(chrm, start, end):
+            yield self.getSegment(chrm, s, e)[0].tostring()
+
+    def fetchArray(self, chrm, start=None, end=None):
+        """Returns the modified sequence of the given region (zero-based
+        and half-open) of the given chromosome, which is all of it, by
+        default, as a byte buffer (a uint8 array of base codes).
+        """
+        start, end = self.getRegionBounds(chrm, start, end)
+        return np.concatenate([np.empty(0, dtype=np.uint8)] +
+                              [self.getSegment(chrm, s, e)[0] for s, e
+                               in self.iterSegmentBounds(chrm, start, end)])
+
+    def fetch(self, chrm, start=None, end=None):
+        """Returns the modified sequence of the given region (zero-based
+        and half-open) of the given chromosome, which is all of it, by
+        default, as a string.
+        """
+        return ''.join(self.iterChromosome(chrm, start, end))
@@ -35,7 +35,9 @@ if [[ ! $DEFAULT_MASK_VALUE =~ [[:digit:]]+ ]]; then
 fi
 
 function cleanup {
-    rm  -Rf "../$work_dir" "$ARCHIVE_PATH" "$OTHER_ARCHIVE_OUT_PATH" "$TRACKS_BASE_PATH"*
+    rm  -Rf "../$work_dir" "$ARCHIVE_PATH" "${ARCHIVE_PATH%/}.manifest.json" \
+        "${ARCHIVE_PATH%/}.calls.npz" "$OTHER_ARCHIVE_OUT_PATH" \
+        "$TRACKS_BASE_PATH"*
 }
 
 function maybeFilter {
@@ -195,6 +197,402 @@ case $test_to_run in
         passMsg '4'
     fi
     ;&
+0|5)
+    # -------------------------------- Test 5 --------------------------------
+    track_out_serial_dir="${TRACKS_BASE_PATH}Serial/"
+    track_out_parallel_dir="${TRACKS_BASE_PATH}Parallel/"
+
+    mkdir "$track_out_serial_dir" "$track_out_parallel_dir"
+
+    # 5) check that generating the genome in parallel ('-j') produces
+    #    the same FASTA file and BED tracks as a serial run
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M -f test5-serial.fa \
+        --BEDOutDir "$track_out_serial_dir"
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M -f test5-parallel.fa \
+        --BEDOutDir "$track_out_parallel_dir" -j 2
+
+    if ! cmp -s test5-serial.fa test5-parallel.fa; then
+        failMsgAndExit '5: FASTA'
+    fi
+    for serial_track in "$track_out_serial_dir"*.bed.gz; do
+        parallel_track="$track_out_parallel_dir$(basename "$serial_track" | \
+                         sed 's/serial/parallel/')"
+        if ! cmp -s <(zcat "$serial_track") <(zcat "$parallel_track"); then
+            failMsgAndExit "5: $(basename "$serial_track")"
+        fi
+    done
+    passMsg '5'
+    ;&
+0|6)
+    # -------------------------------- Test 6 --------------------------------
+    regions_file='test6-regions.bed'
+    track_out_serial_dir="${TRACKS_BASE_PATH}RegionsSerial/"
+    track_out_parallel_dir="${TRACKS_BASE_PATH}RegionsParallel/"
+
+    mkdir "$track_out_serial_dir" "$track_out_parallel_dir"
+
+    # 6) check that generating a file of regions in parallel ('-j')
+    #    produces the same FASTA records, in the same order,
+    #    and the same BED tracks as a serial run
+    for start in $(seq 1858000 -1000 1658000); do
+        echo -e "chr$TEST_REGION_CHR\t$start\t$((start + 700))"
+    done > "$regions_file"
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -r "$regions_file" -c 500 \
+        -f test6-serial.fa --BEDOutDir "$track_out_serial_dir"
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -r "$regions_file" -c 500 \
+        -f test6-parallel.fa --BEDOutDir "$track_out_parallel_dir" -j 3
+
+    if ! cmp -s test6-serial.fa test6-parallel.fa; then
+        failMsgAndExit '6: FASTA'
+    fi
+    for serial_track in "$track_out_serial_dir"*.bed.gz; do
+        parallel_track="$track_out_parallel_dir$(basename "$serial_track" | \
+                         sed 's/serial/parallel/')"
+        if ! cmp -s <(zcat "$serial_track") <(zcat "$parallel_track"); then
+            failMsgAndExit "6: $(basename "$serial_track")"
+        fi
+    done
+    passMsg '6'
+    ;&
+0|7)
+    # -------------------------------- Test 7 --------------------------------
+    track_out_indexed_dir="${TRACKS_BASE_PATH}Indexed/"
+
+    mkdir "$track_out_indexed_dir"
+
+    # 7) check that indexed BED tracks ('--indexBED') are created,
+    #    with a tabix index for each track
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M -f test7.fa \
+        --BEDOutDir "$track_out_indexed_dir" --indexBED
+
+    for track in "$track_out_indexed_dir"*.bed.gz; do
+        if [[ ! -f "$track.tbi" ]]; then
+            failMsgAndExit "7: $(basename "$track")"
+        fi
+    done
+    passMsg '7'
+    ;&
+0|8)
+    # -------------------------------- Test 8 --------------------------------
+    # 8) check that wrapped output ('-w') is the unwrapped output,
+    #    with a newline after every full line
+    unwrapped_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -r "$TEST_4_REGION")
+    wrapped_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -r "$TEST_4_REGION" -w 10)
+
+    if [[ "$wrapped_seq" != "$(echo "$unwrapped_seq" | fold -w 10)" ]]; then
+        failMsgAndExit '8'
+    else
+        passMsg '8'
+    fi
+    ;&
+0|9)
+    # -------------------------------- Test 9 --------------------------------
+    # 9) check that a memory budget ('--memory-budget'), which results in
+    #    many, short, segments does not alter the output
+    test_9_region="chr$TEST_REGION_CHR:1800000-1900000"
+    default_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_9_region")
+    budgeted_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_9_region" --memory-budget 1K)
+
+    if [[ "$budgeted_seq" != "$default_seq" ]]; then
+        failMsgAndExit '9'
+    else
+        passMsg '9'
+    fi
+    ;&
+0|10)
+    # -------------------------------- Test 10 -------------------------------
+    regions_file='test10-regions.bed'
+
+    # 10) check that overlapping and unsorted regions, which are computed
+    #     together, produce the same records, in the input order,
+    #     as when each region is output on its own
+    echo -e "chr$TEST_REGION_CHR\t1858500\t1858550
+chr$TEST_REGION_CHR\t1858400\t1858530
+chr$TEST_REGION_CHR\t1858000\t1858100" > "$regions_file"
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M -b -r "$regions_file" -f test10.fa
+
+    individual_seqs=$(while read -r chrm start end; do
+        $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M -b -r "$chrm:$start-$end"
+    done < "$regions_file")
+
+    if [[ "$(grep -v '^>' test10.fa)" != "$individual_seqs" ]]; then
+        failMsgAndExit '10'
+    else
+        passMsg '10'
+    fi
+    ;&
+0|11)
+    # -------------------------------- Test 11 -------------------------------
+    # 11) check that a gzipped BED file of regions, with header lines and
+    #     regions of excluded chromosomes, produces the same centred
+    #     regions as a plain BED file of only the included regions
+    echo -e "chr$TEST_REGION_CHR\t1858500\t1858550
+chr$TEST_REGION_CHR\t1858400\t1858530" > test11-regions.bed
+    (echo -e "track name=test11\n# excluded chrM region below"
+     echo -e "chrM\t100\t200"
+     cat test11-regions.bed) | gzip > test11-regions.bed.gz
+    plain_seqs=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M -b -r test11-regions.bed -c 40)
+    gzipped_seqs=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M -b -r test11-regions.bed.gz -c 40)
+
+    if [[ -z "$plain_seqs" || "$gzipped_seqs" != "$plain_seqs" ]]; then
+        failMsgAndExit '11'
+    else
+        passMsg '11'
+    fi
+    ;&
+0|12)
+    # -------------------------------- Test 12 -------------------------------
+    # 12) check that an intersection ('-I') requiring only one of the
+    #     files of each modification type to agree ('-k 1') is their union
+    test_12_region="chr$TEST_REGION_CHR:1858000-1858600"
+    union_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -r "$test_12_region")
+    one_agreeing_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -r "$test_12_region" -I -k 1)
+
+    if [[ "$one_agreeing_seq" != "$union_seq" ]]; then
+        failMsgAndExit '12'
+    else
+        passMsg '12'
+    fi
+    ;&
+0|13)
+    # -------------------------------- Test 13 -------------------------------
+    # 13) check that the segments of a single region, computed in parallel
+    #     ('-j'), are reassembled into the same wrapped sequence as a
+    #     serial run, using a memory budget to produce many segments
+    test_13_region="chr$TEST_REGION_CHR:1800000-1900000"
+    serial_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_13_region" --memory-budget 1K -w 60)
+    parallel_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_13_region" --memory-budget 1K -w 60 -j 3)
+
+    if [[ "$parallel_seq" != "$serial_seq" ]]; then
+        failMsgAndExit '13'
+    else
+        passMsg '13'
+    fi
+    ;&
+0|14)
+    # -------------------------------- Test 14 -------------------------------
+    # 14) check that pipelining ('--pipeline') the reading, computation,
+    #     and writing of many segments does not alter the output
+    test_14_region="chr$TEST_REGION_CHR:1800000-1900000"
+    serial_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_14_region" --memory-budget 1K)
+    pipelined_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_14_region" --memory-budget 1K --pipeline 2)
+
+    if [[ "$pipelined_seq" != "$serial_seq" ]]; then
+        failMsgAndExit '14'
+    else
+        passMsg '14'
+    fi
+    ;&
+0|15)
+    # -------------------------------- Test 15 -------------------------------
+    # 15) check that an indexed ('--indexFASTA') Gzipped FASTA file is
+    #     created, with its FASTA and BGZF indices, and contains the
+    #     same records as a regular Gzipped FASTA file, and that a
+    #     sub-region fetched via its indices (by pysam) is correct
+    test_15_region="chr$TEST_REGION_CHR:1800000-1900000"
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_15_region" -w 60 \
+        -f test15.fa.gz
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_15_region" -w 60 \
+        -f test15-indexed.fa.gz --indexFASTA
+    test_15_fetch="import pysam; FASTA = pysam.FastaFile('test15-indexed.fa.gz'); \
+print(FASTA.fetch(FASTA.references[0], 12345, 54321))"
+
+    if [[ ! -f test15-indexed.fa.gz.fai || ! -f test15-indexed.fa.gz.gzi ]] ||
+       ! cmp -s <(zcat test15.fa.gz) <(zcat test15-indexed.fa.gz) ||
+       ! cmp -s <(zcat test15.fa.gz | fgrep -v '>' | tr -d '\n' | \
+                  cut -c 12346-54321) \
+                <(python -c "$test_15_fetch" 2> /dev/null); then
+        failMsgAndExit '15'
+    else
+        passMsg '15'
+    fi
+    ;&
+0|16)
+    # -------------------------------- Test 16 -------------------------------
+    # 16) check that the packed output ('.pmg') of a region contains the
+    #     same sequence as its FASTA file, both in its entirety and
+    #     for a sub-region, which is read via memory mapping
+    test_16_region="chr$TEST_REGION_CHR:1800000-1900000"
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_16_region" \
+        -f test16.fa
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M -r "$test_16_region" \
+        -f test16.pmg
+    test_16_fetch="import sys; sys.path.insert(0, '$BASE_PROG_PATH'); \
+import cytoUtils; genome = cytoUtils.PackedGenome('test16.pmg'); \
+print(genome.fetch('$test_16_region')); \
+print(genome.fetch('$test_16_region', 12345, 54321))"
+
+    if [[ ! -f test16.pmg.idx ]] ||
+       ! cmp -s <(fgrep -v '>' test16.fa | tr -d '\n'; echo; \
+                  fgrep -v '>' test16.fa | tr -d '\n' | cut -c 12346-54321) \
+                <(python -c "$test_16_fetch" 2> /dev/null); then
+        failMsgAndExit '16'
+    else
+        passMsg '16'
+    fi
+    ;&
+0|17)
+    # -------------------------------- Test 17 -------------------------------
+    # 17) check that a region fetched in-process, via the ModifiedGenome
+    #     class, is identical to the sequence output by Cytomod
+    test_17_region_start=1800000
+    test_17_region_end=1900000
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M \
+        -r "chr$TEST_REGION_CHR:$test_17_region_start-$test_17_region_end" \
+        > test17.txt
+    test_17_fetch="import sys; sys.path.insert(0, '$BASE_PROG_PATH'); \
+import modifiedGenome; \
+genome = modifiedGenome.ModifiedGenome('$ARCHIVE_PATH', maskRegions=0); \
+print(genome.fetch('chr$TEST_REGION_CHR', $test_17_region_start, \
+                   $test_17_region_end)); \
+genome.close()"
+
+    if ! cmp -s test17.txt <(python -c "$test_17_fetch" 2> /dev/null); then
+        failMsgAndExit '17'
+    else
+        passMsg '17'
+    fi
+    ;&
+0|18)
+    # -------------------------------- Test 18 -------------------------------
+    # 18) check that regions served over a Unix socket ('--serve'), with
+    #     segments cached on disk ('--cacheDir'), are identical to the
+    #     sequence output by Cytomod, for the region and a sub-region,
+    #     and that the socket is removed once the server is terminated
+    test_18_region="chr$TEST_REGION_CHR:1800000-1900000"
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b -M \
+        -r "$test_18_region" > test18.txt
+    $PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M --serve test18.sock \
+        --cacheDir test18-cache &
+    test_18_server_PID=$!
+    for attempt in {1..100}; do
+        [[ -S test18.sock ]] && break
+        sleep 0.2
+    done
+    test_18_query="import socket; \
+client = socket.socket(socket.AF_UNIX); client.connect('test18.sock'); \
+client.sendall('$test_18_region\nchr$TEST_REGION_CHR\t1812345\t1854321\n'); \
+client.shutdown(socket.SHUT_WR); \
+print(client.makefile().read().rstrip())"
+    python -c "$test_18_query" > test18-served.txt 2> /dev/null
+    kill $test_18_server_PID
+    wait $test_18_server_PID
+
+    if [[ -e test18.sock ]] ||
+       ! cmp -s <(cat test18.txt; cut -c 12346-54321 test18.txt) \
+                test18-served.txt; then
+        failMsgAndExit '18'
+    else
+        passMsg '18'
+    fi
+    ;&
+0|19)
+    # -------------------------------- Test 19 -------------------------------
+    # 19) check that, once an archive has been created from a manifest of
+    #     its inputs, a subsequent run with unchanged inputs reuses it,
+    #     without modifying it, and outputs the same sequence
+    $PROGRAM_PATH $VERBOSITY_ARG -d "$DATA_DIR/" "$DATA_DIR/" -b \
+        -r "$TEST_REGION" > test19A.txt
+    test_19_archive_stats=$(ls -l --time-style=full-iso "$ARCHIVE_PATH")
+    $PROGRAM_PATH $VERBOSITY_ARG -d "$DATA_DIR/" "$DATA_DIR/" -b \
+        -r "$TEST_REGION" > test19B.txt
+
+    if [[ ! -f "${ARCHIVE_PATH%/}.manifest.json" ||
+          $(ls -l --time-style=full-iso "$ARCHIVE_PATH") != \
+          "$test_19_archive_stats" ]] ||
+       ! cmp -s <(tail -n 1 test19A.txt) <(tail -n 1 test19B.txt); then
+        failMsgAndExit '19'
+    else
+        passMsg '19'
+    fi
+    ;&
+0|20)
+    # -------------------------------- Test 20 -------------------------------
+    # 20) check that a bedGraph track added to an archive, which is parsed
+    #     by a separate process when using multiple jobs, is loaded
+    #     (i.e. a duplicate track has the same values as the track it
+    #     duplicates, which was loaded by Genomedata, and does not change
+    #     the output sequence)
+    tracks_dir="${TRACKS_BASE_PATH}20/"
+    mkdir "$tracks_dir"
+    cp "$TRACK_PREF"*.bedGraph.gz "$tracks_dir"
+    $PROGRAM_PATH $VERBOSITY_ARG -d "$DATA_DIR/" "$tracks_dir" \
+        --archiveOutDir "$DATA_DIR" -b -r "$TEST_REGION" > test20A.txt
+    cp "${TRACK_PREF}5mC-fakeData.bedGraph.gz" \
+        "${tracks_dir}mm9_chrY-only_5mC-fakeData-2.bedGraph.gz"
+    $PROGRAM_PATH $VERBOSITY_ARG -d "$DATA_DIR/" "$tracks_dir" \
+        --archiveOutDir "$DATA_DIR" -b -r "$TEST_REGION" -j 2 > test20B.txt
+
+    test_20_compare="import numpy as np; from genomedata import Genome; \
+genome = Genome('$ARCHIVE_PATH'); \
+names = list(genome.tracknames_continuous); \
+idxs = [names.index(name) for name in sorted(names) if '5mC' in name]; \
+cols = [np.concatenate([continuous[:, idx] for chromosome in genome \
+for _, continuous in chromosome.itercontinuous()]) for idx in idxs]; \
+print(len(cols) == 2 and np.isfinite(cols[1]).any() and \
+np.array_equal(np.isnan(cols[0]), np.isnan(cols[1])) and \
+np.array_equal(np.nan_to_num(cols[0]), np.nan_to_num(cols[1])))"
+
+    if ! fgrep -q '5mC-fakeData-2' "${ARCHIVE_PATH%/}.manifest.json" ||
+       [[ $(python -c "$test_20_compare" 2> /dev/null) != 'True' ]] ||
+       ! cmp -s <(tail -n 1 test20A.txt) <(tail -n 1 test20B.txt); then
+        failMsgAndExit '20'
+    else
+        passMsg '20'
+    fi
+    ;&
+0|21)
+    # -------------------------------- Test 21 -------------------------------
+    # 21) check that reading the genome and tracks directly, without
+    #     an archive, yields the expected (masked) sequence
+    direct_res=$($PROGRAM_PATH $VERBOSITY_ARG --direct "$DATA_DIR/" \
+                 "$DATA_DIR/" -M -r "$TEST_REGION" -b | tail -n 1)
+    if [[ $direct_res != "$TEST_REGION_CORRECT_MASKED_RES" ]]; then
+        failMsgAndExit '21'
+    else
+        passMsg '21'
+    fi
+    ;&
+0|22)
+    # -------------------------------- Test 22 -------------------------------
+    # 22) check that the call index, both when built and when then loaded,
+    #     yields the same (masked and intersected) sequence as the archive
+    index_res_A=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M \
+                  -r "$TEST_REGION" -b --callIndex | tail -n 1)
+    index_res_B=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M \
+                  -r "$TEST_REGION" -b --callIndex | tail -n 1)
+    int_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b \
+              -r "$TEST_4_REGION" -I)
+    index_int_seq=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -b \
+                    -r "$TEST_4_REGION" -I --callIndex)
+
+    if [[ ! -f "${ARCHIVE_PATH%/}.calls.npz" ||
+          $index_res_A != "$TEST_REGION_CORRECT_MASKED_RES" ||
+          $index_res_B != "$TEST_REGION_CORRECT_MASKED_RES" ||
+          $index_int_seq != "$int_seq" ]]; then
+        failMsgAndExit '22'
+    else
+        passMsg '22'
+    fi
+    ;&
+0|23)
+    # -------------------------------- Test 23 -------------------------------
+    # 23) check that the metrics of a run, using multiple jobs, record all
+    #     of its bases and segments, without changing the output sequence
+    metrics_res=$($PROGRAM_PATH $VERBOSITY_ARG -G "$ARCHIVE_PATH" -M \
+                  -r "$TEST_REGION" -b -j 2 --metrics test23.json | tail -n 1)
+    test_23_bases="import json; metrics = json.load(open('test23.json')); \
+print(metrics['bases'] if metrics['segments'] > 0 and \
+metrics['stageSeconds']['archiveRead'] > 0 else 0)"
+
+    if [[ $metrics_res != "$TEST_REGION_CORRECT_MASKED_RES" ||
+          $(python -c "$test_23_bases" 2> /dev/null) -ne \
+          ${#TEST_REGION_CORRECT_MASKED_RES} ]]; then
+        failMsgAndExit '23'
+    else
+        passMsg '23'
+    fi
+    ;&
 esac
 
 exit $EXIT_SUCCESS